@@ -0,0 +1,350 @@
+""" The benchmark cases.  A case is a function of a Context: it sets up a trace in ctx.path, runs ctx.events events
+inside `with ctx.timed(num_events):`, and closes the trace so that its size counts towards bytes/event. """
+import contextlib
+import functools
+import gc
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import tg4perfetto
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _peak_rss_kib():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+class Context:
+    def __init__(self, path : str, events : int, threads : int):
+        self.path = path
+        self.events = events
+        self.threads = threads
+        self.seconds = None
+        self.num_events = None
+        # more result fields, e.g. overhead_ns
+        self.extra = {}
+
+    @contextlib.contextmanager
+    def timed(self, num_events : int):
+        """ Time the block, in which num_events events are recorded """
+        gc.collect()
+        start = time.perf_counter()
+        yield
+        self.seconds = time.perf_counter() - start
+        self.num_events = num_events
+
+    def result(self, name : str) -> dict:
+        n = self.num_events
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else None
+        result = {
+            "case": name,
+            "events": n,
+            "seconds": self.seconds,
+            "events_per_sec": n / self.seconds,
+            "ns_per_event": self.seconds / n * 1e9,
+            "bytes_per_event": None if size is None else size / n,
+            "peak_rss_kib": _peak_rss_kib(),
+        }
+        result.update(self.extra)
+        return result
+
+CASES = {}
+# case name -> the optional module (e.g. numpy) it needs
+_REQUIRES = {}
+
+def case(name, requires : str = None):
+    def register(func):
+        CASES[name] = func
+        if requires is not None:
+            _REQUIRES[name] = requires
+        return func
+    return register
+
+def missing(name : str) -> str:
+    """ The optional module that a case needs and that isn't installed, if any """
+    module = _REQUIRES.get(name)
+    if module is not None and importlib.util.find_spec(module) is None:
+        return module
+    return None
+
+def case_names(max_threads : int) -> list:
+    counts = []
+    n = 1
+    while n < max_threads:
+        counts.append(n)
+        n *= 2
+    counts.append(max_threads)
+    return list(CASES) + ["threads.{}".format(n) for n in counts]
+
+def get(name : str):
+    if name.startswith("threads."):
+        return functools.partial(_threads, int(name.split(".", 1)[1]))
+    return CASES[name]
+
+def _time_loop(func, n : int) -> float:
+    """ ns per call of func() """
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - start) / n * 1e9
+
+# --- raw TraceGenerator throughput, per event type
+
+def _generator(ctx):
+    tgen = tg4perfetto.TraceGenerator(ctx.path)
+    return tgen, tgen.create_group("bench").create_track("track")
+
+@case("tgen.slice")
+def tgen_slice(ctx):
+    tgen, track = _generator(ctx)
+    with ctx.timed(2 * ctx.events):
+        for i in range(ctx.events):
+            track.open(2 * i, "slice")
+            track.close(2 * i + 1)
+        tgen.close()
+
+@case("tgen.instant")
+def tgen_instant(ctx):
+    tgen, track = _generator(ctx)
+    with ctx.timed(ctx.events):
+        for i in range(ctx.events):
+            track.instant(i, "instant")
+        tgen.close()
+
+@case("tgen.flow")
+def tgen_flow(ctx):
+    tgen, track = _generator(ctx)
+    with ctx.timed(ctx.events):
+        for i in range(ctx.events):
+            track.instant(i, "instant", None, [i + 1])
+        tgen.close()
+
+@case("tgen.counter")
+def tgen_counter(ctx):
+    tgen = tg4perfetto.TraceGenerator(ctx.path)
+    counter = tgen.create_counter_track("counter")
+    with ctx.timed(ctx.events):
+        for i in range(ctx.events):
+            counter.count(i, i & 0xff)
+        tgen.close()
+
+@case("tgen.count_many", requires="numpy")
+def tgen_count_many(ctx):
+    tgen = tg4perfetto.TraceGenerator(ctx.path)
+    counter = tgen.create_counter_track("counter")
+    # the batch APIs are meant for arrays; build them outside the timed block
+    import numpy as np
+    ts = np.arange(ctx.events, dtype=np.int64)
+    values = ts & 0xff
+    with ctx.timed(ctx.events):
+        counter.count_many(ts, values)
+        tgen.close()
+
+@case("tgen.slices_many", requires="numpy")
+def tgen_slices_many(ctx):
+    tgen, track = _generator(ctx)
+    import numpy as np
+    starts = np.arange(0, 2 * ctx.events, 2, dtype=np.int64)
+    ends = starts + 1
+    with ctx.timed(2 * ctx.events):
+        track.slices_many(starts, ends, "slice")
+        tgen.close()
+
+# --- decorator overhead, against the same function undecorated
+
+def _work(a, b=None):
+    return a
+
+def _decorator_case(ctx, decorator):
+    baseline = _time_loop(lambda: _work(1, b=2), ctx.events)
+    func = decorator(_work)
+    with tg4perfetto.open(ctx.path):
+        with ctx.timed(2 * ctx.events):
+            for _ in range(ctx.events):
+                func(1, b=2)
+    ctx.extra["baseline_ns"] = baseline
+    # per call (a call records two events)
+    ctx.extra["overhead_ns"] = ctx.seconds / ctx.events * 1e9 - baseline
+
+@case("func.trace_func")
+def func_trace_func(ctx):
+    _decorator_case(ctx, tg4perfetto.trace_func)
+
+@case("func.trace_func_args")
+def func_trace_func_args(ctx):
+    _decorator_case(ctx, tg4perfetto.trace_func_args)
+
+@case("func.trace")
+def func_trace(ctx):
+    with tg4perfetto.open(ctx.path):
+        with ctx.timed(2 * ctx.events):
+            for _ in range(ctx.events):
+                with tg4perfetto.trace("slice"):
+                    pass
+
+@case("func.trace.mmap")
+def func_trace_mmap(ctx):
+    with tg4perfetto.open(ctx.path, mmap_output=True):
+        with ctx.timed(2 * ctx.events):
+            for _ in range(ctx.events):
+                with tg4perfetto.trace("slice"):
+                    pass
+
+# --- contention: every thread records ctx.events slices into the same trace
+
+def _threads(num_threads, ctx):
+    barrier = threading.Barrier(num_threads + 1)
+    def run():
+        barrier.wait()
+        for _ in range(ctx.events):
+            with tg4perfetto.trace("slice"):
+                pass
+        barrier.wait()
+    with tg4perfetto.open(ctx.path):
+        threads = [threading.Thread(target=run) for _ in range(num_threads)]
+        for t in threads:
+            t.start()
+        barrier.wait()
+        with ctx.timed(2 * ctx.events * num_threads):
+            barrier.wait()
+        for t in threads:
+            t.join()
+    ctx.extra["threads"] = num_threads
+
+# --- annotation-heavy events
+
+@case("annotations.small")
+def annotations_small(ctx):
+    with tg4perfetto.open(ctx.path):
+        with ctx.timed(ctx.events):
+            for i in range(ctx.events):
+                tg4perfetto.instant("instant", {"i": i, "name": "request", "ok": True, "ratio": 0.5})
+
+@case("annotations.unique_strings")
+def annotations_unique_strings(ctx):
+    with tg4perfetto.open(ctx.path):
+        with ctx.timed(ctx.events):
+            for i in range(ctx.events):
+                tg4perfetto.instant("instant", {"id": "request-{}".format(i)})
+
+@case("annotations.large")
+def annotations_large(ctx):
+    args = {"rows": list(range(100000)), "nested": {"a": [{"b": list(range(100))}] * 100}, "text": "x" * 10000}
+    n = max(1, ctx.events // 10)
+    with tg4perfetto.open(ctx.path):
+        with ctx.timed(n):
+            for _ in range(n):
+                tg4perfetto.instant("instant", args)
+
+# --- counter spam
+
+@case("counter.increment")
+def counter_increment(ctx):
+    counter = tg4perfetto.count("counter")
+    with tg4perfetto.open(ctx.path):
+        with ctx.timed(ctx.events):
+            for _ in range(ctx.events):
+                counter.increment(1)
+
+@case("counter.coalesced")
+def counter_coalesced(ctx):
+    counter = tg4perfetto.count("counter", interval=0.001)
+    with tg4perfetto.open(ctx.path):
+        with ctx.timed(ctx.events):
+            for _ in range(ctx.events):
+                counter.increment(1)
+
+# --- instrumentation left in place while no trace is open, against the same code without it
+
+def _disabled_case(ctx, func, baseline_func):
+    baseline = _time_loop(baseline_func, ctx.events)
+    with ctx.timed(ctx.events):
+        for _ in range(ctx.events):
+            func()
+    ctx.extra["baseline_ns"] = baseline
+    ctx.extra["overhead_ns"] = ctx.seconds / ctx.events * 1e9 - baseline
+
+@case("disabled.trace_func")
+def disabled_trace_func(ctx):
+    func = tg4perfetto.trace_func(_work)
+    _disabled_case(ctx, lambda: func(1, b=2), lambda: _work(1, b=2))
+
+@case("disabled.environment")
+def disabled_environment(ctx):
+    # decorated with TG4PERFETTO_DISABLED=1, which leaves the function undecorated
+    os.environ["TG4PERFETTO_DISABLED"] = "1"
+    try:
+        func = tg4perfetto.trace_func(_work)
+    finally:
+        del os.environ["TG4PERFETTO_DISABLED"]
+    _disabled_case(ctx, lambda: func(1, b=2), lambda: _work(1, b=2))
+
+@case("disabled.trace")
+def disabled_trace(ctx):
+    def traced():
+        with tg4perfetto.trace("slice"):
+            return _work(1)
+    def plain():
+        return _work(1)
+    _disabled_case(ctx, traced, plain)
+
+@case("disabled.instant")
+def disabled_instant(ctx):
+    _disabled_case(ctx, lambda: tg4perfetto.instant("instant"), lambda: None)
+
+# --- startup: `import tg4perfetto` in a fresh interpreter, as every short-lived program that keeps the decorators pays
+
+_STARTUP_RUNS = 20
+
+def _startup_case(ctx, code):
+    """ Run code in _STARTUP_RUNS fresh interpreters.  overhead_ns is the median time the code took,
+    peak_rss_kib the interpreters' (rather than this process's), and protobuf_loaded whether the code loaded the
+    protobuf runtime. """
+    script = ("import sys, time\nstart = time.perf_counter_ns()\n{}\nend = time.perf_counter_ns()\n"
+              "try:\n    import resource\n    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+              "except ImportError:\n    rss = None\n"
+              "print(end - start, rss, 'google.protobuf' in sys.modules)").format(code)
+    times = []
+    rss = []
+    with ctx.timed(_STARTUP_RUNS):
+        for _ in range(_STARTUP_RUNS):
+            out = subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE, check=True,
+                                 universal_newlines=True).stdout.split()
+            times.append(int(out[0]))
+            # bytes on macOS, KiB elsewhere
+            rss.append(None if out[1] == "None" else int(out[1]) // 1024 if sys.platform == "darwin" else int(out[1]))
+    ctx.extra["overhead_ns"] = statistics.median(times)
+    ctx.extra["peak_rss_kib"] = None if None in rss else max(rss)
+    ctx.extra["protobuf_loaded"] = out[2] == "True"
+
+@case("startup.import")
+def startup_import(ctx):
+    _startup_case(ctx, "import tg4perfetto")
+
+@case("startup.decorated")
+def startup_decorated(ctx):
+    # instrumentation left in place, with no trace opened
+    _startup_case(ctx, "import tg4perfetto\n"
+                       "@tg4perfetto.trace_func\n"
+                       "def f():\n"
+                       "    pass\n"
+                       "f()")
+
+@case("startup.open")
+def startup_open(ctx):
+    # up to the first event of a first trace (in a file of its own, so that bytes/event stays empty)
+    _startup_case(ctx, "import tg4perfetto\n"
+                       "with tg4perfetto.open({!r}):\n"
+                       "    with tg4perfetto.trace('slice'):\n"
+                       "        pass".format(ctx.path + ".startup"))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+""" Benchmarks of tg4perfetto's own cost.
+
+    python benchmarks/run.py                          # every case, as a table
+    python benchmarks/run.py -k threads -k func       # cases whose name contains "threads" or "func"
+    python benchmarks/run.py --json results.json      # also write the results as JSON ("-" for stdout)
+
+Benchmarks the tg4perfetto that `import tg4perfetto` finds (e.g., after `pip install -e .`).  Each case runs in a
+subprocess of its own, so that cases don't share tracing state and the peak memory is the case's own.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import cases
+
+def _run_child(name, args):
+    """ Run one case in this process and print its result as JSON """
+    case = cases.get(name)
+    with tempfile.TemporaryDirectory() as tmp:
+        ctx = cases.Context(os.path.join(tmp, "bench.perfetto-trace"), args.events, args.threads)
+        case(ctx)
+        result = ctx.result(name)
+    print(json.dumps(result))
+
+def _run_case(name, args):
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--events", str(args.events),
+           "--threads", str(args.threads)]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def _meta():
+    import tg4perfetto
+    try:
+        from importlib.metadata import version
+        tg_version = version("tg4perfetto")
+    except Exception:
+        tg_version = None
+    return {
+        "tg4perfetto": tg_version,
+        "tg4perfetto_path": os.path.dirname(tg4perfetto.__file__),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    }
+
+def _format(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "{:,.1f}".format(value)
+    return "{:,}".format(value)
+
+_COLUMNS = ["events_per_sec", "ns_per_event", "bytes_per_event", "overhead_ns", "peak_rss_kib"]
+
+def _print_table(results, file):
+    width = max(len(r["case"]) for r in results)
+    print("{:{}}  {}".format("case", width, "  ".join("{:>15}".format(c) for c in _COLUMNS)), file=file)
+    for r in results:
+        print("{:{}}  {}".format(r["case"], width, "  ".join("{:>15}".format(_format(r.get(c))) for c in _COLUMNS)), file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark tg4perfetto")
+    parser.add_argument("-k", dest="filters", action="append", default=[],
+                        help="only run cases whose name contains this (may be repeated)")
+    parser.add_argument("--events", type=int, default=100000, help="events per case (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=8, help="most threads to scale up to (default: %(default)s)")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE ('-' for stdout)")
+    parser.add_argument("--list", action="store_true", help="list the cases and exit")
+    parser.add_argument("--child", metavar="CASE", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _run_child(args.child, args)
+        return 0
+
+    names = [n for n in cases.case_names(args.threads) if not args.filters or any(f in n for f in args.filters)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+    if not names:
+        parser.error("no case matches " + ", ".join(args.filters))
+
+    # the table goes to stderr when the JSON goes to stdout
+    table = sys.stderr if args.json == "-" else sys.stdout
+    results = []
+    for name in names:
+        module = cases.missing(name)
+        if module is not None:
+            print("skipping {} ({} isn't installed)".format(name, module), file=sys.stderr)
+            continue
+        print("running " + name, file=sys.stderr)
+        results.append(_run_case(name, args))
+    if results:
+        _print_table(results, table)
+
+    if args.json:
+        doc = {"meta": _meta(), "config": {"events": args.events, "threads": args.threads}, "results": results}
+        if args.json == "-":
+            json.dump(doc, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w") as f:
+                json.dump(doc, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,2 +1,29 @@
-from ._tgen import TraceGenerator
-from ._profile import instant, trace, count, trace_func, trace_func_args, open, track
+from ._profile import (instant, trace, count, trace_func, trace_func_args, open, track, dump, use_track, task_factory,
+                       enable, disable, enabled)
+from ._sampling import sampling
+
+# The rest is imported on first use (PEP 562): TraceGenerator loads the trace machinery, and the readers the
+# protobuf runtime, neither of which programs that only keep the decorators in place need.
+_lazy = {
+    "TraceGenerator": "._tgen",
+    "TraceReader": "._reader",
+    "summarize": "._reader",
+    "filter_trace": "._reader",
+    "repair_trace": "._reader",
+    "merge_traces": "._merge",
+}
+
+__all__ = ["instant", "trace", "count", "trace_func", "trace_func_args", "open", "track", "dump", "use_track",
+           "task_factory", "enable", "disable", "enabled", "sampling"] + list(_lazy)
+
+def __getattr__(name):
+    module = _lazy.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    import importlib
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
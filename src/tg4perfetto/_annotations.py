@@ -0,0 +1,76 @@
+import enum
+import sys
+
+# How the trace engines encode a value of a given type as a debug annotation.  Each engine maps these kinds to
+# encoders, and caches the encoder per type.
+_KIND_STR = 0
+_KIND_BOOL = 1
+_KIND_INT = 2
+_KIND_FLOAT = 3
+_KIND_DICT = 4
+_KIND_LIST = 5
+_KIND_BYTES = 6
+_KIND_ENUM = 7
+_KIND_DATACLASS = 8
+_KIND_NDARRAY = 9
+_KIND_NPSCALAR = 10
+_KIND_OTHER = 11
+
+# NumPy arrays larger than this only get their shape and dtype, not min/max/mean
+_NDARRAY_MAX_STATS_SIZE = 1 << 20
+# bytes values show this many bytes in hex
+_BYTES_PREVIEW = 32
+
+def _kind(t) -> int:
+    """ The kind of values of type t """
+    # enums before int and str, since IntEnum and StrEnum members are ints and strs too; bool before int
+    if issubclass(t, enum.Enum):
+        return _KIND_ENUM
+    if issubclass(t, bool):
+        return _KIND_BOOL
+    if issubclass(t, str):
+        return _KIND_STR
+    if issubclass(t, int):
+        return _KIND_INT
+    if issubclass(t, float):
+        return _KIND_FLOAT
+    if issubclass(t, dict):
+        return _KIND_DICT
+    if issubclass(t, (list, tuple, set, frozenset)):
+        return _KIND_LIST
+    if issubclass(t, (bytes, bytearray, memoryview)):
+        return _KIND_BYTES
+    if hasattr(t, "__dataclass_fields__"):
+        return _KIND_DATACLASS
+    # numpy is only looked at if the program imported it
+    numpy = sys.modules.get("numpy")
+    if numpy is not None:
+        if issubclass(t, numpy.ndarray):
+            return _KIND_NDARRAY
+        if issubclass(t, numpy.generic):
+            return _KIND_NPSCALAR
+    return _KIND_OTHER
+
+def _dataclass_fields(v) -> dict:
+    """ The fields of a dataclass instance (not recursively, unlike dataclasses.asdict()) """
+    import dataclasses
+    return {f.name: getattr(v, f.name) for f in dataclasses.fields(v)}
+
+def _ndarray_summary(a, max_values : int) -> dict:
+    """ Shape, dtype and either the values (of small arrays) or min/max/mean (of numeric ones) """
+    d = {"shape": list(a.shape), "dtype": str(a.dtype)}
+    if a.size <= max_values:
+        d["values"] = a.tolist()
+    elif a.dtype.kind in "biuf" and a.size <= _NDARRAY_MAX_STATS_SIZE:
+        d["min"] = a.min().item()
+        d["max"] = a.max().item()
+        d["mean"] = a.mean().item()
+    return d
+
+def _bytes_summary(v) -> str:
+    """ Length and leading bytes of a bytes-like value, e.g. "<5 bytes: 68656c6c6f>" """
+    v = memoryview(v).cast("B")
+    preview = v[:_BYTES_PREVIEW].hex()
+    if len(v) > _BYTES_PREVIEW:
+        preview += "..."
+    return "<{} bytes: {}>".format(len(v), preview)
@@ -0,0 +1,159 @@
+import fnmatch
+import os
+import re
+import sys
+import threading
+
+from ._clock import _now
+from ._wire import _function_name
+
+# tg4perfetto's own functions are never traced
+_own_dir = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+def _compile(patterns):
+    """ Matcher for a list of glob patterns such as "mypkg.*" or "*.helper" (None if there are none) """
+    if not patterns:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns)).match
+
+class _AutoTracer:
+    """ Traces every Python function call as a slice on the calling thread's default track.
+
+    Uses sys.monitoring (PEP 669) on Python 3.12+, where functions that are filtered out stop generating events
+    altogether.  Older versions fall back to sys.setprofile() and threading.setprofile(); there, threads that are
+    already running (other than the one calling start()) are not traced.
+
+    Functions are matched by "module.qualname" against include and exclude, which are glob patterns.  Depth
+    counts the traced calls open on a thread; only calls at depth min_depth to max_depth become slices.  Names and
+    source locations are computed once per code object.
+    """
+    def __init__(self, tracefile, thread_track, include = None, exclude = None, min_depth : int = 1, max_depth : int = None):
+        self._tracefile = tracefile
+        # returns the calling thread's default track uuid
+        self._thread_track = thread_track
+        self._include = _compile(include)
+        self._exclude = _compile(exclude)
+        self._min_depth = min_depth
+        self._max_depth = sys.maxsize if max_depth is None else max_depth
+        # code object -> (name, source location), or None if it is filtered out
+        self._codes = {}
+        self._local = threading.local()
+        self._running = False
+
+    def _classify(self, code, frame):
+        info = None
+        if not code.co_filename.startswith(_own_dir):
+            name = _function_name(code)
+            module = frame.f_globals.get("__name__", "") if frame is not None and frame.f_code is code else ""
+            full_name = module + "." + name
+            if (self._include is None or self._include(full_name)) and (self._exclude is None or not self._exclude(full_name)):
+                info = (name, (code.co_filename, code.co_firstlineno, name))
+        self._codes[code] = info
+        return info
+
+    def reset(self, tracefile):
+        """ Continue tracing into another trace (in a forked child) """
+        self._tracefile = tracefile
+        self._local = threading.local()
+
+    def _state(self):
+        """ [stack of traced calls (True if it became a slice), sequence, track uuid] of the calling thread """
+        try:
+            return self._local.state
+        except AttributeError:
+            state = self._local.state = [[], self._tracefile._thread_sequence(), self._thread_track()]
+            return state
+
+    def _call(self, code, frame):
+        """ A function starts or resumes.  Returns False if it is filtered out. """
+        try:
+            info = self._codes[code]
+        except KeyError:
+            info = self._classify(code, frame)
+        if info is None:
+            return False
+        stack, seq, uuid = self._state()
+        if self._min_depth <= len(stack) + 1 <= self._max_depth:
+            stack.append(True)
+            seq.track_open(uuid, _now(), info[0], None, (), info[1])
+            self._tracefile._flush_if_necessary(seq)
+        else:
+            stack.append(False)
+        return True
+
+    def _return(self, code):
+        """ A function returns, yields or unwinds.  Returns False if it is filtered out. """
+        info = self._codes.get(code, False)
+        if info is None:
+            return False
+        # functions that were already running when tracing started have no call on the stack
+        if info is not False:
+            stack, seq, uuid = self._state()
+            if stack and stack.pop():
+                seq.track_close(uuid, _now(), ())
+                self._tracefile._flush_if_necessary(seq)
+        return True
+
+    def start(self):
+        self._running = True
+        if hasattr(sys, "monitoring"):
+            self._start_monitoring()
+        else:
+            sys.setprofile(self._profile)
+            threading.setprofile(self._profile)
+
+    def stop(self):
+        """ Stop tracing.  Slices still open are left unterminated. """
+        self._running = False
+        if hasattr(sys, "monitoring"):
+            self._stop_monitoring()
+        else:
+            threading.setprofile(None)
+            sys.setprofile(None)
+
+    def _profile(self, frame, event, arg):
+        if not self._running:
+            # other threads remove the hook on their next call
+            sys.setprofile(None)
+        elif event == "call":
+            self._call(frame.f_code, frame)
+        elif event == "return":
+            self._return(frame.f_code)
+
+    def _start_monitoring(self):
+        mon = sys.monitoring
+        events = mon.events
+        DISABLE = mon.DISABLE
+        getframe = sys._getframe
+        call = self._call
+        ret = self._return
+
+        # returning DISABLE turns the event off for that code location, so filtered out functions cost nothing
+        def on_start(code, offset):
+            if not call(code, getframe(1)):
+                return DISABLE
+        def on_return(code, offset, value):
+            if not ret(code):
+                return DISABLE
+        def on_unwind(code, offset, exception):
+            # PY_UNWIND can't be disabled
+            ret(code)
+
+        mon.use_tool_id(mon.PROFILER_ID, "tg4perfetto")
+        mon.register_callback(mon.PROFILER_ID, events.PY_START, on_start)
+        mon.register_callback(mon.PROFILER_ID, events.PY_RESUME, on_start)
+        mon.register_callback(mon.PROFILER_ID, events.PY_RETURN, on_return)
+        mon.register_callback(mon.PROFILER_ID, events.PY_YIELD, on_return)
+        mon.register_callback(mon.PROFILER_ID, events.PY_UNWIND, on_unwind)
+        mon.set_events(mon.PROFILER_ID, events.PY_START | events.PY_RESUME | events.PY_RETURN | events.PY_YIELD | events.PY_UNWIND)
+        # code locations disabled by an earlier session may match this session's filters
+        mon.restart_events()
+
+    def _stop_monitoring(self):
+        mon = sys.monitoring
+        mon.set_events(mon.PROFILER_ID, 0)
+        for event in (mon.events.PY_START, mon.events.PY_RESUME, mon.events.PY_RETURN, mon.events.PY_YIELD, mon.events.PY_UNWIND):
+            mon.register_callback(mon.PROFILER_ID, event, None)
+        mon.free_tool_id(mon.PROFILER_ID)
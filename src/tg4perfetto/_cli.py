@@ -0,0 +1,120 @@
+import argparse
+import json
+import sys
+
+
+def _format_ns(ns):
+    if ns is None:
+        return "-"
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if ns >= scale:
+            return "{:.2f}{}".format(ns / scale, unit)
+    return "{}ns".format(ns)
+
+def _print_stats(summary, top):
+    print("packets: {:,}  track events: {:,}".format(summary["packets"], summary["track_events"]))
+    if summary["first_ts"] is not None:
+        print("time range: {} - {} ({})".format(summary["first_ts"], summary["last_ts"],
+                                                 _format_ns(summary["last_ts"] - summary["first_ts"])))
+    slices = sorted(summary["slices"].items(), key=lambda item: item[1]["total_ns"], reverse=True)[:top]
+    if slices:
+        width = max(len(str(name)) for name, _ in slices)
+        print()
+        print("{:{}}  {:>10}  {:>10}  {:>10}  {:>10}  {:>10}".format("slice", width, "count", "total", "p50", "p99", "max"))
+        for name, s in slices:
+            print("{:{}}  {:>10,}  {:>10}  {:>10}  {:>10}  {:>10}".format(str(name), width, s["count"], _format_ns(s["total_ns"]),
+                  _format_ns(s["p50_ns"]), _format_ns(s["p99_ns"]), _format_ns(s["max_ns"])))
+    instants = sorted(summary["instants"].items(), key=lambda item: item[1], reverse=True)[:top]
+    if instants:
+        width = max(len(str(name)) for name, _ in instants)
+        print()
+        print("{:{}}  {:>10}".format("instant", width, "count"))
+        for name, count in instants:
+            print("{:{}}  {:>10,}".format(str(name), width, count))
+    counters = sorted(summary["counters"].items())[:top]
+    if counters:
+        width = max(len(name) for name, _ in counters)
+        print()
+        print("{:{}}  {:>10}  {:>12}  {:>12}  {:>12}  {:>12}".format("counter", width, "count", "min", "max", "mean", "last"))
+        for name, c in counters:
+            print("{:{}}  {:>10,}  {:>12.6g}  {:>12.6g}  {:>12.6g}  {:>12.6g}".format(name, width, c["count"], c["min"], c["max"],
+                                                                                      c["mean"], c["last"]))
+    _print_validation(summary["validation"])
+
+def _print_validation(validation):
+    print()
+    if validation["ok"]:
+        print("valid")
+    for error in validation["errors"]:
+        print("error: " + error)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tg4perfetto", description="Inspect and trim perfetto traces")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    stats = commands.add_parser("stats", help="summarize the slices, instants and counters of a trace")
+    stats.add_argument("trace")
+    stats.add_argument("--top", type=int, default=20, help="show the top N slices/instants/counters (default: %(default)s)")
+    stats.add_argument("--json", action="store_true", help="print the whole summary as JSON")
+
+    validate = commands.add_parser("validate", help="check a trace for unmatched slices, unknown iids, truncation, ...")
+    validate.add_argument("trace")
+    validate.add_argument("--json", action="store_true", help="print the validation report as JSON")
+
+    trim = commands.add_parser("filter", help="copy the events in a time range and/or on some tracks to a new trace")
+    trim.add_argument("trace")
+    trim.add_argument("output")
+    trim.add_argument("--start", type=int, help="drop events before this timestamp (ns)")
+    trim.add_argument("--end", type=int, help="drop events after this timestamp (ns)")
+    trim.add_argument("--track", action="append", dest="tracks",
+                      help="keep the tracks whose name matches this glob, and their descendants (may be repeated)")
+
+    repair = commands.add_parser("repair", help="cut a trace whose process died while writing it back to its last whole packet")
+    repair.add_argument("trace")
+
+    merge = commands.add_parser("merge", help="merge traces (e.g., one per process or host) into one")
+    merge.add_argument("output")
+    merge.add_argument("traces", nargs="+")
+    merge.add_argument("--offset", type=int, action="append", dest="offsets",
+                       help="nanoseconds to add to an input's timestamps (one per input, in order, if any)")
+    merge.add_argument("--keep-flows", action="store_true",
+                       help="keep the flow IDs as they are, e.g. for flows between forked processes")
+
+    args = parser.parse_args(argv)
+    # imported after the arguments are parsed, so that --help doesn't wait for the protobuf runtime
+    from ._merge import merge_traces
+    from ._reader import summarize, filter_trace, repair_trace
+    if args.command == "stats":
+        summary = summarize(args.trace)
+        if args.json:
+            json.dump(summary, sys.stdout, indent=2)
+            print()
+        else:
+            _print_stats(summary, args.top)
+        return 0
+    if args.command == "validate":
+        validation = summarize(args.trace)["validation"]
+        if args.json:
+            json.dump(validation, sys.stdout, indent=2)
+            print()
+        else:
+            _print_validation(validation)
+        return 0 if validation["ok"] else 1
+    if args.command == "repair":
+        result = repair_trace(args.trace)
+        print("{}: {:,} packets, {:,} of {:,} bytes kept".format(args.trace, result["packets"], result["bytes_after"],
+                                                                 result["bytes_before"]))
+        return 0
+    if args.command == "merge":
+        if args.offsets is not None and len(args.offsets) != len(args.traces):
+            parser.error("--offset must be given once per input")
+        result = merge_traces(args.traces, args.output, args.offsets, not args.keep_flows)
+        for error in result["errors"]:
+            print("error: " + error, file=sys.stderr)
+        print("{:,} packets of {} traces written to {}".format(result["packets"], result["inputs"], args.output))
+        return 0
+    result = filter_trace(args.trace, args.output, args.start, args.end, args.tracks)
+    for error in result["errors"]:
+        print("error: " + error, file=sys.stderr)
+    print("{:,} of {:,} packets written to {}".format(result["packets_out"], result["packets_in"], args.output))
+    return 0
@@ -0,0 +1,24 @@
+import time
+
+# perfetto's builtin clock ids
+_BUILTIN_CLOCK_REALTIME = 1
+_BUILTIN_CLOCK_MONOTONIC = 3
+_BUILTIN_CLOCK_BOOTTIME = 6
+# Clock ids from 64 up are scoped to a packet sequence.  Delta-encoded timestamps count on this one.
+_CLOCK_INCREMENTAL = 64
+
+# The clock of tg4perfetto.open() traces.  perf_counter_ns() is clock_gettime(CLOCK_MONOTONIC) on Linux: it has
+# nanosecond resolution, and unlike time.time_ns() it doesn't jump when the wall clock is set.
+_now = time.perf_counter_ns
+
+def _snapshot():
+    """ Readings of _now() (as CLOCK_MONOTONIC), the realtime clock and (where the OS has it) the boottime clock,
+    all taken at the same moment.  Returns ([(clock id, timestamp)], primary clock id). """
+    before = _now()
+    realtime = time.time_ns()
+    boottime = time.clock_gettime_ns(time.CLOCK_BOOTTIME) if hasattr(time, "CLOCK_BOOTTIME") else None
+    after = _now()
+    clocks = [(_BUILTIN_CLOCK_REALTIME, realtime), (_BUILTIN_CLOCK_MONOTONIC, (before + after) // 2)]
+    if boottime is None:
+        return clocks, _BUILTIN_CLOCK_MONOTONIC
+    return clocks + [(_BUILTIN_CLOCK_BOOTTIME, boottime)], _BUILTIN_CLOCK_BOOTTIME
@@ -1,83 +1,408 @@
-from . import perfetto_trace_pb2 as pb2
+import functools
+import itertools
+import threading
+import weakref
+from ._clock import _now, _snapshot, _BUILTIN_CLOCK_REALTIME, _BUILTIN_CLOCK_BOOTTIME, _BUILTIN_CLOCK_MONOTONIC, _CLOCK_INCREMENTAL
+from ._wire import _WireSequence, _compress_packets
+from ._writer import _AsyncWriter, _RingBuffer, _RotatingFile, _MmapFile
 
 # Set this to true if you want to dump the protobuf results to stdout.  For debugging.
 print_proto = False
 
+def _proto_sequence():
+    # imported when a trace asks for it, as it loads the protobuf runtime
+    from ._proto import _ProtoSequence
+    return _ProtoSequence
+
+# Packet encoders (as functions that return the sequence class).  "wire" writes the protobuf wire format directly
+# and is much faster; "protobuf" goes through the generated pb2 classes and produces the same bytes.
+_engines = {
+    "wire" : lambda: _WireSequence,
+    "protobuf" : _proto_sequence,
+}
+
+def _write_chunk(file, serialize, compress_level, chunk):
+    data = serialize(chunk)
+    if print_proto:
+        from . import perfetto_trace_slim_pb2 as pb2
+        print(pb2.Trace.FromString(data))
+    if compress_level is not None:
+        data = _compress_packets(data, compress_level)
+    file.write(data)
+    file.flush()
+
+class _ThreadEnd:
+    """ Kept in a thread's thread-local data, and so dropped when the thread finishes (see _thread_finished()) """
+    def __init__(self, tracefile, seq, tracks):
+        self._tracefile = weakref.ref(tracefile)
+        self._seq = seq
+        self._tracks = tracks
+
+    def __del__(self):
+        tracefile = self._tracefile()
+        if tracefile is not None:
+            tracefile._thread_finished(self._seq, list(self._tracks.values()))
+
 class _BaseTraceGenerator:
-    def __init__(self, filename : str):
-        """ Create a trace """
-        self.__uuid__ = 1234567
-        self.interned_data = {}
-        self.interned_source = {}
+    # stays set if __init__ fails before the file is opened
+    _closed = True
+
+    def __init__(self, filename : str, engine : str = "wire", async_flush : bool = False,
+                 max_pending_flushes : int = 4, backpressure : str = "block", compress : bool = False,
+                 compress_level : int = 6, ring_buffer_size : int = None, rotate_bytes : int = None,
+                 rotate_seconds : float = None, keep_segments : int = None, shard : int = 0, clock : str = None,
+                 incremental_timestamps : bool = False, mmap_output : bool = False):
+        """ Create a trace.
+
+        engine: packet encoder, "wire" (default) or "protobuf".
+        async_flush: serialize and write flushed packets on a background writer thread.
+        max_pending_flushes: (async_flush only) number of flushed chunks that may wait for the writer.
+        backpressure: (async_flush only) what to do when the writer falls behind: "block" waits for it,
+            "drop" discards the chunk and counts its packets in dropped_packets.
+        compress: deflate each flushed chunk into `compressed_packets` packets (perfetto decompresses them on load).
+            Combine with async_flush to keep the compression off the calling threads.
+        compress_level: (compress only) zlib compression level, 1 (fastest) to 9 (smallest).
+        ring_buffer_size: flight-recorder mode.  Keep only the most recent packets, up to roughly this many bytes,
+            in memory and write nothing until dump() is called.  Not compatible with async_flush.
+        rotate_bytes, rotate_seconds: split the trace into segments (filename with .0, .1, ... inserted before the
+            extension), starting a new one when the current one would grow past rotate_bytes or is older than
+            rotate_seconds.  Each segment can be loaded on its own.
+        keep_segments: (rotation only) delete all but the most recent keep_segments segments.
+        shard: for traces written by several processes (e.g., a pid).  Each shard uses its own range of track uuids
+            and packet sequence ids, so that the shards' packets don't collide when their files are loaded together.
+        clock: what the timestamps are.  None (default): arbitrary nanoseconds, shown as they are.  "monotonic":
+            readings of time.perf_counter_ns() (CLOCK_MONOTONIC on Linux); the trace then starts with a clock
+            snapshot that maps them to the boottime and realtime clocks.
+        incremental_timestamps: encode each packet's timestamp as the delta to the previous one on its sequence,
+            which mostly takes 1-3 bytes instead of 9.  Timestamps that go backwards still work, but take more space.
+        mmap_output: write the file through a memory map, and flush every 100 packets (per thread) rather than every
+            10000, which the map makes cheap.  What was flushed survives the process being killed (SIGKILL, OOM);
+            repair_trace() (or `tg4perfetto repair`) then cuts the file back to what was written.
+        """
+        if engine not in _engines:
+            raise ValueError("Unknown trace engine {!r} (expected one of {})".format(engine, ", ".join(_engines)))
+        if backpressure not in ("block", "drop"):
+            raise ValueError("backpressure must be either 'block' or 'drop'")
+        if ring_buffer_size is not None and async_flush:
+            raise ValueError("ring_buffer_size can't be combined with async_flush")
+        rotate = rotate_bytes is not None or rotate_seconds is not None
+        if rotate and ring_buffer_size is not None:
+            raise ValueError("ring_buffer_size can't be combined with rotation")
+        if mmap_output and (rotate or ring_buffer_size is not None):
+            raise ValueError("mmap_output can't be combined with rotation or ring_buffer_size")
+        if keep_segments is not None and not rotate:
+            raise ValueError("keep_segments requires rotate_bytes or rotate_seconds")
+        if clock not in (None, "monotonic"):
+            raise ValueError("clock must be None or 'monotonic'")
+        self._uuids = itertools.count(1234567 + (shard << 32))
         self.flush_threshold = 10000
         self.list_max_size = 16
+        # per event; annotations stop once they have this many values or this many bytes of new strings
+        self.annotation_max_nodes = 256
+        self.annotation_max_bytes = 4096
+        # per sequence; once that many annotation string values are interned, the rest are written inline
+        self.max_interned_strings = 10000
+        self.dropped_packets = 0
+
+        self._engine = _engines[engine]()
+        self._filename = filename
+        self._clock = clock
+        self._clock_id = _BUILTIN_CLOCK_MONOTONIC if clock == "monotonic" else _BUILTIN_CLOCK_REALTIME
+        self._incremental_timestamps = incremental_timestamps
+        self._compress_level = compress_level if compress else None
+        self._ring = None
+        self._mmap_output = mmap_output
+        if rotate:
+            # through a weak reference, so that dropping the generator still flushes and closes it
+            ref = weakref.ref(self)
+            self.file = _RotatingFile(filename, rotate_bytes, rotate_seconds, keep_segments,
+                                      lambda: ref()._preamble(), lambda: ref()._postamble())
+        elif mmap_output:
+            self.file = _MmapFile(filename)
+            self.flush_threshold = 100
+        elif ring_buffer_size is None:
+            self.file = open(filename, "wb")
+        else:
+            # smaller chunks, so that the ring buffer holds many of them and evicts little at a time
+            self.flush_threshold = 1000
+            self._ring = _RingBuffer(ring_buffer_size)
+            self.file = None
+        self._closed = False
+        # Chunks that may be read without the ones before them (ring buffer, rotation) must not depend on
+        # incremental state from earlier chunks: the sequence restarts after every chunk.
+        self._self_contained_chunks = rotate or self._ring is not None
+
+        # Packet sequences other than the default one are created per thread (see _thread_sequence()).
+        # Each one has its own buffer and interning state, so threads never share a buffer; only the
+        # (rare) writes of a drained chunk to the file are serialized.
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # every live sequence (the default one, then one per thread, and the one of incremental counters)
+        self._sequences = []
+        # created by the first incremental counter (see _counter_sequence())
+        self._counter_seq = None
+        # sequence ids are 32 bits: 16 for the shard, 16 within it (1 and 2 are the header's and the default
+        # sequence's; the others go round, see _next_seq_id())
+        self._seq_base = (shard & 0xffff) << 16
+        self._seq_ids = itertools.cycle(range(3, 0x10000))
+
+        # Track registry: tracks shared by all threads, by key.  Per-thread tracks live in self._local.tracks.
+        self._shared_tracks = {}
+        self._track_lock = threading.Lock()
+        # The track descriptors that dumps and new segments re-declare, as uuid -> (method, args): every track
+        # declared so far, except those of threads that have finished (see _retire_tracks()).
+        self._descriptors = {}
+        # flight-recorder mode: (number of chunks written to the ring, uuids) of retired tracks, which are kept until
+        # the ring has evicted those chunks
+        self._retired = []
+        self._descriptor_lock = threading.Lock()
+
+        if self._ring is not None:
+            # chunks are serialized right away and compressed only when dumped
+            ring, serialize = self._ring, self._engine.serialize
+            self._write = lambda chunk: ring(serialize(chunk))
+        else:
+            self._write = functools.partial(_write_chunk, self.file, self._engine.serialize, self._compress_level)
+        if async_flush:
+            self._writer = _AsyncWriter(self._write, max_pending_flushes, backpressure == "block")
+        else:
+            self._writer = None
+
+        if rotate:
+            self.file.rotate()
+        elif self._ring is None:
+            self._submit(self._header(), True)
+
+        self._seq = self._engine(self, self._seq_base + 2)
+        self._packet_defaults(self._seq)
+        self._sequences.append(self._seq)
+
+    def _packet_defaults(self, seq, ts : int = None):
+        """ Start a sequence: its packet defaults, and with incremental timestamps, the time (by default, now) they count from """
+        if self._incremental_timestamps:
+            if ts is None:
+                ts = _now() if self._clock == "monotonic" else 0
+            seq.packet_defaults(1, _CLOCK_INCREMENTAL, (self._clock_id, ts))
+        else:
+            seq.packet_defaults(1, self._clock_id)
 
-        self.trace = pb2.Trace()
-        self.file = open(filename, "wb")
-
-        pkt = self.trace.packet.add()
-        pkt.trusted_packet_sequence_id = 1
-        clk = pkt.clock_snapshot.clocks.add()
-        clk.clock_id = 1
-        clk.timestamp = 0
-        clk = pkt.clock_snapshot.clocks.add()
-        clk.clock_id = 2 
-        clk.timestamp = 0
-        clk = pkt.clock_snapshot.clocks.add()
-        clk.clock_id = 3
-        clk.timestamp = 0
-        clk = pkt.clock_snapshot.clocks.add()
-        clk.clock_id = 4
-        clk.timestamp = 0
-        clk = pkt.clock_snapshot.clocks.add()
-        clk.clock_id = 5
-        clk.timestamp = 0
-        clk = pkt.clock_snapshot.clocks.add()
-        clk.clock_id = 6
-        clk.timestamp = 0
-        pkt.clock_snapshot.primary_trace_clock = pb2.BUILTIN_CLOCK_BOOTTIME
-    
-        pkt = self.trace.packet.add()
-        pkt.trusted_packet_sequence_id = 1
-        pkt.trace_config.buffers.add().size_kb = 1024
-        pkt.trace_config.data_sources.add().config.name = "track_event"
-    
-        pkt = self.trace.packet.add()
-        pkt.trusted_packet_sequence_id = 2
-        pkt.trace_packet_defaults.track_event_defaults.track_uuid=1
-        pkt.trace_packet_defaults.timestamp_clock_id = 1
-        pkt.sequence_flags = 1
-
+    def _header(self):
+        """ The first sequence: the clock snapshot and trace config that start every trace """
+        header = self._engine(self, self._seq_base + 1)
+        if self._clock is None:
+            header.clock_snapshot([(clock_id, 0) for clock_id in range(1, 7)], _BUILTIN_CLOCK_BOOTTIME)
+        else:
+            header.clock_snapshot(*_snapshot())
+        header.trace_config(1024, "track_event")
+        return header
+
+    def _tracks_chunk(self):
+        """ Every track declared so far, on a fresh sequence (serialized) """
+        tracks = self._engine(self, self._next_seq_id())
+        self._packet_defaults(tracks)
+        with self._descriptor_lock:
+            if self._retired:
+                self._drop_retired()
+            descriptors = list(self._descriptors.values())
+        for method, args in descriptors:
+            getattr(tracks, method)(*args)
+        return self._engine.serialize(tracks.drain())
+
+    def _preamble_chunks(self):
+        """ Serialized header, then every track declared so far """
+        return [self._engine.serialize(self._header().drain()), self._tracks_chunk()]
+
+    def _preamble(self):
+        """ Start of each rotated segment """
+        data = b"".join(self._preamble_chunks())
+        if self._compress_level is not None:
+            data = _compress_packets(data, self._compress_level)
+        return data
+
+    def _postamble(self):
+        """ End of each rotated segment: the tracks declared since it started may have gone to the next segment """
+        data = self._tracks_chunk()
+        if self._compress_level is not None:
+            data = _compress_packets(data, self._compress_level)
+        return data
+
+    @property
+    def interned_data(self):
+        return self._seq.interned_data
+
+    @property
+    def interned_source(self):
+        return self._seq.interned_source
+
+    def _submit(self, seq, block : bool = None):
+        """ Swap out the sequence's packets and write them (or hand them to the writer thread).
+
+        flush() and close() submit other threads' sequences too.  The sequence's lock keeps its thread from adding
+        a packet while it is drained, or before it has restarted.
+        """
+        with seq.lock:
+            num_packets = len(seq)
+            tracks = seq.tracks
+            chunk = seq.drain()
+            if self._writer is None:
+                with self._lock:
+                    self._write(chunk)
+            elif not self._writer.submit(chunk, block):
+                with self._lock:
+                    self.dropped_packets += num_packets
+                self._restart_sequence(seq, tracks)
+                return
+            if self._self_contained_chunks:
+                # this also keeps the interning tables from growing beyond what one chunk needs
+                self._restart_sequence(seq, ())
+
+    def _restart_sequence(self, seq, tracks):
+        """ Start a sequence over after its pending packets were lost: clear the incremental state and re-declare the lost tracks """
+        seq.reset()
+        # the sequence's packets to come are no earlier than its last one
+        self._packet_defaults(seq, seq.last_timestamp)
+        for method, args in tracks:
+            getattr(seq, method)(*args)
 
     def flush(self):
         """ Flush trace.  This creates a perfetto trace packet and writes to disk. """
-        if print_proto:
-            print(self.trace)
-        self.file.write(self.trace.SerializeToString())
-        self.file.flush()
-        self.trace = pb2.Trace()
+        if self._ring is not None:
+            # nothing goes to disk before dump(), which also picks up the pending packets
+            return
+        with self._lock:
+            sequences = list(self._sequences)
+        for seq in sequences:
+            if len(seq) > 0:
+                self._submit(seq, True)
+        if self._writer is not None:
+            self._writer.wait()
+
+    def close(self):
+        """ Flush the trace and close the file.  With async_flush, this waits for the writer thread to finish. """
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+        if self.file is not None:
+            self.file.close()
+
+    def dump(self, filename : str = None) -> str:
+        """ Write what the ring buffer holds (flight-recorder mode) as a self-contained trace.
+
+        filename defaults to the one the trace was created with.  The ring buffer is left as is, so dump()
+        can be called again later.  Returns the name of the file written.
+        """
+        if self._ring is None:
+            raise RuntimeError("dump() is only available with ring_buffer_size")
+        if filename is None:
+            filename = self._filename
+
+        # clock snapshot, trace config, then every track, so that events survive even
+        # if the chunk that declared their track was evicted
+        chunks = self._preamble_chunks()
+        with self._lock:
+            sequences = list(self._sequences)
+        chunks += self._ring.contents()
+        # packets not flushed yet; each pending buffer starts with its own packet defaults
+        chunks += [seq.peek() for seq in sequences]
+
+        data = b"".join(chunks)
+        if self._compress_level is not None:
+            data = _compress_packets(data, self._compress_level)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+    def _abandon(self):
+        """ Drop the trace without writing anything.  Used in a forked child, where the trace belongs to the parent. """
+        self._closed = True
+        self._writer = None
 
     def __del__(self):
-        self.flush()
-        self.file.close()
+        self.close()
+
+    def _next_seq_id(self):
+        """ A sequence id of the shard's range that no live sequence has.  Once the range has gone round, ids of
+        finished sequences (of threads that ended, or that re-declared the tracks for a segment or dump) come
+        again; every sequence starts by clearing the incremental state, so nothing carries over to the new one. """
+        # (called with self._lock held when a new segment starts)
+        live = {seq.seq_id for seq in list(self._sequences)}
+        for _ in range(0x10000 - 3):
+            seq_id = self._seq_base + next(self._seq_ids)
+            if seq_id not in live:
+                return seq_id
+        raise RuntimeError("all {} packet sequence ids of the shard are in use".format(0x10000 - 3))
+
+    def _thread_sequence(self):
+        """ Get the packet sequence owned by the calling thread, creating one if necessary """
+        try:
+            return self._local.seq
+        except AttributeError:
+            seq = self._local.seq = self._engine(self, self._next_seq_id())
+            self._packet_defaults(seq)
+            self._local.tracks = {}
+            # goes away with the thread
+            self._local.end = _ThreadEnd(self, seq, self._local.tracks)
+            with self._lock:
+                self._sequences.append(seq)
+            return seq
+
+    def _counter_sequence(self):
+        """ Get the packet sequence of incremental counters, creating it if necessary.  Perfetto adds up an
+        incremental counter's values per sequence, from where the sequence last cleared its incremental state, so
+        every thread's increments go to this one sequence. """
+        seq = self._counter_seq
+        if seq is None:
+            seq = self._engine(self, self._next_seq_id())
+            self._packet_defaults(seq)
+            with self._lock:
+                if self._counter_seq is None:
+                    self._counter_seq = seq
+                    self._sequences.append(seq)
+                seq = self._counter_seq
+        return seq
+
+    def _thread_track(self, key, parent_uuid, name):
+        """ Get the calling thread's own instance of a normal track (one uuid per (key, thread) pair).
+
+        Slices only nest properly within a thread, so threads never share a normal track.  The track
+        descriptor is emitted once, on first use.
+        """
+        try:
+            return self._local.tracks[key]
+        except AttributeError:
+            self._thread_sequence()
+        except KeyError:
+            pass
+        # tid isn't really used here
+        uuid = self._local.tracks[key] = self._tid_packet(0, parent_uuid, name, 0, self._thread_sequence())
+        return uuid
+
+    def _shared_track(self, key, parent_uuid, name, track_type, seq = None):
+        """ Get a track shared by all threads (e.g., a counter track).  The descriptor is emitted once, on first use,
+        on seq (by default, the calling thread's sequence). """
+        uuid = self._shared_tracks.get(key)
+        if uuid is None:
+            with self._track_lock:
+                uuid = self._shared_tracks.get(key)
+                if uuid is None:
+                    if seq is None:
+                        seq = self._thread_sequence()
+                    # note that TID here is a dummy value (not really used)
+                    uuid = self._tid_packet(2**32 + len(self._shared_tracks), parent_uuid, name, track_type, seq)
+                    self._shared_tracks[key] = uuid
+        return uuid
 
     def _pid_packet(self, pid, process_name : str, track_name : str = None):
         """ Create a group.  Each "group" comes with a default normal track (named track_name)."""
-        uuid = self.__uuid__
-        pkt = self.trace.packet.add()
-        pkt.timestamp = 0
-        pkt.track_descriptor.uuid = uuid
-        pkt.track_descriptor.process.pid = pid
-        pkt.track_descriptor.process.process_name = process_name
-        pkt.trusted_packet_sequence_id = 2
-        pkt.sequence_flags = 2
+        uuid = next(self._uuids)
         if track_name is None:
-            pkt.track_descriptor.name = process_name
-        else:
-            pkt.track_descriptor.name = track_name
+            track_name = process_name
+        self._seq.process_track(uuid, pid, process_name, track_name)
+        self._add_descriptor("process_track", (uuid, pid, process_name, track_name))
 
-        self.__uuid__ += 1
-        
         # funnily enough, declaring a process and a track at the same time will get rid of the default track
         # if there is no trace in the track.  Unfortunately this changes the process track's name to "Process XXX"
         # so it shouldn't be applicable.
@@ -88,225 +413,104 @@ class _BaseTraceGenerator:
         #pkt.track_descriptor.thread.tid = tid
         #pkt.track_descriptor.thread.thread_name = process_name
         #self.__pid__ += 1
-    
-        self._flush_if_necessary()
-
-        return uuid
-
-    def _flush_if_necessary(self):
-        if len(self.trace.packet) > self.flush_threshold:
-            self.flush()
-
-    def _tid_packet(self, my_pid, parent_uuid, process_name, track_type):
-        pkt = self.trace.packet.add()
 
-        pkt.timestamp = 0
-        pkt.trusted_packet_sequence_id = 2
-        pkt.sequence_flags = 2
-        uuid = self.__uuid__
-
-        pkt.track_descriptor.uuid = uuid
-        self.__uuid__ += 1
-        pkt.track_descriptor.name = process_name
-
-        if parent_uuid != 0:
-            pkt.track_descriptor.parent_uuid = parent_uuid
-    
-        if track_type == 1:
-            pkt.track_descriptor.counter.categories.append("dummy")
-        self._flush_if_necessary()
+        self._flush_descriptor()
 
         return uuid
-    
-    def _get_iid_for(self, pkt, name):
-        if name in self.interned_data:
-            return self.interned_data[name]
-    
-        ev = pkt.interned_data.event_names.add()
-        ev.name = name
-        ev.iid = len(self.interned_data) + 1
-    
-        self.interned_data[name] = ev.iid
-        return ev.iid
-
-    def _add_debug_annotation_old(self, d, kwargs):
-        for k,v in kwargs.items():
-            assert(isinstance(k, str))
-
-            x = d.add()
-            x.name = k
-            def set_single(x, v):
-                if isinstance(v, str):
-                    x.string_value = v
-                elif isinstance(v, bool):
-                    x.bool_value = v
-                elif isinstance(v, int):
-                    x.int_value = v
-                elif isinstance(v, float):
-                    x.double_value = v
-                elif isinstance(v, dict):
-                    # Try the older, deprecated version first.  If this doesn't work, use the code below (newer version)
-                    def set_nested_dict(x, vv):
-                        for k,v in vv.items():
-                            x.dict_keys.append(k)
-                            vt = x.dict_values.add()
-                            set_single(vt, v)
-                    set_nested_dict(x, v)
-                    x.nested_type = pb2.DebugAnnotation.NestedValue.NestedType.DICT
-                elif isinstance(v, list):
-                    def set_nested_list(x, vv):
-                        for i,v in zip(range(len(vv)), vv):
-                            if i == self.list_max_size:
-                                vt = x.array_values.add()
-                                set_single(vt, "... ({} more items)".format(len(vv) - i))
-                                break
-                            else:
-                                vt = x.array_values.add()
-                                set_single(vt, v)
-                    set_nested_list(x, v)
-                    x.nested_type = pb2.DebugAnnotation.NestedValue.NestedType.ARRAY
-                else:
-                    assert False
-
-            if isinstance(v, dict) or isinstance(v, list):
-                set_single(x.nested_value, v)
-            else:
-                set_single(x, v)
-
-    def _add_debug_annotation_new(self, d, kwargs):
-        cnt = 0
-        for k,v in kwargs.items():
-            cnt += 1
-            x = d.add()
-            if cnt == self.list_max_size:
-                x.name = "..."
-                x.string_value = "({} more items)".format(len(kwargs) - cnt)
-                break
-
-            x.name = str(k)
-            def set_single(x, v):
-                if isinstance(v, str):
-                    x.string_value = v
-                elif isinstance(v, bool):
-                    x.bool_value = v
-                elif isinstance(v, int):
-                    x.int_value = v
-                elif isinstance(v, float):
-                    x.double_value = v
-                elif isinstance(v, dict):
-                    if len(v) == 0:
-                        x.string_value = "[empty]"
-                    else:
-                        self._add_debug_annotation_new(x.dict_entries, v)
-                elif isinstance(v, list) or isinstance(v, tuple):
-                    if len(v) == 0:
-                        x.string_value = "[empty]"
-                    else:
-                        for i,vv in zip(range(len(v)), v):
-                            if i == self.list_max_size:
-                                set_single(x.array_values.add(), "... ({} more items)".format(len(v) - i))
-                                break
-                            # for some reason, perfetto ui crashes on nested lists.
-                            # add a dummy dictionary here
-                            if isinstance(vv, list) or isinstance(vv, tuple):
-                                vv = {"array" : vv}
-                            set_single(x.array_values.add(), vv)
-                else:
-                    x.string_value = str(type(v))
-            set_single(x, v)
-
-    def _add_debug_annotation(self, d, kwargs):
-        return self._add_debug_annotation_new(d, kwargs)
-
-        # some older perfettos (circa early 2021) don't support the new debug annotation packet type
-        # in that case, enable this code below instead of the one above:
-
-        # return self._add_debug_annotation_old(d, kwargs)
-
-        # end code
-     
-    def _track_instant(self, uuid, ts, annotation, kwargs, flow, caller = None):
-        pkt = self.trace.packet.add()
 
-        pkt.timestamp = ts
-        pkt.trusted_packet_sequence_id = 2
-        pkt.sequence_flags = 2
-        pkt.track_event.category_iids.append(1)
-        pkt.track_event.type = pb2.TrackEvent.TYPE_INSTANT
-        pkt.track_event.track_uuid = uuid
-        pkt.track_event.name = annotation
+    def _thread_packet(self, pid, tid, thread_name, seq):
+        """ Declare an actual thread of process pid, so that its stack samples are labeled in the UI """
+        uuid = next(self._uuids)
+        seq.thread_track(uuid, pid, tid, thread_name)
+        self._add_descriptor("thread_track", (uuid, pid, tid, thread_name))
+        self._flush_descriptor(seq)
+        return uuid
 
-        if kwargs is not None:
-            self._add_debug_annotation(pkt.track_event.debug_annotations, kwargs)
+    def _add_descriptor(self, method, args):
+        # args start with the track's uuid
+        with self._descriptor_lock:
+            self._descriptors[args[0]] = (method, args)
+
+    def _retire_tracks(self, uuids):
+        """ Stop re-declaring tracks that won't have any more events, e.g. those of a thread that has finished, so
+        that the preambles of new segments and dumps don't grow with every thread that ever ran.  The events on the
+        tracks must have been submitted already.  In flight-recorder mode, the descriptors are kept until the ring
+        buffer has evicted every chunk written so far, which may hold those events. """
+        if self._writer is not None:
+            # a new segment may start while the writer writes those events
+            self._writer.wait()
+        with self._descriptor_lock:
+            if self._ring is None:
+                for uuid in uuids:
+                    self._descriptors.pop(uuid, None)
+            else:
+                self._retired.append((self._ring.num_chunks, uuids))
+                self._drop_retired()
+
+    def _drop_retired(self):
+        """ (flight-recorder mode, with _descriptor_lock held) Drop the retired descriptors the ring no longer needs """
+        evicted = self._ring.dropped_chunks
+        while self._retired and self._retired[0][0] <= evicted:
+            for uuid in self._retired.pop(0)[1]:
+                self._descriptors.pop(uuid, None)
+
+    def _thread_finished(self, seq, uuids):
+        """ A thread that traced has finished: write out what is left on its sequence, and retire its tracks """
+        if self._closed:
+            return
+        if len(seq) > 0:
+            self._submit(seq)
+        with self._lock:
+            self._sequences.remove(seq)
+        self._retire_tracks(uuids)
+
+    def _flush_if_necessary(self, seq = None):
+        """ Write out the sequence's packets once it holds more than flush_threshold of them """
+        if seq is None:
+            seq = self._seq
+        if len(seq) > self.flush_threshold:
+            self._submit(seq)
+
+    def _flush_descriptor(self, seq = None):
+        """ After a track descriptor: with mmap_output, write it out right away, so that the events of a process
+        that gets killed aren't left on tracks that were never declared """
+        if seq is None:
+            seq = self._seq
+        if self._mmap_output:
+            self._submit(seq)
+        else:
+            self._flush_if_necessary(seq)
 
-        for x in flow:
-            pkt.track_event.flow_ids.append(x)
+    def _tid_packet(self, my_pid, parent_uuid, process_name, track_type, seq = None):
+        if seq is None:
+            seq = self._seq
+        uuid = next(self._uuids)
+        seq.child_track(uuid, parent_uuid, process_name, track_type)
+        self._add_descriptor("child_track", (uuid, parent_uuid, process_name, track_type))
+        self._flush_descriptor(seq)
 
-        if caller is not None:
-            file,line,name = caller
-            iid = self._get_source_iid_for(pkt, file, name, line)
-            pkt.track_event.source_location_iid = iid
+        return uuid
 
+    def _track_instant(self, uuid, ts, annotation, kwargs, flow, caller = None):
+        self._seq.track_instant(uuid, ts, annotation, kwargs, flow, caller)
         self._flush_if_necessary()
-                   
-
-    def _get_source_iid_for(self, pkt, file, name, line):
-        if (file, name, line) in self.interned_source:
-            return self.interned_source[(file, name, line)]
-        ev = pkt.interned_data.source_locations.add()
-        ev.file_name = file
-        ev.function_name = name
-        ev.line_number = line
-        ev.iid = len(self.interned_source) + 1
-        self.interned_source[(file, name, line)] = ev.iid
-
-        return ev.iid
 
     def _track_open(self, uuid, ts, annotation, kwargs, flow, caller = None):
-        pkt = self.trace.packet.add()
-
-        pkt.timestamp = ts
-        pkt.track_event.name_iid = self._get_iid_for(pkt, annotation)
-        pkt.trusted_packet_sequence_id = 2
-        pkt.sequence_flags = 2
-        pkt.track_event.category_iids.append(1)
-        pkt.track_event.type = pb2.TrackEvent.TYPE_SLICE_BEGIN
-        pkt.track_event.track_uuid = uuid
-
-        if kwargs is not None:
-            self._add_debug_annotation(pkt.track_event.debug_annotations, kwargs)
-        for x in flow:
-            pkt.track_event.flow_ids.append(x)
-
-        if caller is not None:
-            file,line,name = caller
-            iid = self._get_source_iid_for(pkt, file, name, line)
-            pkt.track_event.source_location_iid = iid
-
+        self._seq.track_open(uuid, ts, annotation, kwargs, flow, caller)
         self._flush_if_necessary()
-        
-    def _track_close(self, uuid, ts, flow):
-        pkt = self.trace.packet.add()
-
-        pkt.trusted_packet_sequence_id = 2
-        pkt.sequence_flags = 2
-        pkt.timestamp = ts
-        pkt.track_event.track_uuid = uuid
-        pkt.track_event.type = pb2.TrackEvent.TYPE_SLICE_END
-        for x in flow:
-            pkt.track_event.flow_ids.append(x)
 
+    def _track_close(self, uuid, ts, flow):
+        self._seq.track_close(uuid, ts, flow)
         self._flush_if_necessary()
-    
-    def _track_count(self, uuid, ts, value):
-        pkt = self.trace.packet.add()
 
-        pkt.timestamp = ts
-        pkt.trusted_packet_sequence_id = 2
-        pkt.sequence_flags = 2
-        pkt.track_event.type = pb2.TrackEvent.TYPE_COUNTER
-        pkt.track_event.track_uuid = uuid
-        pkt.track_event.counter_value = value
+    def _track_count(self, uuid, ts, value):
+        self._seq.track_count(uuid, ts, value)
+        self._flush_if_necessary()
 
+    def _track_count_many(self, uuid, ts, values):
+        self._seq.track_count_many(uuid, ts, values)
         self._flush_if_necessary()
 
+    def _track_slices_many(self, uuid, starts, ends, names):
+        self._seq.track_slices_many(uuid, starts, ends, names)
+        self._flush_if_necessary()
@@ -0,0 +1,191 @@
+import itertools
+import zlib
+
+from . import perfetto_trace_slim_pb2 as pb2
+from ._reader import _packet_runs, _SEQ_INCREMENTAL_STATE_CLEARED
+
+# Merging traces that were written separately (one per process or host) into one.
+#
+# Each file numbers its tracks, packet sequences and flows on its own, so the merged trace gives them new numbers:
+# tracks and sequences get fresh ones in order of appearance (there are few of them), and flow IDs keep their
+# value in the low 56 bits with the file's index above it (there may be millions of them).  Interned data is
+# scoped to its packet sequence, so with the sequences apart, iids can stay as they are.
+
+_FLOW_ID_BITS = 56
+_FLOW_ID_MASK = (1 << _FLOW_ID_BITS) - 1
+
+class _InputFile:
+    """ How one input file's numbers map to the merged trace's """
+    def __init__(self, index : int, offset : int, uuids, sequence_ids, remap_flows : bool):
+        self.index = index
+        self.offset = offset
+        self._new_uuids = uuids
+        self._new_sequence_ids = sequence_ids
+        self.flow_base = (index + 1) << _FLOW_ID_BITS if remap_flows else None
+        # old uuid -> new uuid
+        self.uuids = {}
+        # old sequence id -> new sequence id
+        self.sequences = {}
+        # old sequence id -> (default clock id, ids of its incremental clocks), to tell which timestamps to shift
+        self.clocks = {}
+
+    def uuid(self, uuid):
+        if uuid == 0:
+            return 0
+        new = self.uuids.get(uuid)
+        if new is None:
+            new = self.uuids[uuid] = next(self._new_uuids)
+        return new
+
+    def sequence(self, seq_id):
+        new = self.sequences.get(seq_id)
+        if new is None:
+            new = self.sequences[seq_id] = next(self._new_sequence_ids)
+        return new
+
+    def flow(self, flow_id):
+        return self.flow_base | (flow_id & _FLOW_ID_MASK)
+
+    def _remap_uuids(self, values):
+        if values:
+            values[:] = [self.uuid(v) for v in values]
+
+    def _remap_flows(self, values):
+        if self.flow_base is not None:
+            values[:] = [self.flow(v) for v in values]
+
+    def remap(self, packet):
+        """ Renumber a packet in place (and shift its timestamps by the file's clock offset) """
+        seq_id = packet.trusted_packet_sequence_id
+        if seq_id:
+            packet.trusted_packet_sequence_id = self.sequences.get(seq_id) or self.sequence(seq_id)
+
+        if packet.HasField("track_event"):
+            ev = packet.track_event
+            uuid = ev.track_uuid
+            if uuid:
+                ev.track_uuid = self.uuids.get(uuid) or self.uuid(uuid)
+            if ev.flow_ids:
+                self._remap_flows(ev.flow_ids)
+            if ev.terminating_flow_ids:
+                self._remap_flows(ev.terminating_flow_ids)
+            if ev.extra_counter_track_uuids:
+                self._remap_uuids(ev.extra_counter_track_uuids)
+            if ev.extra_double_counter_track_uuids:
+                self._remap_uuids(ev.extra_double_counter_track_uuids)
+        else:
+            # packets that declare things: rare
+            self._remap_state(packet, seq_id)
+
+        if self.offset and packet.HasField("timestamp"):
+            default_clock, incremental = self.clocks.get(seq_id, (None, frozenset()))
+            clock = packet.timestamp_clock_id if packet.HasField("timestamp_clock_id") else default_clock
+            # deltas stay as they are: they count from the (shifted) clock snapshot
+            if clock not in incremental:
+                packet.timestamp = self._shift(packet.timestamp)
+
+    def _remap_state(self, packet, seq_id):
+        if packet.sequence_flags & _SEQ_INCREMENTAL_STATE_CLEARED:
+            self.clocks.pop(seq_id, None)
+        if packet.HasField("clock_snapshot"):
+            default_clock, incremental = self.clocks.get(seq_id, (None, frozenset()))
+            for clock in packet.clock_snapshot.clocks:
+                if clock.is_incremental:
+                    incremental = incremental | {clock.clock_id}
+                elif self.offset:
+                    clock.timestamp = self._shift(clock.timestamp)
+            self.clocks[seq_id] = (default_clock, incremental)
+        if packet.HasField("trace_packet_defaults"):
+            defaults = packet.trace_packet_defaults
+            if defaults.HasField("timestamp_clock_id"):
+                self.clocks[seq_id] = (defaults.timestamp_clock_id, self.clocks.get(seq_id, (None, frozenset()))[1])
+            event_defaults = defaults.track_event_defaults
+            if event_defaults.HasField("track_uuid"):
+                event_defaults.track_uuid = self.uuid(event_defaults.track_uuid)
+            self._remap_uuids(event_defaults.extra_counter_track_uuids)
+            self._remap_uuids(event_defaults.extra_double_counter_track_uuids)
+        if packet.HasField("track_descriptor"):
+            desc = packet.track_descriptor
+            desc.uuid = self.uuid(desc.uuid)
+            if desc.parent_uuid:
+                desc.parent_uuid = self.uuid(desc.parent_uuid)
+
+    def _shift(self, ts):
+        ts += self.offset
+        if ts < 0:
+            raise ValueError("the clock offset of input {} moves timestamps below 0".format(self.index))
+        return ts
+
+def _remap_trace(mapping, trace) -> int:
+    """ Remap the packets of a `Trace` in place; returns how many there are """
+    dropped = []
+    for i, packet in enumerate(trace.packet):
+        if packet.HasField("compressed_packets"):
+            try:
+                inner = pb2.Trace.FromString(zlib.decompress(packet.compressed_packets))
+            except zlib.error as e:
+                raise ValueError("bad compressed_packets: {}".format(e))
+            _remap_trace(mapping, inner)
+            packet.compressed_packets = zlib.compress(inner.SerializeToString())
+            continue
+        if mapping.index > 0 and packet.HasField("trace_config"):
+            # only the first input's trace config is kept, whatever sequence it is on
+            packet.ClearField("trace_config")
+            if [field.name for field, _ in packet.ListFields()] in ([], ["trusted_packet_sequence_id"]):
+                dropped.append(i)
+                continue
+        if not packet.trusted_packet_sequence_id and not packet.ListFields():
+            # the header of an mmap_output file (a packet of nothing but an unknown field) only belongs to its own file
+            dropped.append(i)
+            continue
+        mapping.remap(packet)
+    for i in reversed(dropped):
+        del trace.packet[i]
+    return len(trace.packet)
+
+def merge_traces(inputs, output : str, clock_offsets = None, remap_flows : bool = True) -> dict:
+    """ Merge trace files (e.g., one per process or host) into one, reading them one packet at a time.
+
+    Track uuids, packet sequence ids and flow IDs are renumbered so that the files' don't collide.
+    clock_offsets: nanoseconds to add to each input's timestamps (a list, one per input, or a dict of input -> offset),
+        e.g. to line up hosts whose clocks differ.
+    remap_flows: whether to renumber flow IDs.  Traces from open() in processes forked from one another already
+        have distinct flow IDs, with flows between the processes; pass False to keep those flows.
+    Only the first input's trace config is kept, and compressed packets stay compressed.
+    Returns {"inputs": ..., "packets": ..., "errors": [...]}.
+
+    Every packet goes through the protobuf runtime (parsed, renumbered, serialized again), which limits merging to
+    a few MB of input per second, whatever the disk.
+    """
+    inputs = list(inputs)
+    if clock_offsets is None:
+        offsets = [0] * len(inputs)
+    elif isinstance(clock_offsets, dict):
+        offsets = [clock_offsets.get(name, 0) for name in inputs]
+    else:
+        offsets = list(clock_offsets)
+        if len(offsets) != len(inputs):
+            raise ValueError("clock_offsets must have one offset per input")
+    uuids = itertools.count(1)
+    sequence_ids = itertools.count(1)
+    errors = []
+    num_packets = 0
+
+    with open(output, "wb") as out:
+        for index, (name, offset) in enumerate(zip(inputs, offsets)):
+            mapping = _InputFile(index, int(offset), uuids, sequence_ids, remap_flows)
+            file_errors = []
+            with open(name, "rb") as f:
+                # a run of packets at a time: decoding and encoding whole runs keeps the per-packet work down
+                for run in _packet_runs(f, file_errors):
+                    trace = pb2.Trace.FromString(run)
+                    try:
+                        num_packets += _remap_trace(mapping, trace)
+                    except ValueError as e:
+                        if "compressed_packets" not in str(e):
+                            raise
+                        file_errors.append(str(e))
+                        continue
+                    out.write(trace.SerializeToString())
+            errors += ["{}: {}".format(name, e) for e in file_errors]
+    return {"inputs": len(inputs), "packets": num_packets, "errors": errors}
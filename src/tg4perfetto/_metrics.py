@@ -0,0 +1,135 @@
+import gc
+import os
+import threading
+import time
+
+from ._clock import _now
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class _MetricsCollector:
+    """ Process metrics as counter tracks under the process's group: a background thread samples CPU usage, RSS,
+    thread count, page faults and context switches `rate` times per second, from /proc/self/stat and getrusage()
+    (getrusage() alone where there's no /proc).  Only values that changed are written.
+
+    With gc_track (a function that returns the calling thread's track uuid), every garbage collection is also
+    recorded as a "gc" slice on the thread that triggered it, with its generation and the number of objects
+    collected.
+    """
+    def __init__(self, tracefile, parent_uuid, rate : float = None, gc_track = None):
+        if rate is not None and rate <= 0:
+            raise ValueError("metrics rate must be positive")
+        self._tracefile = tracefile
+        self._parent_uuid = parent_uuid
+        self._interval = None if rate is None else 1.0 / rate
+        self._gc_track = gc_track
+        # name -> last value written
+        self._last = {}
+        self._stop = threading.Event()
+        self._thread = None
+        if rate is not None:
+            self._thread = threading.Thread(target=self._run, name="tg4perfetto-metrics", daemon=True)
+        self._gc_start = threading.local()
+        self._stat_path = "/proc/self/stat" if os.path.exists("/proc/self/stat") else None
+        self._clock_ticks = os.sysconf("SC_CLK_TCK") if self._stat_path is not None else None
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if self._stat_path is not None else None
+
+    def start(self):
+        if self._thread is not None:
+            self._thread.start()
+        if self._gc_track is not None:
+            gc.callbacks.append(self._gc_callback)
+
+    def stop(self):
+        """ Stop collecting and wait for the collector thread to exit """
+        self._abandon()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _abandon(self):
+        """ Stop collecting, without waiting (in a forked child, where the thread doesn't exist) """
+        self._stop.set()
+        if self._gc_track is not None and self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+
+    def _read(self) -> dict:
+        """ CPU times (s) and the other metrics, as of now """
+        values = {}
+        if self._stat_path is not None:
+            with open(self._stat_path, "rb") as f:
+                stat = f.read()
+            # the command name (in parentheses) may contain spaces
+            fields = stat[stat.rindex(b")") + 2:].split()
+            values["minor_faults"] = int(fields[7])
+            values["major_faults"] = int(fields[9])
+            values["cpu_user"] = int(fields[11]) / self._clock_ticks
+            values["cpu_system"] = int(fields[12]) / self._clock_ticks
+            values["threads"] = int(fields[17])
+            values["rss_bytes"] = int(fields[21]) * self._page_size
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            values["voluntary_context_switches"] = usage.ru_nvcsw
+            values["involuntary_context_switches"] = usage.ru_nivcsw
+            if self._stat_path is None:
+                values["minor_faults"] = usage.ru_minflt
+                values["major_faults"] = usage.ru_majflt
+                values["cpu_user"] = usage.ru_utime
+                values["cpu_system"] = usage.ru_stime
+                values["threads"] = threading.active_count()
+        return values
+
+    def _emit(self, seq, ts, name, value):
+        if self._last.get(name) == value:
+            return
+        self._last[name] = value
+        uuid = self._tracefile._shared_track(("metrics", name), self._parent_uuid, name, 1)
+        seq.track_count(uuid, ts, value)
+
+    def _run(self):
+        tracefile = self._tracefile
+        seq = tracefile._thread_sequence()
+        prev = None
+        next_time = time.perf_counter()
+        while not self._stop.is_set():
+            wall = time.perf_counter()
+            values = self._read()
+            ts = _now()
+            if prev is not None and wall > prev[0]:
+                elapsed = wall - prev[0]
+                for kind in ("cpu_user", "cpu_system"):
+                    if kind in values:
+                        # of one core; above 100 when several threads run at once
+                        self._emit(seq, ts, kind + "_percent", round((values[kind] - prev[1][kind]) / elapsed * 100, 1))
+            prev = (wall, values)
+            for name, value in values.items():
+                if not name.startswith("cpu_"):
+                    self._emit(seq, ts, name, value)
+            tracefile._flush_if_necessary(seq)
+
+            # keep to the schedule, but don't try to catch up on samples missed while the process was busy
+            next_time += self._interval
+            delay = next_time - time.perf_counter()
+            if delay < 0:
+                next_time -= delay
+                delay = 0
+            self._stop.wait(delay)
+
+    def _gc_callback(self, phase, info):
+        if phase == "start":
+            self._gc_start.ts = _now()
+            return
+        start = getattr(self._gc_start, "ts", None)
+        if start is None or self._stop.is_set():
+            return
+        self._gc_start.ts = None
+        end = _now()
+        tracefile = self._tracefile
+        seq = tracefile._thread_sequence()
+        uuid = self._gc_track()
+        seq.track_open(uuid, start, "gc", {"generation": info["generation"], "collected": info["collected"],
+                                           "uncollectable": info["uncollectable"]}, [])
+        seq.track_close(uuid, end, [])
+        tracefile._flush_if_necessary(seq)
@@ -1,30 +1,148 @@
-from ._core import _BaseTraceGenerator
+from ._sampling import sampling, _samplings
+from ._clock import _now
 
-import typing
+import atexit
+import contextvars
 import os
+import signal
 import sys
 import functools
+import itertools
 import threading
-import time
+import weakref
 from threading import local
 
-_counter_tracks = {}
+# the trace events go to; None when no trace is open or recording is paused (see disable()), which every event
+# path checks first
 _tracefile = None
-_tlock = threading.Lock()
+# disable() was called, or TG4PERFETTO_DISABLED is set (see _disabled_by_environment())
+_paused = False
+# Events are written to the calling thread's own packet sequence, so the event paths take no shared lock.
 _master_uuid = None
-_flow_id = 1
+# next() on an itertools.count is atomic, so flow IDs can be allocated without locking
+_flow_ids = itertools.count(1)
 _all_tracks = []
 _tls = local()
-
-def _create_counter_track_if_necessary(name):
-    global _master_uuid, _counter_tracks, _tracefile
-    if name not in _counter_tracks:
-        # note that TID here is a dummy value (not really used)
-        uuid = _tracefile._tid_packet(2**32 + len(_counter_tracks), _master_uuid, name, 1)
-        _counter_tracks[name] = uuid
-    return _counter_tracks[name]
+# the trace opened by open(), if any (see _after_fork_in_child())
+_session = None
+# every count object, whose locks have to be replaced in a forked child
+_counts = weakref.WeakSet()
+# the track set by use_track() in the current context (which follows asyncio tasks across awaits)
+_current_track = contextvars.ContextVar("tg4perfetto_current_track", default=None)
+# open(task_tracks=True): asyncio tasks trace to tracks of their own
+_task_tracks = False
+# asyncio task -> its track (see _task_track())
+_task_lanes = weakref.WeakKeyDictionary()
+# asyncio task -> flow ID from where task_factory() created it, for the task's first event
+_task_flows = weakref.WeakKeyDictionary()
+# inspect.CO_COROUTINE, without importing inspect
+_CO_COROUTINE = 0x80
+# the decision of the enclosing head-sampled slice in the current context, if any (see sampling(head=True))
+_head_decision = contextvars.ContextVar("tg4perfetto_head_decision", default=None)
+# whether any sampling(head=True) is in use, so that events look up _head_decision only then
+_head_sampling = False
+# name -> count of the events a rate limiter dropped
+_dropped_counts = {}
+
+def _create_counter_track_if_necessary(tracefile, name, track_type = 1):
+    global _master_uuid
+    # incremental counters are declared on their own sequence, ahead of their values
+    seq = tracefile._counter_sequence() if track_type == 3 else None
+    return tracefile._shared_track(("count", name, track_type), _master_uuid, name, track_type, seq)
+
+def _next_flow_ids(num_flow_ids):
+    return [next(_flow_ids) for _ in range(num_flow_ids)]
+
+# Source locations, as the (file, line, name) tuples the sequences intern, by (id(code), line) or id(code).
+# Handing the sequences the same tuple object every time keeps their interning lookups cheap.  Code objects
+# are keyed by id() because hashing one hashes its whole contents; _source_codes keeps them (and their ids) alive.
+_source_locations = {}
+_source_codes = []
+
+def _source_location(frame, source):
+    """ Source location of frame: source is "line" (the current line) or "function" (the function's first line) """
+    code = frame.f_code
+    if source == "line":
+        key = (id(code), frame.f_lineno)
+    else:
+        key = id(code)
+    loc = _source_locations.get(key)
+    if loc is None:
+        _source_codes.append(code)
+        loc = _source_locations[key] = (code.co_filename, frame.f_lineno if source == "line" else code.co_firstlineno, code.co_name)
+    return loc
+
+def _function_location(code):
+    loc = _source_locations.get(id(code))
+    if loc is None:
+        _source_codes.append(code)
+        loc = _source_locations[id(code)] = (code.co_filename, code.co_firstlineno, code.co_name)
+    return loc
+
+def _sampled(policy, name, counter_name):
+    """ Whether to record an event named name; policy is a sampling, or None """
+    if _head_sampling:
+        decision = _head_decision.get()
+        if decision is not None:
+            return decision
+    if policy is None:
+        return True
+    keep = policy._sampled(name)
+    if keep and policy.max_rate is not None:
+        keep = policy._admit()
+        if keep and policy.dropped != policy._reported:
+            dropped = policy._take_dropped()
+            if dropped is not None:
+                counter_name = "{} dropped".format(policy.name or counter_name)
+                c = _dropped_counts.get(counter_name)
+                if c is None:
+                    c = _dropped_counts.setdefault(counter_name, count(counter_name))
+                c.count(dropped)
+    return keep
+
+def _disabled_by_environment():
+    """ TG4PERFETTO_DISABLED=1 in the environment: the decorators leave functions undecorated, and recording starts
+    paused.  For instrumentation that ships in place: a wrapper that checks whether to record still costs a call """
+    return os.environ.get("TG4PERFETTO_DISABLED", "") not in ("", "0")
+
+def _undecorated(x):
+    """ What trace_func(x) returns while _disabled_by_environment() """
+    if callable(x):
+        return x
+    return lambda func: func
+
+def _use_sampling(policy):
+    global _head_sampling
+    if policy.head:
+        _head_sampling = True
+
+def _current_task():
+    """ The running asyncio task, or None (asyncio isn't imported just to find out) """
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return None
+    loop = asyncio._get_running_loop()
+    if loop is None:
+        return None
+    return asyncio.current_task(loop)
+
+def _take_task_flow():
+    """ Incoming flow IDs for the running task's first event (see task_factory()) """
+    task = _current_task()
+    if task is None:
+        return []
+    flow_id = _task_flows.pop(task, None)
+    return [] if flow_id is None else [flow_id]
+
+def _is_coroutine_function(func):
+    return bool(getattr(getattr(func, "__code__", None), "co_flags", 0) & _CO_COROUTINE)
 
 class _trace:
+    # where the slice was opened from: "line", "function" or None (see track)
+    _source = "line"
+    # the decision that slices and instants nested inside this one follow (see sampling(head=True)), if any
+    _head = None
+
     def __init__(self, uuid, params, *kargs, **kwargs):
         self._params = params
         self._kargs = kargs
@@ -37,21 +155,32 @@ class _trace:
         if _tracefile is not None:
             if isinstance(caller, tuple):
                 self._caller = caller
-            elif isinstance(caller, typing.Callable):
-                self._caller = (caller.__code__.co_filename, caller.__code__.co_firstlineno, caller.__code__.co_name)
+            elif self._source is not None and callable(caller):
+                self._caller = _function_location(caller.__code__)
         return self
 
     def __enter__(self):
-        global _tracefile,_tlock
+        return self._enter(2)
 
-        if _tracefile is not None:
-            if self._caller is None:
-                import inspect
-                frame = inspect.currentframe().f_back
-                self._caller = frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name
+    async def __aenter__(self):
+        return self._enter(2)
+
+    def _enter(self, depth):
+        """ Open the slice; depth is how far up the stack the `with` statement is """
+        global _tracefile
+
+        if self._head is not None:
+            self._head_token = _head_decision.set(self._head)
+        tracefile = _tracefile
+        if tracefile is not None:
+            if self._caller is None and self._source is not None:
+                self._caller = _source_location(sys._getframe(depth), self._source)
+            if _task_flows:
+                self._incoming_flow_ids = self._incoming_flow_ids + _take_task_flow()
             if self._uuid is not None:
-                with _tlock:
-                    _tracefile._track_open(self._uuid, time.time_ns(), self._params, {"kargs":self._kargs, "kwargs":self._kwargs}, self._incoming_flow_ids, self._caller)
+                seq = tracefile._thread_sequence()
+                seq.track_open(self._uuid, _now(), self._params, {"kargs":self._kargs, "kwargs":self._kwargs}, self._incoming_flow_ids, self._caller)
+                tracefile._flush_if_necessary(seq)
         try:
             return self._outgoing_flow_ids
         finally:
@@ -62,98 +191,322 @@ class _trace:
         return self
 
     def get_outgoing_flow_ids(self, num_outgoing_flow_ids):
-        global _flow_id, _tlock
-        with _tlock:
-            self._outgoing_flow_ids = [x for x in range(_flow_id, _flow_id + num_outgoing_flow_ids)]
-            _flow_id += num_outgoing_flow_ids
+        self._outgoing_flow_ids = _next_flow_ids(num_outgoing_flow_ids)
 
         return self
 
     def __exit__(self, type, value, traceback):
-        global _flow_id, _tlock
-        if _tracefile is not None:
+        tracefile = _tracefile
+        if tracefile is not None:
             if self._uuid is not None:
-                with _tlock:
-                    _tracefile._track_close(self._uuid, time.time_ns(), self._outgoing_flow_ids)
+                seq = tracefile._thread_sequence()
+                seq.track_close(self._uuid, _now(), self._outgoing_flow_ids)
+                tracefile._flush_if_necessary(seq)
+        if self._head is not None:
+            _head_decision.reset(self._head_token)
         self._flow_ids = None
 
+    async def __aexit__(self, type, value, traceback):
+        self.__exit__(type, value, traceback)
+
+class _NullTrace:
+    """ Stands in for the slices that aren't recorded (no trace open, or sampled out): one shared instance,
+    whose methods do nothing """
+    __slots__ = ()
+
+    def set_caller(self, caller):
+        return self
+
+    def set_incoming_flow_ids(self, incoming_flow_ids):
+        return self
+
+    def get_outgoing_flow_ids(self, num_outgoing_flow_ids):
+        # the flow IDs are handed out all the same, which takes a scope of its own
+        return _trace(None, None).get_outgoing_flow_ids(num_outgoing_flow_ids)
+
+    def __enter__(self):
+        return ()
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    async def __aenter__(self):
+        return ()
+
+    async def __aexit__(self, type, value, traceback):
+        pass
+
+_NULL_TRACE = _NullTrace()
 
 class track:
-    def __init__(self, name):
+    def __init__(self, name, source : str = "line", sampling : sampling = None):
+        """ A track of slices and instants.
+
+        source: how events record where they come from: "line" (file and line), "function" (only the function,
+            which interns fewer locations), or None (no source locations).
+        sampling: which of the track's events to record (see tg4perfetto.sampling); by default, all of them.
+        """
+        if source not in ("line", "function", None):
+            raise ValueError("source must be 'line', 'function' or None")
         self._name = name
-        self._uuid = None
+        self._source = source
+        self._sampling = sampling
+        if sampling is not None:
+            _use_sampling(sampling)
 
     def trace(self, param, *kargs, **kwargs):
-        global _master_uuid
+        return self._slice(self._sampling, param, kargs, kwargs)
 
-        if _tracefile is not None:
-            with _tlock:
-                # tid isn't really used here
-                self._uuid = _tracefile._tid_packet(0, _master_uuid, self._name, 0)
+    def _slice(self, policy, param, kargs, kwargs):
+        global _master_uuid
 
-        ret = _trace(self._uuid, param, *kargs, **kwargs)
+        tracefile = _tracefile
+        if tracefile is None:
+            return _NULL_TRACE
+        head = None
+        if policy is not None or _head_sampling:
+            keep = _sampled(policy, param, self._name if policy is self._sampling else param)
+            if policy is not None and policy.head and _head_decision.get() is None:
+                head = keep
+            if not keep and head is None:
+                return _NULL_TRACE
+        # Each thread gets its own instance of the track, so that slices always nest properly.
+        uuid = tracefile._thread_track(self, _master_uuid, self._name) if head is not False else None
+
+        ret = _trace(uuid, param, *kargs, **kwargs)
+        if self._source != "line":
+            ret._source = self._source
+        if head is not None:
+            ret._head = head
         return ret
-        
+
     def instant(self, name, description : dict = None, **kwargs):
+        """ Record an instant event.  Keyword arguments: num_outgoing_flow_ids, incoming_flow_ids, and
+        sampling (which overrides the track's) """
         return self._instant(name, description, **kwargs)
 
     def _instant(self, name, description : dict = None, **kwargs):
         num_outgoing_flow_ids = kwargs.get("num_outgoing_flow_ids", 0)
         incoming_flow_ids = kwargs.get("incoming_flow_ids", [])
-        global _tracefile, _tlock, _flow_id, _master_uuid
-        with _tlock:
-            flow_ids = [x for x in range(_flow_id, _flow_id + num_outgoing_flow_ids)]
-            _flow_id += num_outgoing_flow_ids
-            if _tracefile is not None:
-                import inspect
-
-                frame = inspect.currentframe().f_back.f_back
-                caller = frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name
-                if self._uuid is None:
-                    self._uuid = _tracefile._tid_packet(0, _master_uuid, self._name, 0)
-                _tracefile._track_instant(self._uuid, time.time_ns(), name, description, incoming_flow_ids + flow_ids, caller)
-    
+        global _tracefile, _master_uuid
+        flow_ids = _next_flow_ids(num_outgoing_flow_ids)
+        tracefile = _tracefile
+        if tracefile is not None:
+            policy = kwargs.get("sampling", self._sampling)
+            if (policy is not None or _head_sampling) and not _sampled(policy, name, self._name if policy is self._sampling else name):
+                return flow_ids
+            caller = None
+            if self._source is not None:
+                caller = _source_location(sys._getframe(2), self._source)
+            if _task_flows:
+                incoming_flow_ids = incoming_flow_ids + _take_task_flow()
+            uuid = tracefile._thread_track(self, _master_uuid, self._name)
+            seq = tracefile._thread_sequence()
+            seq.track_instant(uuid, _now(), name, description, incoming_flow_ids + flow_ids, caller)
+            tracefile._flush_if_necessary(seq)
+
         return flow_ids
 
 class count:
-    def __init__(self, name):
+    def __init__(self, name, interval : float = None, min_change = None, incremental : bool = False):
+        """ A counter, shared by all threads.  Values are ints or floats.
+
+        By default, every count() and increment() is recorded, in order.  For counters that change more often
+        than that is worth:
+        interval: record the counter at most once every interval seconds.  increment() then only adds to a delta
+            of the calling thread's own, without locking, and the value is the sum of all threads' deltas.
+        min_change: only record the counter once it moved at least this much since it was last recorded.
+        With either, the last value is recorded when the trace is closed.
+        incremental: record each change rather than the value, on a Perfetto incremental counter track.  The
+            changes of all threads go to one packet sequence of the trace, and the value is recorded in full again
+            wherever that sequence starts over (each chunk of a ring buffer or rotated segment), so that every
+            part of the trace that loads on its own adds up to the right values.
+        """
         self._name = name
         self._value = 0
-
+        # Per-counter lock: keeps the value and the order of its samples consistent across threads
+        self._lock = threading.Lock()
+        self._track_type = 3 if incremental else 1
+        self._interval = None if interval is None else int(interval * 1e9)
+        self._min_change = min_change
+        self._coalesce = interval is not None or min_change is not None
+        # coalescing counters: a [delta] cell per thread that incremented the counter; the value is _value plus
+        # the deltas, and each cell is only ever written by its own thread
+        self._cells = []
+        self._local = threading.local()
+        # _now() from which the next sample is due
+        self._next = 0
+        # the last value recorded, and the trace it was recorded to
+        self._recorded = 0
+        self._recorded_to = None
+        # incremental counters: the resets of the counter sequence when the counter was last recorded to it
+        self._cleared = None
+        _counts.add(self)
+
+    def _emit(self, tracefile, value):
+        if self._recorded_to is not tracefile:
+            self._recorded = 0
+            self._recorded_to = tracefile
+            self._cleared = None
+        uuid = _create_counter_track_if_necessary(tracefile, self._name, self._track_type)
+        if self._track_type == 3:
+            # The changes add up from where the sequence last cleared its incremental state (a new chunk of a ring
+            # buffer or segment, or dropped packets): the first sample after that is the value itself.
+            seq = tracefile._counter_sequence()
+            with seq.lock:
+                seq.track_count(uuid, _now(), value - self._recorded if self._cleared == seq.resets else value)
+                self._cleared = seq.resets
+        else:
+            seq = tracefile._thread_sequence()
+            seq.track_count(uuid, _now(), value)
+        self._recorded = value
+        tracefile._flush_if_necessary(seq)
+
+    def _flush(self, force = False):
+        """ Record the value of a coalescing counter if it changed enough.  Unless force, give up if another
+        thread is at it. """
+        if not self._lock.acquire(force):
+            return
+        try:
+            tracefile = _tracefile
+            if tracefile is None:
+                return
+            value = self._value + sum(cell[0] for cell in self._cells)
+            change = value - (self._recorded if self._recorded_to is tracefile else 0)
+            if change and (force or self._min_change is None or abs(change) >= self._min_change):
+                self._emit(tracefile, value)
+            if self._interval is not None:
+                self._next = _now() + self._interval
+        finally:
+            self._lock.release()
 
     def count(self, value):
         global _tracefile
 
-        with _tlock:
+        if self._coalesce:
+            with self._lock:
+                self._value = value - sum(cell[0] for cell in self._cells)
+            if _tracefile is not None and (self._interval is None or _now() >= self._next):
+                self._flush()
+            return
+        with self._lock:
             self._value = value
-            if _tracefile is not None:
-                uuid = _create_counter_track_if_necessary(self._name)
-                _tracefile._track_count(uuid, time.time_ns(), self.value)
+            tracefile = _tracefile
+            if tracefile is not None:
+                self._emit(tracefile, value)
 
     def increment(self, value):
         global _tracefile
 
-        with _tlock:
+        if self._coalesce:
+            try:
+                cell = self._local.cell
+            except AttributeError:
+                cell = self._local.cell = [0]
+                self._cells.append(cell)
+            cell[0] += value
+            if _tracefile is not None and (self._interval is None or _now() >= self._next):
+                self._flush()
+            return
+        with self._lock:
             self._value += value
-            if _tracefile is not None:
-                uuid = _create_counter_track_if_necessary(self._name)
-                _tracefile._track_count(uuid, time.time_ns(), self._value)
-
-def trace(params, *kargs, **kwargs):
+            tracefile = _tracefile
+            if tracefile is not None:
+                self._emit(tracefile, self._value)
+
+def _task_track(task):
+    """ The track of an asyncio task (see open(task_tracks=True)).
+
+    Tracks are recycled when their task is done, so a thread has as many task tracks as it ever ran tasks
+    at the same time, named "<thread> task <n>".
+    """
+    t = _task_lanes.get(task)
+    if t is None:
+        try:
+            free = _tls.free_task_tracks
+        except AttributeError:
+            free = _tls.free_task_tracks = []
+        if free:
+            t = free.pop()
+        else:
+            _tls.num_task_tracks = getattr(_tls, "num_task_tracks", 0) + 1
+            t = track("{} task {}".format(threading.current_thread().name, _tls.num_task_tracks))
+        _task_lanes[task] = t
+        # done callbacks run on the task's loop, i.e., on this thread
+        task.add_done_callback(lambda task: free.append(t))
+    return t
+
+def _default_track():
+    """ The track trace() and instant() use: the one set by use_track(), the running asyncio task's
+    (with open(task_tracks=True)), or else the calling thread's default track """
+    t = _current_track.get()
+    if t is not None:
+        return t
+    if _task_tracks:
+        task = _current_task()
+        if task is not None:
+            return _task_track(task)
     if not hasattr(_tls, "default_track"):
         _tls.default_track = track(threading.current_thread().name)
-    return _tls.default_track.trace(params, *kargs, **kwargs)
+    return _tls.default_track
+
+class use_track:
+    """ Make trace(), instant() and the trace_func decorators use track t within a `with` block.
+
+    The setting lives in a contextvars context: it follows a coroutine across awaits, and asyncio tasks
+    created inside the block inherit it.  Tasks that run at the same time shouldn't share a track, as their
+    slices wouldn't nest.
+    """
+    def __init__(self, t : track):
+        self._track = t
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_track.set(self._track)
+        return self._track
+
+    def __exit__(self, type, value, traceback):
+        _current_track.reset(self._token)
+
+def task_factory(loop, coro, **kwargs):
+    """ asyncio task factory that draws a flow arrow from where a task is created to the task's first event.
+
+    Install it with loop.set_task_factory(tg4perfetto.task_factory); open(task_tracks=True) does so for the
+    running loop.  The creating side gets a "create_task" instant.
+    """
+    import asyncio
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    if _tracefile is not None:
+        _task_flows[task] = instant("create_task", {"task": task.get_name()}, num_outgoing_flow_ids=1)[0]
+    return task
+
+def trace(params, *kargs, **kwargs):
+    if _tracefile is None:
+        return _NULL_TRACE
+    return _default_track().trace(params, *kargs, **kwargs)
 
 def instant(name : str, description : dict = None, **kwargs):
-    if not hasattr(_tls, "default_track"):
-        _tls.default_track = track(threading.current_thread().name)
-    return _tls.default_track._instant(name, description, **kwargs)
+    if _tracefile is None:
+        return _next_flow_ids(kwargs.get("num_outgoing_flow_ids", 0)) if kwargs else []
+    return _default_track()._instant(name, description, **kwargs)
 
 def trace_func(x):
-    if isinstance(x, typing.Callable):
+    if _disabled_by_environment():
+        return _undecorated(x)
+    if callable(x):
         func = x
+        if _is_coroutine_function(func):
+            @functools.wraps(func)
+            async def f(*kargs, **kwargs):
+                if _tracefile is None:
+                    return await func(*kargs, **kwargs)
+                with trace(func.__name__).set_caller(func) as _:
+                    return await func(*kargs, **kwargs)
+            return f
         @functools.wraps(func)
         def f(*kargs, **kwargs):
+            if _tracefile is None:
+                return func(*kargs, **kwargs)
             with trace(func.__name__).set_caller(func) as _:
                 return func(*kargs, **kwargs)
         return f
@@ -161,59 +514,326 @@ def trace_func(x):
         tobj = x
         def trace_func_wrapper(func):
             nonlocal tobj
+            if _is_coroutine_function(func):
+                @functools.wraps(func)
+                async def f(*kargs, **kwargs):
+                    if _tracefile is None:
+                        return await func(*kargs, **kwargs)
+                    with tobj.trace(func.__name__).set_caller(func) as _:
+                        return await func(*kargs, **kwargs)
+                return f
             @functools.wraps(func)
             def f(*kargs, **kwargs):
                 nonlocal tobj
+                if _tracefile is None:
+                    return func(*kargs, **kwargs)
                 with tobj.trace(func.__name__).set_caller(func) as _:
                     return func(*kargs, **kwargs)
             return f
         return trace_func_wrapper
+    elif isinstance(x, sampling):
+        return _sampled_trace_func(x, False)
     else:
         assert False
 
 def trace_func_args(x):
-    if isinstance(x, typing.Callable):
+    if _disabled_by_environment():
+        return _undecorated(x)
+    if callable(x):
         func = x
+        if _is_coroutine_function(func):
+            @functools.wraps(func)
+            async def f(*kargs, **kwargs):
+                if _tracefile is None:
+                    return await func(*kargs, **kwargs)
+                with trace(func.__name__, *kargs, **kwargs).set_caller(func) as _:
+                    return await func(*kargs, **kwargs)
+            return f
         @functools.wraps(func)
         def f(*kargs, **kwargs):
+            if _tracefile is None:
+                return func(*kargs, **kwargs)
             with trace(func.__name__, *kargs, **kwargs).set_caller(func) as _:
                 return func(*kargs, **kwargs)
         return f
     elif isinstance(x, track):
         tobj = x
-        def tarce_func_wrapper(func):
+        def trace_func_wrapper(func):
             nonlocal tobj
+            if _is_coroutine_function(func):
+                @functools.wraps(func)
+                async def f(*kargs, **kwargs):
+                    if _tracefile is None:
+                        return await func(*kargs, **kwargs)
+                    with tobj.trace(func.__name__, *kargs, **kwargs).set_caller(func) as _:
+                        return await func(*kargs, **kwargs)
+                return f
             @functools.wraps(func)
             def f(*kargs, **kwargs):
                 nonlocal tobj
+                if _tracefile is None:
+                    return func(*kargs, **kwargs)
                 with tobj.trace(func.__name__, *kargs, **kwargs).set_caller(func) as _:
                     return func(*kargs, **kwargs)
             return f
         return trace_func_wrapper
-
-def open(filename): 
+    elif isinstance(x, sampling):
+        return _sampled_trace_func(x, True)
+
+def _sampled_trace_func(policy, args):
+    """ trace_func(policy) / trace_func_args(policy): trace the calls policy samples, on the default track """
+    _use_sampling(policy)
+    def trace_func_wrapper(func):
+        name = func.__name__
+        if _is_coroutine_function(func):
+            @functools.wraps(func)
+            async def f(*kargs, **kwargs):
+                if _tracefile is None:
+                    return await func(*kargs, **kwargs)
+                with _default_track()._slice(policy, name, kargs if args else (), kwargs if args else {}).set_caller(func) as _:
+                    return await func(*kargs, **kwargs)
+            return f
+        @functools.wraps(func)
+        def f(*kargs, **kwargs):
+            if _tracefile is None:
+                return func(*kargs, **kwargs)
+            with _default_track()._slice(policy, name, kargs if args else (), kwargs if args else {}).set_caller(func) as _:
+                return func(*kargs, **kwargs)
+        return f
+    return trace_func_wrapper
+
+def open(filename, engine : str = "wire", dump_signal = None, dump_on_exception : bool = False, sample_rate : float = None,
+         auto_trace : bool = False, auto_trace_include = None, auto_trace_exclude = None, auto_trace_min_depth : int = 1,
+         auto_trace_max_depth : int = None, task_tracks : bool = False, metrics_rate : float = None, trace_gc : bool = False,
+         **kwargs):
+    """ Start tracing into filename.  Keyword arguments (engine, async_flush, ...) go to _BaseTraceGenerator.
+
+    Events are timestamped on the monotonic clock, with delta-encoded timestamps (clock="monotonic",
+    incremental_timestamps=True).
+
+    With ring_buffer_size, the trace is only kept in memory (flight-recorder mode) and written by dump().
+    dump_signal: (flight-recorder mode only) a signal number (e.g. signal.SIGUSR1) that triggers dump().
+    dump_on_exception: (flight-recorder mode only) dump() when an exception escapes the `with` block or a thread.
+    sample_rate: also sample the Python stacks of all threads this many times per second (e.g. 100-1000),
+        for flamegraphs of the code that isn't traced explicitly.
+    auto_trace: trace every function call as a slice on the thread's default track, without decorators.
+        auto_trace_include / auto_trace_exclude: glob patterns (or lists of them) matched against "module.qualname".
+        auto_trace_min_depth / auto_trace_max_depth: only trace calls nested this deep among the traced calls.
+    task_tracks: give each asyncio task a track of its own, so that the slices of tasks that interleave on an
+        event loop nest properly, and install task_factory() on the running loop (if any) for flows from
+        create_task() to each task's first event.
+    metrics_rate: also record process metrics (CPU %, RSS, threads, page faults, context switches) this many times
+        per second (e.g. 10) as counter tracks under the process.
+    trace_gc: record each garbage collection as a "gc" slice, with its generation and the number of objects
+        collected, on the thread that triggered it.
+    """
     global _tracefile, _master_uuid
+    if (dump_signal is not None or dump_on_exception) and kwargs.get("ring_buffer_size") is None:
+        raise ValueError("dump_signal and dump_on_exception need ring_buffer_size (flight-recorder mode)")
+    kwargs.setdefault("clock", "monotonic")
+    kwargs.setdefault("incremental_timestamps", True)
 
     class X:
         def __init__(self):
-            pass
-        def __enter__(self):
+            self._tracefile = None
+            self._old_handler = None
+            self._dump_requests = None
+            self._dumper = None
+            self._old_excepthook = None
+            self._sampler = None
+            self._metrics = None
+            self._auto_tracer = None
+            self._loop = None
+        def _start(self, filename, shard):
             global _tracefile, _master_uuid
+            # The trace machinery is imported by the first trace opened, so that programs that only keep the
+            # decorators in place don't pay for it.
+            from ._core import _BaseTraceGenerator
+            self._tracefile = _BaseTraceGenerator(filename, engine, shard=shard, **kwargs)
+            if not _paused:
+                _tracefile = self._tracefile
+            pid = os.getpid()
+            tid = threading.get_ident()
+            uuid = self._tracefile._pid_packet(pid, sys.argv[0], threading.current_thread().name)
+            _master_uuid = uuid
+
+            if sample_rate is not None:
+                from ._sampler import _Sampler
+                self._sampler = _Sampler(self._tracefile, sample_rate)
+                self._sampler.start()
+            if metrics_rate is not None or trace_gc:
+                from ._metrics import _MetricsCollector
+                self._metrics = _MetricsCollector(self._tracefile, uuid, metrics_rate, self._thread_track if trace_gc else None)
+                self._metrics.start()
+            if self._auto_tracer is not None:
+                self._auto_tracer.reset(self._tracefile)
+        def __enter__(self):
+            global _session, _task_tracks
             if _master_uuid is not None:
                 raise AssertError("Nested trace opening not allowed")
 
-            _tracefile = _BaseTraceGenerator(filename)
+            self._start(filename, 0)
+            _session = self
+
+            if task_tracks:
+                _task_tracks = True
+                asyncio = sys.modules.get("asyncio")
+                loop = asyncio._get_running_loop() if asyncio is not None else None
+                if loop is not None and loop.get_task_factory() is None:
+                    loop.set_task_factory(task_factory)
+                    self._loop = loop
+
+            if dump_signal is not None:
+                self._start_dumper()
+                self._old_handler = signal.signal(dump_signal, lambda signum, frame: self._dump_requests.put(True))
+            if dump_on_exception:
+                self._old_excepthook = threading.excepthook
+                def excepthook(args):
+                    self._dump_or_report()
+                    self._old_excepthook(args)
+                threading.excepthook = excepthook
+            if auto_trace:
+                from ._autotrace import _AutoTracer
+                self._auto_tracer = _AutoTracer(self._tracefile, self._thread_track,
+                                                auto_trace_include, auto_trace_exclude, auto_trace_min_depth, auto_trace_max_depth)
+                self._auto_tracer.start()
+            return self
+        def _start_dumper(self):
+            """ Start the thread that dumps on dump_signal.  The signal handler runs on the main thread between any
+            two bytecodes, possibly while that thread holds the trace's locks, so it only queues a request (the put()
+            of a SimpleQueue is reentrant) and dumping happens here. """
+            import queue
+            self._dump_requests = queue.SimpleQueue()
+            self._dumper = threading.Thread(target=self._run_dumper, name="tg4perfetto-dump", daemon=True)
+            self._dumper.start()
+        def _run_dumper(self):
+            requests = self._dump_requests
+            while requests.get():
+                self._dump_or_report()
+        def _dump_or_report(self):
+            """ dump(), printing rather than raising what goes wrong: the dumps that aren't asked for directly happen
+            when something else went wrong, which is what the caller needs to see """
+            try:
+                self.dump()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+        def _thread_track(self):
+            """ uuid of the calling thread's default track """
+            t = _default_track()
+            return self._tracefile._thread_track(t, _master_uuid, t._name)
+        def _after_fork_in_child(self):
+            """ Continue in a shard file of the child's own, e.g. trace.1234.perfetto-trace """
+            # whatever the parent traced before the fork is the parent's to write
+            self._tracefile._abandon()
+            # the sampler and metrics threads didn't survive the fork
+            self._sampler = None
+            if self._metrics is not None:
+                self._metrics._abandon()
+                self._metrics = None
             pid = os.getpid()
-            tid = threading.get_ident()
-            uuid = _tracefile._pid_packet(pid, sys.argv[0], threading.current_thread().name)
-            _master_uuid = uuid
+            root, ext = os.path.splitext(filename)
+            self._start("{}.{}{}".format(root, pid, ext), pid)
+            # nor did the dump thread
+            if self._dumper is not None:
+                self._start_dumper()
+            # A multiprocessing child leaves with os._exit(), which skips atexit, but it runs multiprocessing's
+            # finalizers first.  Its finalizer registry is cleared after the fork, so register from an after-forker.
+            mp_util = sys.modules.get("multiprocessing.util")
+            if mp_util is not None:
+                mp_util.register_after_fork(self, lambda self: mp_util.Finalize(self, self.__exit__, (None, None, None), exitpriority=10))
+            atexit.register(self.__exit__, None, None, None)
         def __exit__(self, type, value, traceback):
-            global _tracefile, _master_uuid
-            _tracefile = None
-            _master_uuid = None
+            global _tracefile, _master_uuid, _session, _task_tracks
+            if self._tracefile._closed:
+                # already closed at exit of a forked child
+                return
+            # whatever fails here, the trace ends and the exception that left the block (if any) comes through
+            try:
+                if self._auto_tracer is not None:
+                    self._auto_tracer.stop()
+                if self._sampler is not None:
+                    self._sampler.stop()
+                if self._metrics is not None:
+                    self._metrics.stop()
+                if dump_signal is not None:
+                    signal.signal(dump_signal, self._old_handler)
+                    # after the dumps already asked for
+                    self._dump_requests.put(False)
+                    self._dumper.join()
+                if self._old_excepthook is not None:
+                    threading.excepthook = self._old_excepthook
+                if self._loop is not None and self._loop.get_task_factory() is task_factory:
+                    self._loop.set_task_factory(None)
+                if dump_on_exception and type is not None:
+                    self._dump_or_report()
+                _flush_counts()
+            finally:
+                _task_tracks = False
+                _tracefile = None
+                _master_uuid = None
+                _session = None
+                self._tracefile.close()
+        def dump(self, filename : str = None) -> str:
+            """ Write the flight recorder's contents (see _BaseTraceGenerator.dump) """
+            _flush_counts()
+            return self._tracefile.dump(filename)
+        @property
+        def dropped_packets(self):
+            """ Number of packets discarded because the background writer fell behind (backpressure="drop") """
+            return self._tracefile.dropped_packets
 
     return X()
 
+def _flush_counts():
+    """ Record the latest values of the coalescing counters """
+    for c in list(_counts):
+        if c._coalesce:
+            c._flush(True)
+
+def dump(filename : str = None) -> str:
+    """ Write the flight recorder's contents of the currently open trace.  Returns the file name, or None if no trace is open. """
+    session = _session
+    if session is None:
+        return None
+    return session.dump(filename)
+
+def disable():
+    """ Pause recording: until enable(), trace(), instant(), counters and the trace_func decorators record nothing,
+    and cost about as much as if they weren't there.  Holds across open(), so that a program can keep its
+    instrumentation in place and turn it on where needed.  Stack sampling and auto_trace go on. """
+    global _tracefile, _paused
+    _paused = True
+    _tracefile = None
+
+def enable():
+    """ Resume recording after disable() """
+    global _tracefile, _paused
+    _paused = False
+    if _session is not None:
+        _tracefile = _session._tracefile
+
+def enabled() -> bool:
+    """ Whether events are being recorded, i.e., a trace is open and recording isn't paused """
+    return _tracefile is not None
+
+def _after_fork_in_child():
+    global _flow_ids
+    for c in list(_counts):
+        c._lock = threading.Lock()
+    for s in list(_samplings):
+        s._lock = threading.Lock()
+    if _session is not None:
+        # flow IDs the parent hands out stay valid in the child and never collide with the child's own,
+        # so flows between processes connect when the shards are loaded together
+        _flow_ids = itertools.count((os.getpid() << 32) + 1)
+        _session._after_fork_in_child()
+
+_paused = _disabled_by_environment()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 def stop():
     _tracefile = None
     # We will leave _master_uuid set.  This is for detecting nested open calls.
@@ -0,0 +1,441 @@
+import threading
+import weakref
+
+from . import perfetto_trace_slim_pb2 as pb2
+from ._annotations import (_kind, _dataclass_fields, _ndarray_summary, _bytes_summary, _KIND_STR, _KIND_BOOL, _KIND_INT,
+                           _KIND_FLOAT, _KIND_DICT, _KIND_LIST, _KIND_BYTES, _KIND_ENUM, _KIND_DATACLASS, _KIND_NDARRAY,
+                           _KIND_NPSCALAR, _KIND_OTHER)
+from ._wire import _function_name, _utf8_len, _truncate_utf8, _counter_value
+
+# The "protobuf" engine.  It lives apart from _core so that only traces that ask for it load the protobuf runtime.
+
+class _ProtoSequence:
+    """ A packet sequence built through the pb2 message API.  Slow, but useful as a reference. """
+    def __init__(self, parent, seq_id):
+        # a proxy: the generator holds its sequences, and is flushed when it is dropped
+        self._parent = weakref.proxy(parent)
+        self.seq_id = seq_id
+        # how many times reset() was called: incremental counters start over after each
+        self.resets = 0
+        self.interned_data = {}
+        self.interned_source = {}
+        self.interned_frames = {}
+        self.interned_mappings = {}
+        self.interned_callstacks = {}
+        self.interned_annotation_names = {}
+        self.interned_strings = {}
+        # track descriptors in the pending packets, as (method, args)
+        self.tracks = []
+        # Held while a packet is added, and while the sequence is drained and restarted, which flush() and close()
+        # do from other threads.  Reentrant, as restarting the sequence adds packets.
+        self.lock = threading.RLock()
+        self.trace = pb2.Trace()
+        # delta-encoded timestamps (see packet_defaults())
+        self._incremental = False
+        self.last_timestamp = 0
+        self._absolute_clock = None
+
+    def __len__(self):
+        return len(self.trace.packet)
+
+    def drain(self):
+        """ Swap out the packets accumulated so far.  Pass the result to serialize() to get the bytes. """
+        with self.lock:
+            data = self.trace
+            self.trace = pb2.Trace()
+            self.tracks = []
+            return data
+
+    @staticmethod
+    def serialize(chunk) -> bytes:
+        """ Serialized form (a `Trace` message body) of a drained chunk. """
+        return chunk.SerializeToString()
+
+    def peek(self) -> bytes:
+        """ Serialized copy of the pending packets, without draining them """
+        with self.lock:
+            return self.trace.SerializeToString()
+
+    def reset(self):
+        """ Forget all interned data.  The next packet on the sequence must clear the incremental state. """
+        with self.lock:
+            self.resets += 1
+            self.interned_data = {}
+            self.interned_source = {}
+            self.interned_frames = {}
+            self.interned_mappings = {}
+            self.interned_callstacks = {}
+            self.interned_annotation_names = {}
+            self.interned_strings = {}
+
+    def clock_snapshot(self, clocks, primary_trace_clock):
+        with self.lock:
+            pkt = self.trace.packet.add()
+            pkt.trusted_packet_sequence_id = self.seq_id
+            for clock_id, ts in clocks:
+                clk = pkt.clock_snapshot.clocks.add()
+                clk.clock_id = clock_id
+                clk.timestamp = ts
+            pkt.clock_snapshot.primary_trace_clock = primary_trace_clock
+
+    def trace_config(self, buffer_size_kb, data_source_name):
+        with self.lock:
+            pkt = self.trace.packet.add()
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.trace_config.buffers.add().size_kb = buffer_size_kb
+            pkt.trace_config.data_sources.add().config.name = data_source_name
+
+    def packet_defaults(self, track_uuid, timestamp_clock_id, incremental_base = None):
+        with self.lock:
+            pkt = self.trace.packet.add()
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.trace_packet_defaults.track_event_defaults.track_uuid = track_uuid
+            pkt.trace_packet_defaults.timestamp_clock_id = timestamp_clock_id
+            pkt.sequence_flags = 1
+            self._incremental = incremental_base is not None
+            if self._incremental:
+                clock_id, ts = incremental_base
+                clk = pkt.clock_snapshot.clocks.add()
+                clk.clock_id = clock_id
+                clk.timestamp = ts
+                clk = pkt.clock_snapshot.clocks.add()
+                clk.clock_id = timestamp_clock_id
+                clk.timestamp = ts
+                clk.is_incremental = True
+                self.last_timestamp = ts
+                self._absolute_clock = clock_id
+
+    def _set_timestamp(self, pkt, ts):
+        if not self._incremental:
+            pkt.timestamp = ts
+        elif ts >= self.last_timestamp:
+            pkt.timestamp = ts - self.last_timestamp
+            self.last_timestamp = ts
+        else:
+            pkt.timestamp = ts
+            pkt.timestamp_clock_id = self._absolute_clock
+
+    def process_track(self, uuid, pid, process_name, track_name):
+        with self.lock:
+            self.tracks.append(("process_track", (uuid, pid, process_name, track_name)))
+            pkt = self.trace.packet.add()
+            pkt.timestamp = 0
+            pkt.track_descriptor.uuid = uuid
+            pkt.track_descriptor.process.pid = pid
+            pkt.track_descriptor.process.process_name = process_name
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+            pkt.track_descriptor.name = track_name
+
+    def child_track(self, uuid, parent_uuid, name, track_type):
+        with self.lock:
+            self.tracks.append(("child_track", (uuid, parent_uuid, name, track_type)))
+            pkt = self.trace.packet.add()
+
+            pkt.timestamp = 0
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+
+            pkt.track_descriptor.uuid = uuid
+            pkt.track_descriptor.name = name
+
+            if parent_uuid != 0:
+                pkt.track_descriptor.parent_uuid = parent_uuid
+
+            if track_type == 1:
+                pkt.track_descriptor.counter.categories.append("dummy")
+            elif track_type == 3:
+                # incremental counter: each value is added to the previous ones
+                pkt.track_descriptor.counter.categories.append("dummy")
+                pkt.track_descriptor.counter.is_incremental = True
+
+    def thread_track(self, uuid, pid, tid, thread_name):
+        with self.lock:
+            self.tracks.append(("thread_track", (uuid, pid, tid, thread_name)))
+            pkt = self.trace.packet.add()
+
+            pkt.timestamp = 0
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+
+            pkt.track_descriptor.uuid = uuid
+            pkt.track_descriptor.thread.pid = pid
+            pkt.track_descriptor.thread.tid = tid
+            pkt.track_descriptor.thread.thread_name = thread_name
+
+    def stack_sample(self, ts, pid, tid, stack):
+        with self.lock:
+            pkt = self.trace.packet.add()
+
+            self._set_timestamp(pkt, ts)
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+            pkt.perf_sample.pid = pid
+            pkt.perf_sample.tid = tid
+
+            if stack in self.interned_callstacks:
+                pkt.perf_sample.callstack_iid = self.interned_callstacks[stack]
+                return
+            callstack = pkt.interned_data.callstacks.add()
+            for code in stack:
+                if code not in self.interned_frames:
+                    file = code.co_filename
+                    if file not in self.interned_mappings:
+                        mid = self.interned_mappings[file] = len(self.interned_mappings) + 1
+                        path = pkt.interned_data.mapping_paths.add()
+                        path.iid = mid
+                        path.str = file.encode()
+                        mapping = pkt.interned_data.mappings.add()
+                        mapping.iid = mid
+                        mapping.path_string_ids.append(mid)
+                    fid = self.interned_frames[code] = len(self.interned_frames) + 1
+                    name = pkt.interned_data.function_names.add()
+                    name.iid = fid
+                    name.str = _function_name(code).encode()
+                    frame = pkt.interned_data.frames.add()
+                    frame.iid = fid
+                    frame.function_name_id = fid
+                    frame.mapping_id = self.interned_mappings[file]
+                    frame.rel_pc = code.co_firstlineno
+                callstack.frame_ids.append(self.interned_frames[code])
+            callstack.iid = self.interned_callstacks[stack] = len(self.interned_callstacks) + 1
+            pkt.perf_sample.callstack_iid = callstack.iid
+
+    def _get_iid_for(self, pkt, name):
+        if name in self.interned_data:
+            return self.interned_data[name]
+
+        ev = pkt.interned_data.event_names.add()
+        ev.name = name
+        ev.iid = len(self.interned_data) + 1
+
+        self.interned_data[name] = ev.iid
+        return ev.iid
+
+    def _get_annotation_name_iid_for(self, pkt, name):
+        if name in self.interned_annotation_names:
+            return self.interned_annotation_names[name]
+
+        n = pkt.interned_data.debug_annotation_names.add()
+        n.name = name
+        n.iid = len(self.interned_annotation_names) + 1
+
+        self.interned_annotation_names[name] = n.iid
+        return n.iid
+
+    def _set_string_value(self, pkt, x, v, budget = None):
+        if v in self.interned_strings:
+            x.string_value_iid = self.interned_strings[v]
+            return
+        if budget is not None:
+            n = _utf8_len(v)
+            if n > budget[1]:
+                x.string_value = _truncate_utf8(v, max(budget[1], 0)) + "..."
+                budget[1] = 0
+                return
+            budget[1] -= n
+        if len(self.interned_strings) >= self._parent.max_interned_strings:
+            x.string_value = v
+        else:
+            entry = pkt.interned_data.debug_annotation_string_values.add()
+            entry.str = v.encode()
+            entry.iid = len(self.interned_strings) + 1
+            self.interned_strings[v] = entry.iid
+            x.string_value_iid = entry.iid
+
+    def _set_value(self, pkt, x, v, budget):
+        """ Set a DebugAnnotation to a value; budget is as in _WireSequence._annotation_value """
+        budget[0] -= 1
+        t = type(v)
+        try:
+            setter = _value_setters[t]
+        except KeyError:
+            setter = _value_setters[t] = _kind_setters[_kind(t)]
+        setter(self, pkt, x, v, budget)
+
+    def _set_str(self, pkt, x, v, budget):
+        self._set_string_value(pkt, x, v, budget)
+
+    def _set_bool(self, pkt, x, v, budget):
+        x.bool_value = v
+
+    def _set_int(self, pkt, x, v, budget):
+        x.int_value = v
+
+    def _set_float(self, pkt, x, v, budget):
+        x.double_value = v
+
+    def _set_dict(self, pkt, x, v, budget):
+        if len(v) == 0:
+            x.string_value = "[empty]"
+        else:
+            self._add_debug_annotation_new(pkt, x.dict_entries, v, budget)
+
+    def _set_list(self, pkt, x, v, budget):
+        if len(v) == 0:
+            x.string_value = "[empty]"
+            return
+        for i,vv in zip(range(len(v)), v):
+            if i == self._parent.list_max_size:
+                self._set_string_value(pkt, x.array_values.add(), "... ({} more items)".format(len(v) - i))
+                break
+            if budget[0] <= 0 or budget[1] <= 0:
+                self._set_string_value(pkt, x.array_values.add(), "... (truncated)")
+                break
+            # for some reason, perfetto ui crashes on nested lists.
+            # add a dummy dictionary here
+            if isinstance(vv, (list, tuple, set, frozenset)):
+                vv = {"array" : vv}
+            self._set_value(pkt, x.array_values.add(), vv, budget)
+
+    def _set_bytes(self, pkt, x, v, budget):
+        x.string_value = _bytes_summary(v)
+
+    def _set_enum(self, pkt, x, v, budget):
+        self._set_string_value(pkt, x, str(v), budget)
+
+    def _set_dataclass(self, pkt, x, v, budget):
+        self._set_dict(pkt, x, _dataclass_fields(v), budget)
+
+    def _set_ndarray(self, pkt, x, v, budget):
+        self._set_dict(pkt, x, _ndarray_summary(v, self._parent.list_max_size), budget)
+
+    def _set_npscalar(self, pkt, x, v, budget):
+        # the Python value takes the node
+        budget[0] += 1
+        self._set_value(pkt, x, v.item(), budget)
+
+    def _set_other(self, pkt, x, v, budget):
+        x.string_value = str(type(v))
+
+    def _add_debug_annotation_new(self, pkt, d, kwargs, budget):
+        cnt = 0
+        for k,v in kwargs.items():
+            cnt += 1
+            x = d.add()
+            if cnt == self._parent.list_max_size:
+                x.name_iid = self._get_annotation_name_iid_for(pkt, "...")
+                x.string_value = "({} more items)".format(len(kwargs) - cnt)
+                break
+            if budget[0] <= 0 or budget[1] <= 0:
+                x.name_iid = self._get_annotation_name_iid_for(pkt, "...")
+                x.string_value = "(truncated)"
+                break
+
+            x.name_iid = self._get_annotation_name_iid_for(pkt, str(k))
+            self._set_value(pkt, x, v, budget)
+
+    def _add_debug_annotation(self, pkt, d, kwargs):
+        return self._add_debug_annotation_new(pkt, d, kwargs, [self._parent.annotation_max_nodes, self._parent.annotation_max_bytes])
+
+    def track_instant(self, uuid, ts, annotation, kwargs, flow, caller = None):
+        with self.lock:
+            pkt = self.trace.packet.add()
+
+            self._set_timestamp(pkt, ts)
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+            pkt.track_event.category_iids.append(1)
+            pkt.track_event.type = pb2.TrackEvent.TYPE_INSTANT
+            pkt.track_event.track_uuid = uuid
+            pkt.track_event.name_iid = self._get_iid_for(pkt, annotation)
+
+            if kwargs is not None:
+                self._add_debug_annotation(pkt, pkt.track_event.debug_annotations, kwargs)
+
+            for x in flow:
+                pkt.track_event.flow_ids.append(x)
+
+            if caller is not None:
+                file,line,name = caller
+                iid = self._get_source_iid_for(pkt, file, name, line)
+                pkt.track_event.source_location_iid = iid
+
+    def _get_source_iid_for(self, pkt, file, name, line):
+        if (file, name, line) in self.interned_source:
+            return self.interned_source[(file, name, line)]
+        ev = pkt.interned_data.source_locations.add()
+        ev.file_name = file
+        ev.function_name = name
+        ev.line_number = line
+        ev.iid = len(self.interned_source) + 1
+        self.interned_source[(file, name, line)] = ev.iid
+
+        return ev.iid
+
+    def track_open(self, uuid, ts, annotation, kwargs, flow, caller = None):
+        with self.lock:
+            pkt = self.trace.packet.add()
+
+            self._set_timestamp(pkt, ts)
+            pkt.track_event.name_iid = self._get_iid_for(pkt, annotation)
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+            pkt.track_event.category_iids.append(1)
+            pkt.track_event.type = pb2.TrackEvent.TYPE_SLICE_BEGIN
+            pkt.track_event.track_uuid = uuid
+
+            if kwargs is not None:
+                self._add_debug_annotation(pkt, pkt.track_event.debug_annotations, kwargs)
+            for x in flow:
+                pkt.track_event.flow_ids.append(x)
+
+            if caller is not None:
+                file,line,name = caller
+                iid = self._get_source_iid_for(pkt, file, name, line)
+                pkt.track_event.source_location_iid = iid
+
+    def track_close(self, uuid, ts, flow):
+        with self.lock:
+            pkt = self.trace.packet.add()
+
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+            self._set_timestamp(pkt, ts)
+            pkt.track_event.track_uuid = uuid
+            pkt.track_event.type = pb2.TrackEvent.TYPE_SLICE_END
+            for x in flow:
+                pkt.track_event.flow_ids.append(x)
+
+    def track_count(self, uuid, ts, value):
+        with self.lock:
+            pkt = self.trace.packet.add()
+
+            self._set_timestamp(pkt, ts)
+            pkt.trusted_packet_sequence_id = self.seq_id
+            pkt.sequence_flags = 2
+            pkt.track_event.type = pb2.TrackEvent.TYPE_COUNTER
+            pkt.track_event.track_uuid = uuid
+            value = _counter_value(value)
+            if type(value) is float:
+                pkt.track_event.double_counter_value = value
+            else:
+                pkt.track_event.counter_value = value
+
+    def track_count_many(self, uuid, ts, values):
+        with self.lock:
+            for t, v in zip(ts, values):
+                self.track_count(uuid, int(t), v)
+
+    def track_slices_many(self, uuid, starts, ends, names):
+        with self.lock:
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                self.track_open(uuid, int(start), names if isinstance(names, str) else str(names[i]), None, [])
+                self.track_close(uuid, int(end), [])
+
+# type -> _ProtoSequence method that sets a DebugAnnotation to its values
+_value_setters = {}
+_kind_setters = {
+    _KIND_STR: _ProtoSequence._set_str,
+    _KIND_BOOL: _ProtoSequence._set_bool,
+    _KIND_INT: _ProtoSequence._set_int,
+    _KIND_FLOAT: _ProtoSequence._set_float,
+    _KIND_DICT: _ProtoSequence._set_dict,
+    _KIND_LIST: _ProtoSequence._set_list,
+    _KIND_BYTES: _ProtoSequence._set_bytes,
+    _KIND_ENUM: _ProtoSequence._set_enum,
+    _KIND_DATACLASS: _ProtoSequence._set_dataclass,
+    _KIND_NDARRAY: _ProtoSequence._set_ndarray,
+    _KIND_NPSCALAR: _ProtoSequence._set_npscalar,
+    _KIND_OTHER: _ProtoSequence._set_other,
+}
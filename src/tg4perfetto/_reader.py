@@ -0,0 +1,550 @@
+import fnmatch
+import math
+import os
+import zlib
+
+from . import perfetto_trace_slim_pb2 as pb2
+from ._writer import _mmap_written_length, _MMAP_HEADER, _MMAP_MAGIC
+
+# Reading traces back, one packet at a time, so that traces much larger than memory can be checked.
+#
+# The file is a `Trace` message, i.e., a sequence of length-delimited `packet` fields; they are framed here and
+# decoded one by one.  The reader keeps what later packets depend on: the tracks, and per packet sequence the
+# interned data, the packet defaults and the incremental clocks.
+
+_K_PACKET = 0x0a
+_READ_SIZE = 1 << 20
+
+_SEQ_INCREMENTAL_STATE_CLEARED = 1
+_SEQ_NEEDS_INCREMENTAL_STATE = 2
+
+_TYPE_SLICE_BEGIN = pb2.TrackEvent.TYPE_SLICE_BEGIN
+_TYPE_SLICE_END = pb2.TrackEvent.TYPE_SLICE_END
+_TYPE_INSTANT = pb2.TrackEvent.TYPE_INSTANT
+_TYPE_COUNTER = pb2.TrackEvent.TYPE_COUNTER
+
+def _read_varint(buf, pos):
+    """ Decode a varint at buf[pos]; returns (value, next position), or (None, pos) if buf ends first """
+    value = 0
+    shift = 0
+    while pos < len(buf):
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+    return None, pos
+
+def _raw_packets(f, errors):
+    """ The serialized packets of a trace file, without reading the file into memory.  Problems go to errors. """
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        # a packet starts at pos: its key, its length, then its body
+        key, p = _read_varint(buf, pos)
+        length = None
+        if key is not None:
+            length, p = _read_varint(buf, p)
+        if length is not None and p + length <= len(buf):
+            if key != _K_PACKET:
+                errors.append("not a trace: unexpected field key {:#x} (if the file was cut short, `tg4perfetto repair` "
+                              "can fix it)".format(key))
+                return
+            yield bytes(buf[p:p + length])
+            pos = p + length
+            continue
+        if eof:
+            if pos < len(buf):
+                errors.append("truncated: {} trailing bytes are not a whole packet".format(len(buf) - pos))
+            return
+        del buf[:pos]
+        pos = 0
+        data = f.read(_READ_SIZE)
+        if not data:
+            eof = True
+        buf += data
+
+def _packet_runs(f, errors):
+    """ Like _raw_packets(), but in runs of whole packets, each a serialized `Trace` """
+    buf = b""
+    pos = 0
+    eof = False
+    while True:
+        start = pos
+        size = len(buf)
+        while pos < size:
+            if buf[pos] != _K_PACKET:
+                if pos > start:
+                    yield buf[start:pos]
+                errors.append("not a trace: unexpected field key {:#x} (if the file was cut short, `tg4perfetto repair` "
+                              "can fix it)".format(buf[pos]))
+                return
+            length, p = _read_varint(buf, pos + 1)
+            if length is None or p + length > size:
+                break
+            pos = p + length
+        if pos > start:
+            yield buf[start:pos]
+        if eof:
+            if pos < size:
+                errors.append("truncated: {} trailing bytes are not a whole packet".format(size - pos))
+            return
+        data = f.read(_READ_SIZE)
+        if not data:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+
+def _is_mmap_header(raw) -> bool:
+    """ Whether a serialized packet is the header of an mmap_output file, which only belongs at the start of that file """
+    return raw[3:3 + len(_MMAP_MAGIC)] == _MMAP_MAGIC and raw[:3] == _MMAP_HEADER[2:5]
+
+class Track:
+    """ A track of the trace, as declared by its descriptor """
+    def __init__(self, uuid : int, name : str, parent_uuid : int, kind : str):
+        self.uuid = uuid
+        self.name = name
+        self.parent_uuid = parent_uuid
+        # "process", "thread", "counter" or "track"
+        self.kind = kind
+
+    def __repr__(self):
+        return "Track({}, {!r}, parent={}, kind={!r})".format(self.uuid, self.name, self.parent_uuid, self.kind)
+
+class _SequenceState:
+    """ Incremental state of a packet sequence """
+    def __init__(self):
+        self.cleared = False
+        self.clear()
+
+    def clear(self):
+        self.event_names = {}
+        self.source_locations = set()
+        self.annotation_names = set()
+        self.string_values = set()
+        self.default_track = None
+        self.default_clock = None
+        # incremental clock id -> [value, unit multiplier, ns on base_clock at value 0, base clock id]
+        self.incremental_clocks = {}
+
+class TraceReader:
+    """ Streams the packets of a trace file.
+
+        reader = TraceReader("trace.perfetto-trace")
+        for packet, ts in reader:
+            ...
+
+    Each packet is a `TracePacket` message (the contents of compressed packets come out one by one).  ts is the
+    packet's timestamp in nanoseconds, with delta-encoded timestamps resolved, or None if it has none.  While a
+    packet is handled, the reader's state (tracks, event_name(), ...) includes everything up to that packet.
+    Problems found along the way (unknown iids, truncated files, ...) are collected in `errors`.
+    """
+    def __init__(self, filename : str):
+        self.filename = filename
+        # uuid -> Track
+        self.tracks = {}
+        self.errors = []
+        self.num_packets = 0
+        self._sequences = {}
+        # the raw form of the packet being handled (None for the packets of compressed_packets, which only come
+        # parsed), and whether it came out of a compressed packet
+        self._raw = None
+        self._compressed = False
+
+    def __iter__(self):
+        with open(self.filename, "rb") as f:
+            for raw in _raw_packets(f, self.errors):
+                packet = pb2.TracePacket.FromString(raw)
+                if packet.HasField("compressed_packets"):
+                    try:
+                        inner = zlib.decompress(packet.compressed_packets)
+                    except zlib.error as e:
+                        self.errors.append("packet {}: bad compressed_packets: {}".format(self.num_packets, e))
+                        continue
+                    for inner_packet in pb2.Trace.FromString(inner).packet:
+                        self._compressed = True
+                        yield self._handle(inner_packet, None)
+                else:
+                    self._compressed = False
+                    yield self._handle(packet, raw)
+
+    def _handle(self, packet, raw):
+        self.num_packets += 1
+        self._raw = raw
+        seq = self._sequence(packet)
+        if packet.sequence_flags & _SEQ_INCREMENTAL_STATE_CLEARED:
+            seq.clear()
+            seq.cleared = True
+        elif packet.sequence_flags & _SEQ_NEEDS_INCREMENTAL_STATE and not seq.cleared:
+            self._error(packet, "needs incremental state, but its sequence never cleared it")
+
+        if packet.HasField("clock_snapshot"):
+            self._clock_snapshot(seq, packet.clock_snapshot)
+        if packet.HasField("trace_packet_defaults"):
+            defaults = packet.trace_packet_defaults
+            if defaults.HasField("timestamp_clock_id"):
+                seq.default_clock = defaults.timestamp_clock_id
+            if defaults.track_event_defaults.HasField("track_uuid"):
+                seq.default_track = defaults.track_event_defaults.track_uuid
+        if packet.HasField("interned_data"):
+            interned = packet.interned_data
+            for e in interned.event_names:
+                seq.event_names[e.iid] = e.name
+            seq.source_locations.update(e.iid for e in interned.source_locations)
+            seq.annotation_names.update(e.iid for e in interned.debug_annotation_names)
+            seq.string_values.update(e.iid for e in interned.debug_annotation_string_values)
+        if packet.HasField("track_descriptor"):
+            self._track_descriptor(packet.track_descriptor)
+        if packet.HasField("track_event"):
+            self._check_iids(packet, seq)
+
+        ts = None
+        if packet.HasField("timestamp"):
+            ts = packet.timestamp
+            clock = packet.timestamp_clock_id if packet.HasField("timestamp_clock_id") else seq.default_clock
+            incremental = seq.incremental_clocks.get(clock)
+            if incremental is not None:
+                incremental[0] += ts
+                ts = incremental[2] + incremental[0] * incremental[1]
+        return packet, ts
+
+    def _sequence(self, packet):
+        seq_id = packet.trusted_packet_sequence_id
+        seq = self._sequences.get(seq_id)
+        if seq is None:
+            seq = self._sequences[seq_id] = _SequenceState()
+        return seq
+
+    def _clock_snapshot(self, seq, snapshot):
+        base = None
+        for clock in snapshot.clocks:
+            if not clock.is_incremental:
+                base = clock
+                break
+        for clock in snapshot.clocks:
+            if clock.is_incremental:
+                multiplier = clock.unit_multiplier_ns or 1
+                offset = base.timestamp - clock.timestamp * multiplier if base is not None else 0
+                seq.incremental_clocks[clock.clock_id] = [clock.timestamp, multiplier, offset,
+                                                          base.clock_id if base is not None else None]
+
+    def _track_descriptor(self, desc):
+        if desc.HasField("process"):
+            kind, name = "process", desc.name or desc.process.process_name
+        elif desc.HasField("thread"):
+            kind, name = "thread", desc.name or desc.thread.thread_name
+        elif desc.HasField("counter"):
+            kind, name = "counter", desc.name
+        else:
+            kind, name = "track", desc.name
+        self.tracks[desc.uuid] = Track(desc.uuid, name, desc.parent_uuid, kind)
+
+    def _check_iids(self, packet, seq):
+        ev = packet.track_event
+        if ev.HasField("name_iid") and ev.name_iid not in seq.event_names:
+            self._error(packet, "unknown event name iid {}".format(ev.name_iid))
+        if ev.HasField("source_location_iid") and ev.source_location_iid not in seq.source_locations:
+            self._error(packet, "unknown source location iid {}".format(ev.source_location_iid))
+        for a in ev.debug_annotations:
+            self._check_annotation(packet, seq, a)
+
+    def _check_annotation(self, packet, seq, a):
+        if a.HasField("name_iid") and a.name_iid not in seq.annotation_names:
+            self._error(packet, "unknown debug annotation name iid {}".format(a.name_iid))
+        if a.HasField("string_value_iid") and a.string_value_iid not in seq.string_values:
+            self._error(packet, "unknown debug annotation string value iid {}".format(a.string_value_iid))
+        for entry in a.dict_entries:
+            self._check_annotation(packet, seq, entry)
+        for entry in a.array_values:
+            self._check_annotation(packet, seq, entry)
+
+    def _error(self, packet, message):
+        self.errors.append("packet {} (sequence {}): {}".format(self.num_packets - 1, packet.trusted_packet_sequence_id, message))
+
+    def event_name(self, packet) -> str:
+        """ Name of a track event (None for slice ends, which have no name of their own) """
+        ev = packet.track_event
+        if ev.HasField("name"):
+            return ev.name
+        if ev.HasField("name_iid"):
+            return self._sequence(packet).event_names.get(ev.name_iid)
+        return None
+
+    def track_uuid(self, packet) -> int:
+        """ uuid of the track a track event is on """
+        ev = packet.track_event
+        if ev.HasField("track_uuid"):
+            return ev.track_uuid
+        return self._sequence(packet).default_track
+
+    def track_name(self, uuid : int) -> str:
+        track = self.tracks.get(uuid)
+        return None if track is None else track.name
+
+    def _absolute(self, packet, ts):
+        """ The packet with an absolute timestamp, if it has a delta-encoded one; serialized.  Used by filter_trace(). """
+        if ts is not None and not packet.HasField("timestamp_clock_id"):
+            seq = self._sequence(packet)
+            incremental = seq.incremental_clocks.get(seq.default_clock)
+            if incremental is not None and incremental[3] is not None:
+                packet = pb2.TracePacket.FromString(packet.SerializeToString())
+                packet.timestamp = ts
+                packet.timestamp_clock_id = incremental[3]
+                return packet.SerializeToString()
+        if self._compressed:
+            return packet.SerializeToString()
+        return self._raw
+
+class _Histogram:
+    """ Counts of durations in logarithmic buckets, 2**(1/16) (~4%) apart, for approximate percentiles in constant memory """
+    _BUCKETS_PER_DOUBLING = 16
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, value):
+        b = -1 if value <= 0 else int(math.log2(value) * self._BUCKETS_PER_DOUBLING)
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def percentile(self, p : float, count : int):
+        """ Approximate p-th percentile (0-100) of the count values added """
+        rank = max(1, math.ceil(count * p / 100))
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return 0 if b < 0 else int(2 ** ((b + 0.5) / self._BUCKETS_PER_DOUBLING))
+        return None
+
+class _SliceStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.histogram = _Histogram()
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+        self.histogram.add(duration)
+
+    def as_dict(self):
+        return {"count": self.count, "total_ns": self.total, "min_ns": self.min, "max_ns": self.max,
+                "p50_ns": self.histogram.percentile(50, self.count), "p99_ns": self.histogram.percentile(99, self.count)}
+
+class _CounterStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.last = value
+
+    def as_dict(self):
+        return {"count": self.count, "min": self.min, "max": self.max, "mean": self.total / self.count, "last": self.last}
+
+def summarize(filename : str) -> dict:
+    """ Read a trace and summarize it: per-name slice statistics (durations in ns; p50/p99 are approximate),
+    instant counts, counter statistics per counter track, and a validation report.  Returns a dict:
+
+        {"packets": ..., "track_events": ..., "first_ts": ..., "last_ts": ...,
+         "slices": {name: {"count", "total_ns", "min_ns", "max_ns", "p50_ns", "p99_ns"}},
+         "instants": {name: count},
+         "counters": {track name: {"count", "min", "max", "mean", "last"}},
+         "validation": {"ok": bool, "errors": [...], "unmatched_ends": ..., "unterminated_slices": ...,
+                        "undeclared_tracks": [uuid, ...]}}
+    """
+    reader = TraceReader(filename)
+    slices = {}
+    instants = {}
+    counters = {}
+    # track uuid -> stack of (name, begin ts)
+    open_slices = {}
+    used_tracks = set()
+    unmatched_ends = 0
+    num_events = 0
+    first_ts = last_ts = None
+
+    for packet, ts in reader:
+        if not packet.HasField("track_event"):
+            continue
+        num_events += 1
+        if ts is not None:
+            first_ts = ts if first_ts is None else min(first_ts, ts)
+            last_ts = ts if last_ts is None else max(last_ts, ts)
+        ev = packet.track_event
+        uuid = reader.track_uuid(packet)
+        used_tracks.add(uuid)
+        if ev.type == _TYPE_SLICE_BEGIN:
+            open_slices.setdefault(uuid, []).append((reader.event_name(packet), ts))
+        elif ev.type == _TYPE_SLICE_END:
+            stack = open_slices.get(uuid)
+            if not stack:
+                unmatched_ends += 1
+                continue
+            name, begin = stack.pop()
+            stats = slices.get(name)
+            if stats is None:
+                stats = slices[name] = _SliceStats()
+            stats.add(ts - begin)
+        elif ev.type == _TYPE_INSTANT:
+            name = reader.event_name(packet)
+            instants[name] = instants.get(name, 0) + 1
+        elif ev.type == _TYPE_COUNTER:
+            value = ev.double_counter_value if ev.HasField("double_counter_value") else ev.counter_value
+            stats = counters.get(uuid)
+            if stats is None:
+                stats = counters[uuid] = _CounterStats()
+            stats.add(value)
+
+    unterminated = sum(len(stack) for stack in open_slices.values())
+    undeclared = sorted(uuid for uuid in used_tracks if uuid not in reader.tracks)
+    errors = list(reader.errors)
+    if unmatched_ends:
+        errors.append("{} slice ends without a begin".format(unmatched_ends))
+    if unterminated:
+        errors.append("{} slices never end".format(unterminated))
+    if undeclared:
+        errors.append("{} tracks are used but never declared".format(len(undeclared)))
+
+    counter_stats = {}
+    for uuid, stats in counters.items():
+        name = reader.track_name(uuid)
+        if name is None or name in counter_stats:
+            name = "{} ({})".format(name, uuid)
+        counter_stats[name] = stats.as_dict()
+
+    return {
+        "packets": reader.num_packets,
+        "track_events": num_events,
+        "first_ts": first_ts,
+        "last_ts": last_ts,
+        "slices": {name: stats.as_dict() for name, stats in slices.items()},
+        "instants": instants,
+        "counters": counter_stats,
+        "validation": {
+            "ok": not errors,
+            "errors": errors,
+            "unmatched_ends": unmatched_ends,
+            "unterminated_slices": unterminated,
+            "undeclared_tracks": undeclared,
+        },
+    }
+
+def filter_trace(src : str, dst : str, start : int = None, end : int = None, tracks = None) -> dict:
+    """ Copy the track events of src that fall into [start, end] (ns, as in summarize()'s first_ts/last_ts) and are
+    on one of tracks (glob patterns matched against track names; a match includes the track's descendants) to dst.
+
+    Everything else the remaining events depend on is kept: track descriptors, clock snapshots, packet defaults, and
+    the interned data of dropped events.  A slice is kept if its begin is kept, including its end.  Perf samples are
+    kept by time, but dropped if tracks is given.  Delta-encoded timestamps are rewritten as absolute ones, and
+    compressed packets come out uncompressed.  Returns {"packets_in": ..., "packets_out": ..., "errors": ...}, errors
+    being the problems found reading src (see TraceReader.errors).
+    """
+    if isinstance(tracks, str):
+        tracks = [tracks]
+    reader = TraceReader(src)
+    selected = set()
+    # track uuid -> stack of whether the open slices were kept
+    open_slices = {}
+    packets_out = 0
+
+    def track_selected(uuid):
+        if uuid in selected:
+            return True
+        track = reader.tracks.get(uuid)
+        if track is None:
+            return False
+        if any(fnmatch.fnmatchcase(track.name or "", t) for t in tracks) or (track.parent_uuid and track_selected(track.parent_uuid)):
+            selected.add(uuid)
+            return True
+        return False
+
+    with open(dst, "wb") as out:
+        for packet, ts in reader:
+            keep = True
+            # (an mmap_output header is never compressed)
+            if not reader._compressed and _is_mmap_header(reader._raw):
+                continue
+            if packet.HasField("track_event"):
+                uuid = reader.track_uuid(packet)
+                ev = packet.track_event
+                if ev.type == _TYPE_SLICE_END:
+                    stack = open_slices.get(uuid)
+                    keep = stack.pop() if stack else False
+                else:
+                    keep = ((start is None or ts is None or ts >= start) and (end is None or ts is None or ts <= end)
+                            and (tracks is None or track_selected(uuid)))
+                    if ev.type == _TYPE_SLICE_BEGIN:
+                        open_slices.setdefault(uuid, []).append(keep)
+            elif packet.HasField("perf_sample"):
+                keep = (tracks is None and (start is None or ts is None or ts >= start) and (end is None or ts is None or ts <= end))
+
+            if keep:
+                data = reader._absolute(packet, ts)
+            else:
+                # what later packets may depend on stays
+                stub = pb2.TracePacket()
+                stub.CopyFrom(packet)
+                for field in ("track_event", "perf_sample", "timestamp", "timestamp_clock_id"):
+                    stub.ClearField(field)
+                if not (stub.HasField("interned_data") or stub.HasField("trace_packet_defaults") or
+                        stub.HasField("clock_snapshot") or stub.sequence_flags & _SEQ_INCREMENTAL_STATE_CLEARED):
+                    continue
+                data = stub.SerializeToString()
+            out.write(bytes((_K_PACKET,)))
+            out.write(_encode_varint(len(data)))
+            out.write(data)
+            packets_out += 1
+    return {"packets_in": reader.num_packets, "packets_out": packets_out, "errors": reader.errors}
+
+class _Limited:
+    """ The first limit bytes of a file """
+    def __init__(self, f, limit : int):
+        self._f = f
+        self._left = limit
+
+    def read(self, size):
+        data = self._f.read(min(size, self._left))
+        self._left -= len(data)
+        return data
+
+def repair_trace(filename : str) -> dict:
+    """ Make a trace that was cut short (e.g., its process was killed while writing it) loadable again, in place,
+    by cutting it back to its last whole packet.  Files written with mmap_output=True record how much of them was
+    written; anything after that goes as well.  Returns {"bytes_before": ..., "bytes_after": ..., "packets": ...}.
+    """
+    with open(filename, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        limit = _mmap_written_length(f.read(len(_MMAP_HEADER)))
+        if limit is None or limit > size:
+            limit = size
+        f.seek(0)
+        end = 0
+        packets = 0
+        for raw in _raw_packets(_Limited(f, limit), []):
+            end += 1 + len(_encode_varint(len(raw))) + len(raw)
+            packets += 1
+        if end < size:
+            f.truncate(end)
+    return {"bytes_before": size, "bytes_after": end, "packets": packets}
+
+def _encode_varint(v):
+    out = bytearray()
+    while v > 0x7f:
+        out.append((v & 0x7f) | 0x80)
+        v >>= 7
+    out.append(v)
+    return bytes(out)
@@ -0,0 +1,78 @@
+import os
+import sys
+import threading
+import time
+
+from ._clock import _now
+
+# threads of our own that are not worth sampling
+_skipped_threads = ("tg4perfetto-writer", "tg4perfetto-sampler", "tg4perfetto-metrics", "tg4perfetto-dump")
+
+class _Sampler:
+    """ Sampling profiler: a background thread snapshots every thread's Python stack with sys._current_frames()
+    `rate` times per second and writes the stacks to the trace as perf samples, so that the UI can show
+    flamegraphs next to the traced slices.
+
+    Samples are taken on the wall clock: threads that are blocked (e.g., waiting on a lock or on I/O) are
+    sampled as well, in the function they are blocked in.  While other threads keep the GIL busy, the
+    sampler only gets to run once per switch interval (sys.getswitchinterval(), 5 ms by default), which
+    caps the effective rate.
+    """
+    def __init__(self, tracefile, rate : float = 100, max_depth : int = 128):
+        if rate <= 0:
+            raise ValueError("sampling rate must be positive")
+        self._tracefile = tracefile
+        self._interval = 1.0 / rate
+        self.max_depth = max_depth
+        # thread id -> track uuid of the sampled threads
+        self._thread_uuids = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="tg4perfetto-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """ Stop sampling and wait for the sampler thread to exit """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        tracefile = self._tracefile
+        seq = tracefile._thread_sequence()
+        pid = os.getpid()
+        me = threading.get_ident()
+        next_time = time.perf_counter()
+        while not self._stop.is_set():
+            threads = {t.ident: t for t in threading.enumerate()}
+            ts = _now()
+            alive = set()
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                if ident == me or thread is None or thread.name in _skipped_threads:
+                    continue
+                tid = getattr(thread, "native_id", ident)
+                alive.add(tid)
+                if tid not in self._thread_uuids:
+                    self._thread_uuids[tid] = tracefile._thread_packet(pid, tid, thread.name, seq)
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                seq.stack_sample(ts, pid, tid, tuple(stack))
+            finished = [tid for tid in self._thread_uuids if tid not in alive]
+            if finished:
+                # their samples go out before their tracks are retired
+                if len(seq) > 0:
+                    tracefile._submit(seq)
+                tracefile._retire_tracks([self._thread_uuids.pop(tid) for tid in finished])
+            tracefile._flush_if_necessary(seq)
+
+            # keep to the schedule, but don't try to catch up on samples missed while the process was busy
+            next_time += self._interval
+            delay = next_time - time.perf_counter()
+            if delay < 0:
+                next_time -= delay
+                delay = 0
+            self._stop.wait(delay)
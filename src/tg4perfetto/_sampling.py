@@ -0,0 +1,91 @@
+import itertools
+import threading
+import weakref
+
+from ._clock import _now
+
+# every sampling object, whose locks have to be replaced in a forked child (see _profile._after_fork_in_child())
+_samplings = weakref.WeakSet()
+
+class sampling:
+    """ Which events to record, to bound the cost of tracing hot code.
+
+        track("io", sampling=sampling(every=100))                      # 1 in 100 slices and instants
+        @trace_func(sampling(probability={"parse": 0.01, "*": 0.1}))   # per-name probability ("*": other names)
+        @trace_func(sampling(probability=0.05, head=True))             # 5% of calls, with everything inside them
+        track("rpc", sampling=sampling(max_rate=1000))                 # at most ~1000 events/sec
+
+    every: record one event in every N.
+    probability: record each event with this probability; or a dict of event name -> probability, where "*" is
+        the probability of the names not in the dict (1 if missing).
+    head: take the decision once, at the outermost slice, and apply it to every slice and instant nested inside it
+        (on any track, and across awaits): sampled traces are complete trees, and dropped ones cost next to nothing.
+    max_rate: a rate limiter on top of the above: at most max_rate events per second, in bursts of up to burst
+        events (default: max_rate).  Below the limit every event passes.  The number of events it dropped is
+        recorded in a counter track named "<name> dropped", where name defaults to the track's name (or to the
+        event's name, for trace_func() and instant()).
+
+    A slice is one event; its end is recorded if and only if its begin was.  The state (the count of `every`, the
+    rate limiter's budget) belongs to the sampling object, so tracks that share one share the budget.
+    """
+    def __init__(self, every : int = None, probability = None, head : bool = False, max_rate : float = None,
+                 burst : float = None, name : str = None):
+        if every is not None and every < 1:
+            raise ValueError("every must be at least 1")
+        if probability is not None:
+            for p in (probability.values() if isinstance(probability, dict) else [probability]):
+                if not 0 <= p <= 1:
+                    raise ValueError("probability must be between 0 and 1")
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError("max_rate must be positive")
+        self.every = every
+        self.probability = probability
+        if probability is not None:
+            # random is only imported by the samplings that need it
+            import random
+            self._random = random.random
+        self.head = head
+        self.max_rate = max_rate
+        self.burst = max(1.0, float(max_rate if burst is None else burst)) if max_rate is not None else None
+        self.name = name
+        # number of events the rate limiter dropped
+        self.dropped = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        _samplings.add(self)
+        self._tokens = self.burst
+        self._last = None
+        self._reported = 0
+
+    def _sampled(self, name) -> bool:
+        """ The every/probability decision for an event named name """
+        if self.every is not None and next(self._counter) % self.every:
+            return False
+        p = self.probability
+        if p is not None:
+            if isinstance(p, dict):
+                p = p.get(name, p.get("*", 1.0))
+            if p < 1 and self._random() >= p:
+                return False
+        return True
+
+    def _admit(self) -> bool:
+        """ The rate limiter's decision: a token bucket that refills at max_rate """
+        with self._lock:
+            now = _now()
+            if self._last is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.max_rate / 1e9)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.dropped += 1
+            return False
+
+    def _take_dropped(self):
+        """ The number of dropped events if it changed since the last call, else None """
+        with self._lock:
+            if self.dropped == self._reported:
+                return None
+            self._reported = self.dropped
+            return self.dropped
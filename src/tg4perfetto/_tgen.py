@@ -10,6 +10,12 @@ class CounterTrack:
         self._parent._track_count(self._uuid, ts, value)
         return self
 
+    def count_many(self, ts, values):
+        """ Add many count values at once.  ts and values are equal-length integer arrays (NumPy arrays, or any
+        sequence).  With NumPy installed, the whole batch is encoded in one vectorized pass. """
+        self._parent._track_count_many(self._uuid, ts, values)
+        return self
+
 class NormalTrack:
     def __init__(self, name, parent, uuid):
         self._parent = parent
@@ -30,6 +36,13 @@ class NormalTrack:
         self._parent._track_instant(self._uuid, ts, annotation, kwargs, flow)
         return self
 
+    def slices_many(self, starts, ends, names):
+        """ Record many slices at once.  starts and ends are equal-length integer arrays (NumPy arrays, or any
+        sequence); names is either a single name or one name per slice.  With NumPy installed, the whole batch
+        is encoded in one vectorized pass. """
+        self._parent._track_slices_many(self._uuid, starts, ends, names)
+        return self
+
 class GroupTrack:
     def __init__(self, name, parent, uuid):
         self._parent = parent
@@ -49,9 +62,10 @@ class Group:
         """ Create a normal track for this track."""
         return self._parent._create_track(self._uuid, track_name, 0)
 
-    def create_counter_track(self, track_name : str) -> CounterTrack:
-        """ Create a counter track.  Counter tracks can be used for recording int values."""
-        return self._parent._create_track(self._uuid, track_name, 1)
+    def create_counter_track(self, track_name : str, incremental : bool = False) -> CounterTrack:
+        """ Create a counter track.  Counter tracks can be used for recording int or float values.
+        The values of an incremental counter track are deltas, which the UI adds up. """
+        return self._parent._create_track(self._uuid, track_name, 3 if incremental else 1)
 
     def create_group(self, track_name : str) -> GroupTrack:
         """ Create a group track.  Group tracks can be used for grouping normal tracks."""
@@ -69,11 +83,15 @@ class Group:
         """ Record an instant event. """
         self._parent._track_instant(self._uuid, ts, annotation, kwargs, flow)
 
+    def slices_many(self, starts, ends, names):
+        """ Record many slices at once.  See NormalTrack.slices_many(). """
+        self._parent._track_slices_many(self._uuid, starts, ends, names)
+
 
 class TraceGenerator(_BaseTraceGenerator):
-    def __init__(self, filename : str):
-        """ Create a trace """
-        super().__init__(filename)
+    def __init__(self, filename : str, engine : str = "wire", **kwargs):
+        """ Create a trace.  See _BaseTraceGenerator for the options (engine, async_flush, ...). """
+        super().__init__(filename, engine, **kwargs)
         self.__pid__ = 1
 
     def create_group(self, process_name : str, track_name : str = None):
@@ -92,16 +110,16 @@ class TraceGenerator(_BaseTraceGenerator):
 
         if ttype == 0:
             return NormalTrack(track_name, self, uuid)
-        elif ttype == 1:
+        elif ttype == 1 or ttype == 3:
             return CounterTrack(track_name, self, uuid)
         elif ttype == 2:
             return GroupTrack(track_name, self, uuid)
         else:
             assert False
 
-    def create_counter_track(self, track_name : str):
-        """ Create a global counter track """
-        return self._create_track(0, track_name, 1)
+    def create_counter_track(self, track_name : str, incremental : bool = False):
+        """ Create a global counter track (see Group.create_counter_track()) """
+        return self._create_track(0, track_name, 3 if incremental else 1)
 
 
 
@@ -0,0 +1,777 @@
+import numbers
+import struct
+import threading
+import weakref
+import zlib
+
+from ._annotations import (_kind, _dataclass_fields, _ndarray_summary, _bytes_summary, _KIND_STR, _KIND_BOOL, _KIND_INT,
+                           _KIND_FLOAT, _KIND_DICT, _KIND_LIST, _KIND_BYTES, _KIND_ENUM, _KIND_DATACLASS, _KIND_NDARRAY,
+                           _KIND_NPSCALAR, _KIND_OTHER)
+
+# Direct protobuf wire-format encoding of perfetto trace packets.
+#
+# Building every packet through the pb2 message API costs tens of microseconds per event.  The functions
+# here write the same bytes directly: field keys are precomputed, and every packet is appended to a single
+# bytearray in its final serialized form (already wrapped as a `Trace.packet` entry), so flushing is a plain
+# write.  Fields are emitted in field-number order, which is what the pb2 serializer does, so the output is
+# byte-identical to the pb2 engine.
+
+_VARINT = 0
+_FIXED64 = 1
+_LEN = 2
+
+_ONE_BYTE = [bytes((i,)) for i in range(0x80)]
+
+def _varint(v):
+    """ Encode an integer as a protobuf varint.  Negative numbers are encoded as 64-bit two's complement. """
+    if 0 <= v < 0x80:
+        return _ONE_BYTE[v]
+    if v < 0:
+        v &= 0xFFFFFFFFFFFFFFFF
+    if v < 0x4000:
+        return bytes(((v & 0x7f) | 0x80, v >> 7))
+    if v < 0x200000:
+        return bytes(((v & 0x7f) | 0x80, ((v >> 7) & 0x7f) | 0x80, v >> 14))
+    out = bytearray()
+    while v > 0x7f:
+        out.append((v & 0x7f) | 0x80)
+        v >>= 7
+    out.append(v)
+    return bytes(out)
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+def _f_varint(field, v):
+    return _key(field, _VARINT) + _varint(v)
+
+def _f_bytes(field, b):
+    return _key(field, _LEN) + _varint(len(b)) + b
+
+def _f_str(field, s):
+    return _f_bytes(field, s.encode())
+
+def _utf8_len(s):
+    return len(s) if s.isascii() else len(s.encode())
+
+def _truncate_utf8(s, n):
+    """ The longest prefix of s that is at most n bytes in UTF-8 """
+    if s.isascii():
+        return s[:n]
+    # the slice may end inside a character; drop the partial one
+    return s.encode()[:n].decode(errors="ignore")
+
+_pack_double = struct.Struct("<d").pack
+
+def _f_double(field, v):
+    return _key(field, _FIXED64) + _pack_double(v)
+
+def _counter_value(v):
+    """ A counter value as an int (written as `counter_value`) or a float (`double_counter_value`).  Integers of
+    any kind, NumPy's included, are ints; every other number, np.float32 included, is a float. """
+    if type(v) is int or type(v) is float:
+        return v
+    return int(v) if isinstance(v, numbers.Integral) else float(v)
+
+# Trace
+_K_PACKET = _key(1, _LEN)
+
+# TracePacket
+_K_CLOCK_SNAPSHOT = _key(6, _LEN)
+_K_TIMESTAMP = _key(8, _VARINT)
+_K_TRACK_EVENT = _key(11, _LEN)
+_K_INTERNED_DATA = _key(12, _LEN)
+_K_TRACE_CONFIG = _key(33, _LEN)
+_K_TRACE_PACKET_DEFAULTS = _key(59, _LEN)
+_K_TRACK_DESCRIPTOR = _key(60, _LEN)
+_K_PERF_SAMPLE = _key(66, _LEN)
+_SEQ_INCREMENTAL_STATE_CLEARED = _f_varint(13, 1)
+_SEQ_NEEDS_INCREMENTAL_STATE = _f_varint(13, 2)
+
+# TrackEvent
+_CATEGORY_IID_1 = _f_varint(3, 1)
+_K_DEBUG_ANNOTATIONS = _key(4, _LEN)
+_TYPE_SLICE_BEGIN = _f_varint(9, 1)
+_TYPE_SLICE_END = _f_varint(9, 2)
+_TYPE_INSTANT = _f_varint(9, 3)
+_TYPE_COUNTER = _f_varint(9, 4)
+_K_NAME_IID = _key(10, _VARINT)
+_K_TRACK_UUID = _key(11, _VARINT)
+_K_COUNTER_VALUE = _key(30, _VARINT)
+_K_DOUBLE_COUNTER_VALUE = _key(44, _FIXED64)
+_K_SOURCE_LOCATION_IID = _key(34, _VARINT)
+_K_FLOW_IDS = _key(36, _VARINT)
+
+# DebugAnnotation
+_K_DA_NAME_IID = _key(1, _VARINT)
+_K_DA_BOOL = _key(2, _VARINT)
+_K_DA_INT = _key(4, _VARINT)
+_K_DA_DOUBLE = _key(5, _FIXED64)
+_K_DA_STRING = _key(6, _LEN)
+_K_DA_DICT_ENTRIES = _key(11, _LEN)
+_K_DA_ARRAY_VALUES = _key(12, _LEN)
+_K_DA_STRING_VALUE_IID = _key(17, _VARINT)
+_DA_EMPTY = _f_str(6, "[empty]")
+
+# InternedData
+_K_EVENT_NAMES = _key(2, _LEN)
+_K_DEBUG_ANNOTATION_NAMES = _key(3, _LEN)
+_K_SOURCE_LOCATIONS = _key(4, _LEN)
+_K_FUNCTION_NAMES = _key(5, _LEN)
+_K_FRAMES = _key(6, _LEN)
+_K_CALLSTACKS = _key(7, _LEN)
+_K_MAPPING_PATHS = _key(17, _LEN)
+_K_MAPPINGS = _key(19, _LEN)
+_K_DEBUG_ANNOTATION_STRING_VALUES = _key(29, _LEN)
+_K_FRAME_IDS = _key(2, _VARINT)
+
+def _function_name(code):
+    return getattr(code, "co_qualname", code.co_name)
+
+def _field_number_order(entry):
+    # the first byte of an entry's key orders the InternedData fields we use
+    return entry[0]
+
+def _flows(flow):
+    return b"".join([_K_FLOW_IDS + _varint(x) for x in flow])
+
+def _packet_spans(data):
+    """ Yield (start, end) of each packet entry in a serialized `Trace` body """
+    pos = 0
+    n = len(data)
+    while pos < n:
+        # key, varint length, packet
+        p = pos + 1
+        length = 0
+        shift = 0
+        while True:
+            b = data[p]
+            p += 1
+            length |= (b & 0x7f) << shift
+            shift += 7
+            if b < 0x80:
+                break
+        yield pos, p + length
+        pos = p + length
+
+# perfetto itself compresses packets in batches of about this size
+_COMPRESSED_BATCH_SIZE = 512 * 1024
+
+def _compress_packets(data, level):
+    """ Deflate a serialized `Trace` body into `compressed_packets` packets, splitting at packet boundaries """
+    out = []
+    start = 0
+    for pos, end in _packet_spans(data):
+        if end - start > _COMPRESSED_BATCH_SIZE and pos > start:
+            out.append(data[start:pos])
+            start = pos
+    out.append(data[start:])
+    result = []
+    for batch in out:
+        pkt = _f_bytes(50, zlib.compress(batch, level))
+        result.append(_K_PACKET + _varint(len(pkt)) + pkt)
+    return b"".join(result)
+
+# Vectorized encoding for the bulk APIs.  Each packet of a batch is laid out as one row of a byte matrix,
+# with a mask marking which bytes of the row are used; `matrix[mask]` then gives the serialized packets.
+
+_np = None
+
+def _numpy():
+    """ The numpy module, or None if it isn't installed.  Imported on first use (only the bulk APIs need it). """
+    global _np
+    if _np is None:
+        try:
+            import numpy
+        except ImportError:
+            _np = False
+        else:
+            _np = numpy
+    return _np or None
+
+def _np_varints(values):
+    """ Varint-encode an integer array.  Returns (N x 10 byte matrix, N x 10 mask, encoded lengths). """
+    np = _np
+    v = np.asarray(values)
+    if v.dtype.kind == "u":
+        v = v.astype(np.uint64)
+    elif v.dtype.kind in "ib":
+        v = v.astype(np.int64).view(np.uint64)
+    else:
+        raise TypeError("expected an array of integers, got {}".format(v.dtype))
+    v = v.reshape(-1, 1)
+    lengths = 1 + (v >= np.array([1 << (7 * i) for i in range(1, 10)], dtype=np.uint64)).sum(axis=1)
+    cols = np.arange(10)
+    b = ((v >> np.arange(0, 70, 7, dtype=np.uint64)) & np.uint64(0x7f)).astype(np.uint8)
+    b |= np.where(cols < (lengths - 1)[:, None], 0x80, 0).astype(np.uint8)
+    return b, cols < lengths[:, None], lengths
+
+def _np_deltas(ts, last):
+    """ Timestamps as deltas to the previous one (the first one's to last), or None if they ever go backwards """
+    np = _np
+    deltas = np.diff(np.asarray(ts).reshape(-1).astype(np.int64), prepend=np.int64(last))
+    if (deltas < 0).any():
+        return None
+    return deltas
+
+def _np_rows(num_rows, parts):
+    """ Lay out per-row segments side by side.  A part is either constant bytes, or a (matrix, mask) pair. """
+    np = _np
+    mats = []
+    masks = []
+    for part in parts:
+        if isinstance(part, bytes):
+            mats.append(np.broadcast_to(np.frombuffer(part, np.uint8), (num_rows, len(part))))
+            masks.append(np.ones((num_rows, len(part)), dtype=bool))
+        else:
+            mats.append(part[0])
+            masks.append(part[1])
+    return np.hstack(mats), np.hstack(masks)
+
+def _np_length(lengths):
+    """ A one-byte length column (every packet of a batch is shorter than 128 bytes) """
+    np = _np
+    assert lengths.max() < 0x80
+    return lengths.astype(np.uint8).reshape(-1, 1), np.ones((len(lengths), 1), dtype=bool)
+
+class _WireSequence:
+    """ A packet sequence encoded directly into protobuf wire format. """
+    def __init__(self, parent, seq_id):
+        # a proxy: the generator holds its sequences, and is flushed when it is dropped
+        self._parent = weakref.proxy(parent)
+        self.seq_id = seq_id
+        # how many times reset() was called: incremental counters start over after each
+        self.resets = 0
+        self.interned_data = {}
+        self.interned_source = {}
+        # sampled stacks: code object -> frame iid, file name -> mapping iid, tuple of code objects -> callstack iid
+        self.interned_frames = {}
+        self.interned_mappings = {}
+        self.interned_callstacks = {}
+        # debug annotation names and string values
+        self.interned_annotation_names = {}
+        self.interned_strings = {}
+        self._tpsid = _f_varint(10, seq_id)
+        # Held while a packet is added, and while the sequence is drained and restarted, which flush() and close()
+        # do from other threads.  Reentrant, as restarting the sequence adds packets.
+        self.lock = threading.RLock()
+        self._buf = bytearray()
+        self._num_packets = 0
+        # track descriptors in the pending packets, as (method, args)
+        self.tracks = []
+        # encoded `track_uuid`, `name_iid`, `source_location_iid`, annotation `name_iid` and `string_value_iid` fields
+        self._track_uuids = {}
+        self._name_iids = {}
+        self._source_iids = {}
+        self._annotation_name_iids = {}
+        self._string_iids = {}
+        # delta-encoded timestamps (see packet_defaults()): the previous packet's timestamp, and the encoded
+        # `timestamp_clock_id` field of packets that have to fall back to an absolute timestamp
+        self._incremental = False
+        self.last_timestamp = 0
+        self._absolute_clock = b""
+
+    def __len__(self):
+        return self._num_packets
+
+    def drain(self):
+        """ Swap out the packets accumulated so far.  Pass the result to serialize() to get the bytes. """
+        with self.lock:
+            data = self._buf
+            self._buf = bytearray()
+            self._num_packets = 0
+            self.tracks = []
+            return data
+
+    @staticmethod
+    def serialize(chunk) -> bytes:
+        """ Serialized form (a `Trace` message body) of a drained chunk. """
+        return chunk
+
+    def peek(self) -> bytes:
+        """ Serialized copy of the pending packets, without draining them """
+        with self.lock:
+            return bytes(self._buf)
+
+    def reset(self):
+        """ Forget all interned data.  The next packet on the sequence must clear the incremental state. """
+        with self.lock:
+            self.resets += 1
+            self.interned_data = {}
+            self.interned_source = {}
+            self.interned_frames = {}
+            self.interned_mappings = {}
+            self.interned_callstacks = {}
+            self.interned_annotation_names = {}
+            self.interned_strings = {}
+            self._name_iids = {}
+            self._source_iids = {}
+            self._annotation_name_iids = {}
+            self._string_iids = {}
+
+    def _append(self, pkt):
+        self._buf += _K_PACKET + _varint(len(pkt)) + pkt
+        self._num_packets += 1
+
+    def _track_uuid(self, uuid):
+        u = self._track_uuids[uuid] = _K_TRACK_UUID + _varint(uuid)
+        return u
+
+    def clock_snapshot(self, clocks, primary_trace_clock):
+        with self.lock:
+            body = b"".join([_f_bytes(1, _f_varint(1, clock_id) + _f_varint(2, ts)) for clock_id, ts in clocks])
+            body += _f_varint(2, primary_trace_clock)
+            self._append(_K_CLOCK_SNAPSHOT + _varint(len(body)) + body + self._tpsid)
+
+    def trace_config(self, buffer_size_kb, data_source_name):
+        with self.lock:
+            body = _f_bytes(1, _f_varint(1, buffer_size_kb)) + _f_bytes(2, _f_bytes(1, _f_str(1, data_source_name)))
+            self._append(self._tpsid + _K_TRACE_CONFIG + _varint(len(body)) + body)
+
+    def packet_defaults(self, track_uuid, timestamp_clock_id, incremental_base = None):
+        """ Start (or restart) the sequence: clear the incremental state and set the packet defaults.
+
+        With incremental_base = (clock_id, ts), timestamp_clock_id is an incremental clock that reads ts (on clock_id)
+        here, and every packet's timestamp is the delta to the previous one's, which takes a byte or two instead of
+        up to ten.  A timestamp earlier than the previous one is written as is, on clock_id.
+        """
+        with self.lock:
+            body = _f_bytes(11, _f_varint(11, track_uuid)) + _f_varint(58, timestamp_clock_id)
+            pkt = self._tpsid + _SEQ_INCREMENTAL_STATE_CLEARED + _K_TRACE_PACKET_DEFAULTS + _varint(len(body)) + body
+            self._incremental = incremental_base is not None
+            if self._incremental:
+                clock_id, ts = incremental_base
+                snapshot = (_f_bytes(1, _f_varint(1, clock_id) + _f_varint(2, ts)) +
+                            _f_bytes(1, _f_varint(1, timestamp_clock_id) + _f_varint(2, ts) + _f_varint(3, 1)))
+                pkt = _K_CLOCK_SNAPSHOT + _varint(len(snapshot)) + snapshot + pkt
+                self.last_timestamp = ts
+                self._absolute_clock = _f_varint(58, clock_id)
+            self._append(pkt)
+
+    def _track_descriptor(self, body):
+        self._append(_K_TIMESTAMP + b"\x00" + self._tpsid + _SEQ_NEEDS_INCREMENTAL_STATE + _K_TRACK_DESCRIPTOR + _varint(len(body)) + body)
+
+    def process_track(self, uuid, pid, process_name, track_name):
+        with self.lock:
+            self.tracks.append(("process_track", (uuid, pid, process_name, track_name)))
+            process = _f_varint(1, pid) + _f_str(6, process_name)
+            self._track_descriptor(_f_varint(1, uuid) + _f_str(2, track_name) + _f_bytes(3, process))
+
+    def child_track(self, uuid, parent_uuid, name, track_type):
+        with self.lock:
+            self.tracks.append(("child_track", (uuid, parent_uuid, name, track_type)))
+            body = _f_varint(1, uuid) + _f_str(2, name)
+            if parent_uuid != 0:
+                body += _f_varint(5, parent_uuid)
+            if track_type == 1:
+                body += _f_bytes(8, _f_str(2, "dummy"))
+            elif track_type == 3:
+                # incremental counter: each value is added to the previous ones
+                body += _f_bytes(8, _f_str(2, "dummy") + _f_varint(5, 1))
+            self._track_descriptor(body)
+
+    def thread_track(self, uuid, pid, tid, thread_name):
+        with self.lock:
+            self.tracks.append(("thread_track", (uuid, pid, tid, thread_name)))
+            thread = _f_varint(1, pid) + _f_varint(2, tid) + _f_str(5, thread_name)
+            self._track_descriptor(_f_varint(1, uuid) + _f_bytes(4, thread))
+
+    def _intern_callstack(self, stack):
+        """ Intern a callstack and its new frames; returns (callstack iid, encoded `InternedData` entries) """
+        names = []
+        frames = []
+        paths = []
+        mappings = []
+        frame_ids = []
+        for code in stack:
+            fid = self.interned_frames.get(code)
+            if fid is None:
+                file = code.co_filename
+                mid = self.interned_mappings.get(file)
+                if mid is None:
+                    # one mapping per source file; its path string shares the mapping's iid
+                    mid = self.interned_mappings[file] = len(self.interned_mappings) + 1
+                    paths.append(_f_bytes(17, _f_varint(1, mid) + _f_str(2, file)))
+                    mappings.append(_f_bytes(19, _f_varint(1, mid) + _f_varint(7, mid)))
+                # likewise, each frame gets its own function name string
+                fid = self.interned_frames[code] = len(self.interned_frames) + 1
+                names.append(_f_bytes(5, _f_varint(1, fid) + _f_str(2, _function_name(code))))
+                frames.append(_f_bytes(6, _f_varint(1, fid) + _f_varint(2, fid) + _f_varint(3, mid) + _f_varint(4, code.co_firstlineno)))
+            frame_ids.append(fid)
+        iid = self.interned_callstacks[stack] = len(self.interned_callstacks) + 1
+        callstack = _f_varint(1, iid) + b"".join([_K_FRAME_IDS + _varint(fid) for fid in frame_ids])
+        return iid, b"".join(names + frames + [_f_bytes(7, callstack)] + paths + mappings)
+
+    def stack_sample(self, ts, pid, tid, stack):
+        """ A sampled callstack of thread tid.  stack is a tuple of code objects, outermost first. """
+        with self.lock:
+            iid = self.interned_callstacks.get(stack)
+            if iid is None:
+                iid, interned = self._intern_callstack(stack)
+                interned = _K_INTERNED_DATA + _varint(len(interned)) + interned
+            else:
+                interned = b""
+            sample = _f_varint(2, pid) + _f_varint(3, tid) + _f_varint(4, iid)
+            ts, flags = self._timestamp(ts)
+            self._append(b"".join((_K_TIMESTAMP, _varint(ts), self._tpsid, interned, flags,
+                                   _K_PERF_SAMPLE, _varint(len(sample)), sample)))
+
+    def _get_iid_for(self, interned, name):
+        """ Intern an event name; returns the encoded `name_iid` field """
+        iid = len(self.interned_data) + 1
+        self.interned_data[name] = iid
+        ev = _f_varint(1, iid) + _f_str(2, name)
+        interned.append(_K_EVENT_NAMES + _varint(len(ev)) + ev)
+        f = self._name_iids[name] = _K_NAME_IID + _varint(iid)
+        return f
+
+    def _get_source_iid_for(self, interned, caller):
+        """ Intern a (file, line, name) source location; returns the encoded `source_location_iid` field """
+        file,line,name = caller
+        iid = len(self.interned_source) + 1
+        self.interned_source[(file, name, line)] = iid
+        loc = _f_varint(1, iid) + _f_str(2, file) + _f_str(3, name) + _f_varint(4, line)
+        interned.append(_K_SOURCE_LOCATIONS + _varint(len(loc)) + loc)
+        f = self._source_iids[caller] = _K_SOURCE_LOCATION_IID + _varint(iid)
+        return f
+
+    def _get_annotation_name_iid_for(self, interned, name):
+        """ Intern a debug annotation name; returns the encoded `name_iid` field """
+        iid = len(self.interned_annotation_names) + 1
+        self.interned_annotation_names[name] = iid
+        n = _f_varint(1, iid) + _f_str(2, name)
+        interned.append(_K_DEBUG_ANNOTATION_NAMES + _varint(len(n)) + n)
+        f = self._annotation_name_iids[name] = _K_DA_NAME_IID + _varint(iid)
+        return f
+
+    def _string_value(self, interned, v, budget = None):
+        """ Encode a string value as (fields before dict/array entries, fields after them) of a DebugAnnotation.
+
+        New strings are charged to budget (see _annotation_value) by their UTF-8 length; one longer than what is
+        left is truncated.
+        """
+        f = self._string_iids.get(v)
+        if f is not None:
+            return b"", f
+        if budget is not None:
+            n = _utf8_len(v)
+            if n > budget[1]:
+                v = _truncate_utf8(v, max(budget[1], 0)) + "..."
+                budget[1] = 0
+                return _f_str(6, v), b""
+            budget[1] -= n
+        if len(self.interned_strings) >= self._parent.max_interned_strings:
+            # the table is full; the remaining (probably unique) strings are written inline
+            return _f_str(6, v), b""
+        iid = len(self.interned_strings) + 1
+        self.interned_strings[v] = iid
+        entry = _f_varint(1, iid) + _f_str(2, v)
+        interned.append(_K_DEBUG_ANNOTATION_STRING_VALUES + _varint(len(entry)) + entry)
+        f = self._string_iids[v] = _K_DA_STRING_VALUE_IID + _varint(iid)
+        return b"", f
+
+    def _annotation_value(self, interned, v, budget):
+        """ Encode a value as (fields before dict/array entries, fields after them) of a DebugAnnotation.
+
+        budget is [nodes, bytes] left for the event: every value takes a node and new strings their UTF-8
+        length.  Containers stop at the first entry that finds the budget spent.
+        """
+        budget[0] -= 1
+        t = type(v)
+        if t is str:
+            f = self._string_iids.get(v)
+            if f is not None:
+                return b"", f
+            return self._string_value(interned, v, budget)
+        elif t is int:
+            return _K_DA_INT + _varint(v), b""
+        elif t is float:
+            return _K_DA_DOUBLE + _pack_double(v), b""
+        try:
+            encode = _value_encoders[t]
+        except KeyError:
+            encode = _value_encoders[t] = _kind_encoders[_kind(t)]
+        return encode(self, interned, v, budget)
+
+    def _encode_str(self, interned, v, budget):
+        return self._string_value(interned, v, budget)
+
+    def _encode_bool(self, interned, v, budget):
+        return _K_DA_BOOL + (b"\x01" if v else b"\x00"), b""
+
+    def _encode_int(self, interned, v, budget):
+        return _K_DA_INT + _varint(v), b""
+
+    def _encode_float(self, interned, v, budget):
+        return _K_DA_DOUBLE + _pack_double(v), b""
+
+    def _encode_dict(self, interned, v, budget):
+        if len(v) == 0:
+            return _DA_EMPTY, b""
+        return b"", self._annotations(interned, _K_DA_DICT_ENTRIES, v, budget)
+
+    def _encode_list(self, interned, v, budget):
+        if len(v) == 0:
+            return _DA_EMPTY, b""
+        list_max_size = self._parent.list_max_size
+        out = []
+        for i,vv in zip(range(len(v)), v):
+            if i == list_max_size:
+                head, tail = self._string_value(interned, "... ({} more items)".format(len(v) - i))
+            elif budget[0] <= 0 or budget[1] <= 0:
+                head, tail = self._string_value(interned, "... (truncated)")
+            else:
+                # for some reason, perfetto ui crashes on nested lists.
+                # add a dummy dictionary here
+                if isinstance(vv, (list, tuple, set, frozenset)):
+                    vv = {"array" : vv}
+                head, tail = self._annotation_value(interned, vv, budget)
+                out.append(_K_DA_ARRAY_VALUES + _varint(len(head) + len(tail)) + head + tail)
+                continue
+            out.append(_K_DA_ARRAY_VALUES + _varint(len(head) + len(tail)) + head + tail)
+            break
+        return b"", b"".join(out)
+
+    def _encode_bytes(self, interned, v, budget):
+        return _f_str(6, _bytes_summary(v)), b""
+
+    def _encode_enum(self, interned, v, budget):
+        return self._string_value(interned, str(v), budget)
+
+    def _encode_dataclass(self, interned, v, budget):
+        return self._encode_dict(interned, _dataclass_fields(v), budget)
+
+    def _encode_ndarray(self, interned, v, budget):
+        return self._encode_dict(interned, _ndarray_summary(v, self._parent.list_max_size), budget)
+
+    def _encode_npscalar(self, interned, v, budget):
+        # the Python value takes the node
+        budget[0] += 1
+        return self._annotation_value(interned, v.item(), budget)
+
+    def _encode_other(self, interned, v, budget):
+        return _f_str(6, str(type(v))), b""
+
+    def _annotations(self, interned, key, kwargs, budget):
+        out = []
+        cnt = 0
+        list_max_size = self._parent.list_max_size
+        name_iids = self._annotation_name_iids
+        for k,v in kwargs.items():
+            cnt += 1
+            if cnt == list_max_size:
+                body = (name_iids.get("...") or self._get_annotation_name_iid_for(interned, "...")) + _f_str(6, "({} more items)".format(len(kwargs) - cnt))
+                out.append(key + _varint(len(body)) + body)
+                break
+            if budget[0] <= 0 or budget[1] <= 0:
+                body = (name_iids.get("...") or self._get_annotation_name_iid_for(interned, "...")) + _f_str(6, "(truncated)")
+                out.append(key + _varint(len(body)) + body)
+                break
+            if type(k) is not str:
+                k = str(k)
+            name = name_iids.get(k) or self._get_annotation_name_iid_for(interned, k)
+            head, tail = self._annotation_value(interned, v, budget)
+            body = name + head + tail
+            out.append(key + _varint(len(body)) + body)
+        return b"".join(out)
+
+    def _budget(self):
+        """ The annotation budget of an event: [nodes, bytes] """
+        return [self._parent.annotation_max_nodes, self._parent.annotation_max_bytes]
+
+    def _timestamp(self, ts):
+        """ The timestamp to encode, and the fields that follow `sequence_flags` """
+        if not self._incremental:
+            return ts, _SEQ_NEEDS_INCREMENTAL_STATE
+        last = self.last_timestamp
+        if ts >= last:
+            self.last_timestamp = ts
+            return ts - last, _SEQ_NEEDS_INCREMENTAL_STATE
+        return ts, _SEQ_NEEDS_INCREMENTAL_STATE + self._absolute_clock
+
+    def _event(self, ts, ev, interned):
+        # self._timestamp(), inlined
+        flags = _SEQ_NEEDS_INCREMENTAL_STATE
+        if self._incremental:
+            last = self.last_timestamp
+            if ts >= last:
+                self.last_timestamp = ts
+                ts -= last
+            else:
+                flags += self._absolute_clock
+        if interned:
+            if len(interned) > 1:
+                interned.sort(key=_field_number_order)
+            interned = b"".join(interned)
+            pkt = b"".join((_K_TIMESTAMP, _varint(ts), self._tpsid, _K_TRACK_EVENT, _varint(len(ev)), ev,
+                            _K_INTERNED_DATA, _varint(len(interned)), interned, flags))
+        else:
+            pkt = b"".join((_K_TIMESTAMP, _varint(ts), self._tpsid, _K_TRACK_EVENT, _varint(len(ev)), ev, flags))
+        self._buf += _K_PACKET + _varint(len(pkt)) + pkt
+        self._num_packets += 1
+
+    def track_instant(self, uuid, ts, annotation, kwargs, flow, caller = None):
+        with self.lock:
+            interned = []
+            ev = _CATEGORY_IID_1
+            if kwargs is not None:
+                ev += self._annotations(interned, _K_DEBUG_ANNOTATIONS, kwargs, self._budget())
+            ev += _TYPE_INSTANT + (self._name_iids.get(annotation) or self._get_iid_for(interned, annotation)) + (self._track_uuids.get(uuid) or self._track_uuid(uuid))
+            if caller is not None:
+                ev += self._source_iids.get(caller) or self._get_source_iid_for(interned, caller)
+            if flow:
+                ev += _flows(flow)
+            self._event(ts, ev, interned)
+
+    def track_open(self, uuid, ts, annotation, kwargs, flow, caller = None):
+        with self.lock:
+            interned = []
+            ev = _CATEGORY_IID_1
+            if kwargs is not None:
+                ev += self._annotations(interned, _K_DEBUG_ANNOTATIONS, kwargs, self._budget())
+            ev += _TYPE_SLICE_BEGIN + (self._name_iids.get(annotation) or self._get_iid_for(interned, annotation)) + (self._track_uuids.get(uuid) or self._track_uuid(uuid))
+            if caller is not None:
+                ev += self._source_iids.get(caller) or self._get_source_iid_for(interned, caller)
+            if flow:
+                ev += _flows(flow)
+            self._event(ts, ev, interned)
+
+    def track_close(self, uuid, ts, flow):
+        with self.lock:
+            ev = _TYPE_SLICE_END + (self._track_uuids.get(uuid) or self._track_uuid(uuid))
+            if flow:
+                ev += _flows(flow)
+            self._event(ts, ev, None)
+
+    def track_count(self, uuid, ts, value):
+        with self.lock:
+            value = _counter_value(value)
+            if type(value) is float:
+                value = _K_DOUBLE_COUNTER_VALUE + _pack_double(value)
+            else:
+                value = _K_COUNTER_VALUE + _varint(value)
+            self._event(ts, _TYPE_COUNTER + (self._track_uuids.get(uuid) or self._track_uuid(uuid)) + value, None)
+
+    def track_count_many(self, uuid, ts, values):
+        with self.lock:
+            np = _numpy()
+            deltas = None
+            if np is not None and self._incremental:
+                deltas = _np_deltas(ts, self.last_timestamp)
+            if np is None or (self._incremental and deltas is None) or np.asarray(values).dtype.kind == "f":
+                # (doubles are written one by one)
+                for t, v in zip(ts, values):
+                    self.track_count(uuid, int(t), v)
+                return
+            if deltas is not None:
+                last = self.last_timestamp + int(deltas.sum())
+                ts = deltas
+            ts, ts_mask, ts_len = _np_varints(ts)
+            values, values_mask, values_len = _np_varints(values)
+            if len(ts) != len(values):
+                raise ValueError("ts and values must have the same length")
+            if len(ts) == 0:
+                return
+            if deltas is not None:
+                self.last_timestamp = last
+
+            head = _TYPE_COUNTER + (self._track_uuids.get(uuid) or self._track_uuid(uuid)) + _K_COUNTER_VALUE
+            ev_len = len(head) + values_len
+            pkt_len = len(_K_TIMESTAMP) + ts_len + len(self._tpsid) + len(_K_TRACK_EVENT) + 1 + ev_len + len(_SEQ_NEEDS_INCREMENTAL_STATE)
+            mat, mask = _np_rows(len(ts), [_K_PACKET, _np_length(pkt_len), _K_TIMESTAMP, (ts, ts_mask), self._tpsid,
+                                           _K_TRACK_EVENT, _np_length(ev_len), head, (values, values_mask), _SEQ_NEEDS_INCREMENTAL_STATE])
+            self._buf += mat[mask].tobytes()
+            self._num_packets += len(ts)
+
+    def track_slices_many(self, uuid, starts, ends, names):
+        with self.lock:
+            np = _numpy()
+            deltas = None
+            if np is not None:
+                starts = np.asarray(starts).reshape(-1)
+                ends = np.asarray(ends).reshape(-1)
+                num_slices = len(starts)
+                if len(ends) != num_slices:
+                    raise ValueError("starts and ends must have the same length")
+                if num_slices == 0:
+                    return
+                if self._incremental:
+                    # the packets go B0 E0 B1 E1 ...
+                    both = np.empty(2 * num_slices, dtype=np.int64)
+                    both[0::2] = starts
+                    both[1::2] = ends
+                    deltas = _np_deltas(both, self.last_timestamp)
+            if np is None or (self._incremental and deltas is None):
+                for i, (start, end) in enumerate(zip(starts, ends)):
+                    self.track_open(uuid, int(start), names if isinstance(names, str) else str(names[i]), None, [])
+                    self.track_close(uuid, int(end), [])
+                return
+            first_start = int(starts[0])
+            if deltas is not None:
+                last = int(both[-1])
+                starts, ends = deltas[0::2], deltas[1::2]
+            starts, starts_mask, starts_len = _np_varints(starts)
+            ends, ends_mask, ends_len = _np_varints(ends)
+
+            # Intern every distinct name up front.  The definitions ride on the first packet of the batch.
+            interned = []
+            if isinstance(names, str):
+                unique_names, inverse = [names], np.zeros(num_slices, dtype=np.intp)
+            else:
+                unique_names, inverse = np.unique(np.asarray(names), return_inverse=True)
+                if len(inverse) != num_slices:
+                    raise ValueError("names must be a single name or have one name per slice")
+            for name in unique_names:
+                name = str(name)
+                if name not in self._name_iids:
+                    self._get_iid_for(interned, name)
+            iids = np.array([self.interned_data[str(name)] for name in unique_names], dtype=np.uint64)[inverse.reshape(-1)]
+            iids, iids_mask, iids_len = _np_varints(iids)
+
+            u = self._track_uuids.get(uuid) or self._track_uuid(uuid)
+            fixed_len = len(_K_TIMESTAMP) + len(self._tpsid) + len(_K_TRACK_EVENT) + 1 + len(_SEQ_NEEDS_INCREMENTAL_STATE)
+
+            begin_head = _CATEGORY_IID_1 + _TYPE_SLICE_BEGIN + _K_NAME_IID
+            begin_ev_len = len(begin_head) + iids_len + len(u)
+            begin, begin_mask = _np_rows(num_slices, [_K_PACKET, _np_length(fixed_len + starts_len + begin_ev_len), _K_TIMESTAMP,
+                                                      (starts, starts_mask), self._tpsid, _K_TRACK_EVENT, _np_length(begin_ev_len),
+                                                      begin_head, (iids, iids_mask), u, _SEQ_NEEDS_INCREMENTAL_STATE])
+
+            end_ev = _TYPE_SLICE_END + u
+            end, end_mask = _np_rows(num_slices, [_K_PACKET, _np_length(fixed_len + ends_len + len(end_ev)), _K_TIMESTAMP,
+                                                  (ends, ends_mask), self._tpsid, _K_TRACK_EVENT, _varint(len(end_ev)),
+                                                  end_ev, _SEQ_NEEDS_INCREMENTAL_STATE])
+
+            # Interleave begin/end rows (padded to the same width): B0 E0 B1 E1 ...
+            width = max(begin.shape[1], end.shape[1])
+            rows = np.zeros((num_slices, 2, width), dtype=np.uint8)
+            rows_mask = np.zeros((num_slices, 2, width), dtype=bool)
+            rows[:, 0, :begin.shape[1]] = begin
+            rows_mask[:, 0, :begin.shape[1]] = begin_mask
+            rows[:, 1, :end.shape[1]] = end
+            rows_mask[:, 1, :end.shape[1]] = end_mask
+
+            # The first begin packet also carries the newly interned names.
+            first_name = str(unique_names[inverse.reshape(-1)[0]])
+            self._event(first_start, _CATEGORY_IID_1 + _TYPE_SLICE_BEGIN + self._name_iids[first_name] + u, interned)
+            self._buf += rows.reshape(2 * num_slices, width)[1:][rows_mask.reshape(2 * num_slices, width)[1:]].tobytes()
+            self._num_packets += 2 * num_slices - 1
+            if deltas is not None:
+                self.last_timestamp = last
+
+# type -> _WireSequence method that encodes its values as debug annotations
+_value_encoders = {}
+_kind_encoders = {
+    _KIND_STR: _WireSequence._encode_str,
+    _KIND_BOOL: _WireSequence._encode_bool,
+    _KIND_INT: _WireSequence._encode_int,
+    _KIND_FLOAT: _WireSequence._encode_float,
+    _KIND_DICT: _WireSequence._encode_dict,
+    _KIND_LIST: _WireSequence._encode_list,
+    _KIND_BYTES: _WireSequence._encode_bytes,
+    _KIND_ENUM: _WireSequence._encode_enum,
+    _KIND_DATACLASS: _WireSequence._encode_dataclass,
+    _KIND_NDARRAY: _WireSequence._encode_ndarray,
+    _KIND_NPSCALAR: _WireSequence._encode_npscalar,
+    _KIND_OTHER: _WireSequence._encode_other,
+}
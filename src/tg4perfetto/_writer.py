@@ -0,0 +1,208 @@
+import collections
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+class _AsyncWriter:
+    """ Serializes and writes chunks on a dedicated thread, so that event calls never wait for disk I/O.
+
+    The producer swaps out a sequence's buffer (double buffering) and queues it here.  At most max_pending
+    chunks can be queued; when the queue is full, submit() either blocks until the writer catches up or
+    gives up and returns False, depending on `block`.
+    """
+    def __init__(self, write, max_pending : int = 4, block : bool = True):
+        self._write = write
+        self._block = block
+        self._queue = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._run, name="tg4perfetto-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(item)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, chunk, block : bool = None) -> bool:
+        """ Queue a chunk for writing.  Returns False if the chunk was dropped because the queue was full. """
+        if block is None:
+            block = self._block
+        try:
+            self._queue.put(chunk, block)
+        except queue.Full:
+            return False
+        return True
+
+    def wait(self):
+        """ Wait until every chunk queued so far is written """
+        self._queue.join()
+
+    def close(self):
+        """ Write out everything that is queued and stop the writer thread """
+        self._queue.put(None)
+        self._thread.join()
+
+class _RingBuffer:
+    """ Keeps the most recent chunks in memory instead of writing them, up to `size` bytes in total.
+
+    Used as the write function in flight-recorder mode.  The oldest chunks are discarded first, so
+    every chunk must be decodable on its own.
+    """
+    def __init__(self, size : int):
+        self._size = size
+        self._chunks = collections.deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # chunks written so far, and how many of them have been evicted
+        self.num_chunks = 0
+        self.dropped_chunks = 0
+
+    def __call__(self, data):
+        with self._lock:
+            self._chunks.append(data)
+            self.num_chunks += 1
+            self._bytes += len(data)
+            while self._bytes > self._size and len(self._chunks) > 1:
+                self._bytes -= len(self._chunks.popleft())
+                self.dropped_chunks += 1
+
+    def contents(self) -> list:
+        with self._lock:
+            return list(self._chunks)
+
+class _RotatingFile:
+    """ A write-only file that is split into numbered segments, e.g. trace.0.perfetto-trace, trace.1.perfetto-trace, ...
+
+    A new segment starts once the current one would exceed max_bytes or is max_seconds old.  Only whole writes
+    go to a segment.  Each segment starts with preamble() and ends with postamble(), so that it can be loaded
+    on its own.  Only the last `keep` segments are kept on disk.
+    """
+    def __init__(self, filename : str, max_bytes : int = None, max_seconds : float = None, keep : int = None,
+                 preamble = None, postamble = None):
+        root, ext = os.path.splitext(filename)
+        self._pattern = root + ".{}" + ext
+        self._max_bytes = max_bytes
+        self._max_seconds = max_seconds
+        self._keep = keep
+        self._preamble = preamble
+        self._postamble = postamble
+        self._index = 0
+        self._segments = collections.deque()
+        self._file = None
+
+    @property
+    def segments(self) -> list:
+        """ File names of the segments on disk, oldest first """
+        return list(self._segments)
+
+    def rotate(self):
+        """ Start a new segment """
+        self._close_segment()
+        name = self._pattern.format(self._index)
+        self._index += 1
+        self._file = open(name, "wb")
+        self._segments.append(name)
+        while self._keep is not None and len(self._segments) > self._keep:
+            try:
+                os.remove(self._segments.popleft())
+            except FileNotFoundError:
+                pass
+        self._started = time.monotonic()
+        data = self._preamble() if self._preamble is not None else b""
+        self._file.write(data)
+        self._preamble_bytes = self._bytes = len(data)
+
+    def write(self, data):
+        if self._file is None:
+            self.rotate()
+        elif self._bytes > self._preamble_bytes and (
+                (self._max_bytes is not None and self._bytes + len(data) > self._max_bytes) or
+                (self._max_seconds is not None and time.monotonic() - self._started >= self._max_seconds)):
+            self.rotate()
+        self._file.write(data)
+        self._bytes += len(data)
+
+    def _close_segment(self):
+        if self._file is not None:
+            if self._postamble is not None:
+                self._file.write(self._postamble())
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        self._close_segment()
+
+# mmap_output files start with a packet that perfetto skips (its only field is unknown): a magic string, the number
+# of bytes of the file written so far (including this header), and whether the file was closed properly.
+_MMAP_MAGIC = b"TG4PMMAP"
+_MMAP_HEADER = b"\x0a\x1b" + b"\xfa\x7f\x18" + _MMAP_MAGIC + bytes(16)
+_MMAP_LENGTH_OFFSET = 13
+_MMAP_CLOSED_OFFSET = 21
+_MMAP_INITIAL_SIZE = 1 << 24
+_u64 = struct.Struct("<Q")
+
+def _mmap_written_length(header : bytes):
+    """ How much of an mmap_output file was written, from its first bytes; None if it isn't one """
+    if len(header) < len(_MMAP_HEADER) or header[:_MMAP_LENGTH_OFFSET] != _MMAP_HEADER[:_MMAP_LENGTH_OFFSET]:
+        return None
+    return _u64.unpack_from(header, _MMAP_LENGTH_OFFSET)[0]
+
+class _MmapFile:
+    """ A write-only file that is written through a memory map, so that whatever was written survives the process
+    being killed: it is in the page cache already, and the kernel writes it out.  Writes don't make system calls,
+    except when the file grows (it doubles, from 16 MiB).
+
+    The header records how many bytes are valid after every write; repair_trace() cuts a file whose process died
+    back to that.  close() truncates the file to its contents.
+    """
+    def __init__(self, filename : str, initial_size : int = _MMAP_INITIAL_SIZE):
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        self._size = initial_size
+        os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        self._map[:len(_MMAP_HEADER)] = _MMAP_HEADER
+        self._pos = len(_MMAP_HEADER)
+        _u64.pack_into(self._map, _MMAP_LENGTH_OFFSET, self._pos)
+
+    def write(self, data):
+        end = self._pos + len(data)
+        if end > self._size:
+            self._grow(end)
+        self._map[self._pos:end] = data
+        self._pos = end
+        # after the data: a process killed in between leaves the previous length, which is still consistent
+        _u64.pack_into(self._map, _MMAP_LENGTH_OFFSET, end)
+
+    def _grow(self, needed):
+        size = self._size
+        while size < needed:
+            size *= 2
+        self._map.flush()
+        self._map.close()
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._size = size
+
+    def flush(self):
+        # the page cache has it all; msync() would only matter if the machine went down
+        pass
+
+    def close(self):
+        if self._map is None:
+            return
+        _u64.pack_into(self._map, _MMAP_CLOSED_OFFSET, 1)
+        self._map.close()
+        self._map = None
+        os.ftruncate(self._fd, self._pos)
+        os.close(self._fd)
@@ -0,0 +1,74 @@
+""" Tracing coroutines: per-task tracks, flows from create_task() and use_track() across awaits """
+import asyncio
+import collections
+
+import tg4perfetto
+from tg4perfetto import TraceReader, summarize
+
+@tg4perfetto.trace_func
+async def _work(i):
+    async with tg4perfetto.trace("inner", i):
+        # the tasks interleave here
+        await asyncio.sleep(0.001 * (i % 3))
+    tg4perfetto.instant("done")
+    return i
+
+def _events(path):
+    """ (track name, event type, name, flow ids, terminating flow ids) of every track event """
+    reader = TraceReader(path)
+    events = []
+    for packet, ts in reader:
+        if packet.HasField("track_event"):
+            ev = packet.track_event
+            events.append((reader.track_name(reader.track_uuid(packet)), ev.type, reader.event_name(packet),
+                           list(ev.flow_ids), list(ev.terminating_flow_ids)))
+    return events
+
+def test_task_tracks(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+
+    async def main():
+        with tg4perfetto.open(path, task_tracks=True):
+            assert await asyncio.gather(*(_work(i) for i in range(20))) == list(range(20))
+            # done tasks give their tracks back
+            assert await asyncio.gather(*(_work(i) for i in range(5))) == list(range(5))
+    asyncio.run(main())
+
+    # interleaved tasks' slices nest, because every task has a track of its own
+    summary = summarize(path)
+    assert summary["validation"]["ok"], summary["validation"]
+    assert summary["slices"]["_work"]["count"] == summary["slices"]["inner"]["count"] == 25
+
+    events = _events(path)
+    tracks = collections.Counter(track for track, _, name, _, _ in events if name == "_work")
+    assert len(tracks) == 20
+    assert all(track.startswith("MainThread task ") for track in tracks)
+
+    # a flow from each create_task() (gather() makes one task per coroutine) to the task's first event
+    flows = collections.Counter(f for event in events for f in event[3] + event[4])
+    assert len(flows) == 25
+    assert set(flows.values()) == {2}
+    firsts = [track for track, _, name, ids, _ in events if ids and name == "_work"]
+    assert len(firsts) == 25
+
+def test_use_track_follows_awaits(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    mine = tg4perfetto.track("mine")
+
+    async def step(i):
+        await asyncio.sleep(0)
+        tg4perfetto.instant("step")
+
+    async def main():
+        with tg4perfetto.open(path):
+            with tg4perfetto.use_track(mine):
+                for i in range(3):
+                    await step(i)
+                # tasks inherit the context, and with it the track
+                await asyncio.create_task(step(3))
+            tg4perfetto.instant("after")
+    asyncio.run(main())
+
+    events = [(track, name) for track, _, name, _, _ in _events(path)]
+    assert events.count(("mine", "step")) == 4
+    assert ("mine", "after") not in events
@@ -0,0 +1,96 @@
+""" count_many() and slices_many() write what the equivalent count(), open() and close() calls do """
+import pytest
+
+from tg4perfetto import TraceGenerator, TraceReader
+
+np = pytest.importorskip("numpy")
+
+def _write(path, record, **kwargs):
+    tgen = TraceGenerator(str(path), **kwargs)
+    group = tgen.create_group("process")
+    record(group.create_track("thread"), group.create_counter_track("counter"))
+    tgen.close()
+    with open(str(path), "rb") as f:
+        return f.read()
+
+def _events(path):
+    reader = TraceReader(str(path))
+    events = []
+    for packet, ts in reader:
+        if packet.HasField("track_event"):
+            ev = packet.track_event
+            value = ev.double_counter_value if ev.HasField("double_counter_value") else ev.counter_value
+            events.append((ts, ev.type, reader.event_name(packet), reader.track_name(reader.track_uuid(packet)), value))
+    assert reader.errors == []
+    return events
+
+_starts = np.array([0, 10, 15, 1000, 1000, 5, 2 ** 40], dtype=np.int64)
+_ends = _starts + np.array([5, 3, 0, 100, 1, 7, 2 ** 20])
+_names = ["a", "b", "a", "c", "d", "a", "b"]
+
+@pytest.mark.parametrize("kwargs", [{}, {"incremental_timestamps": True}, {"engine": "protobuf"}],
+                         ids=["wire", "incremental", "protobuf"])
+def test_equals_scalar_calls(tmp_path, kwargs):
+    ts = np.arange(0, 5000, 7, dtype=np.int64)
+    values = (ts * 31) % 1000 - 500
+
+    def bulk(track, counter):
+        counter.count_many(ts, values)
+        track.slices_many(_starts, _ends, _names)
+        track.slices_many(_starts, _ends, "same")
+
+    def scalar(track, counter):
+        for t, v in zip(ts.tolist(), values.tolist()):
+            counter.count(t, v)
+        for names in (_names, ["same"] * len(_names)):
+            for start, end, name in zip(_starts.tolist(), _ends.tolist(), names):
+                track.open(start, name)
+                track.close(end)
+
+    # (the bytes may differ: a batch interns its names up front)
+    _write(tmp_path / "bulk.perfetto-trace", bulk, **kwargs)
+    _write(tmp_path / "scalar.perfetto-trace", scalar, **kwargs)
+    assert _events(tmp_path / "bulk.perfetto-trace") == _events(tmp_path / "scalar.perfetto-trace")
+
+def test_lists(tmp_path):
+    # plain sequences take the same path as arrays
+    def bulk(track, counter):
+        counter.count_many([1, 2, 3], [4, -5, 6])
+        track.slices_many([1, 2], [3, 4], ["x", "y"])
+    def arrays(track, counter):
+        counter.count_many(np.array([1, 2, 3]), np.array([4, -5, 6]))
+        track.slices_many(np.array([1, 2]), np.array([3, 4]), ["x", "y"])
+    assert _write(tmp_path / "lists.perfetto-trace", bulk) == _write(tmp_path / "arrays.perfetto-trace", arrays)
+
+def test_length_mismatch(tmp_path):
+    tgen = TraceGenerator(str(tmp_path / "trace.perfetto-trace"))
+    track = tgen.create_group("process").create_track("thread")
+    with pytest.raises(ValueError):
+        track.slices_many(np.array([1, 2]), np.array([3]), "x")
+    tgen.close()
+
+@pytest.mark.parametrize("engine", ["wire", "protobuf"])
+def test_value_types(tmp_path, engine):
+    # NumPy floats of any width are doubles and NumPy integers ints, one by one as in bulk
+    ts = np.arange(3, dtype=np.int64)
+
+    def record(track, counter):
+        counter.count(0, np.float32(1.5))
+        counter.count(1, np.float64(2.5))
+        counter.count(2, np.int64(-3))
+        counter.count_many(ts + 10, np.array([0.5, 1.25, -2], dtype=np.float32))
+        counter.count_many(ts + 20, np.array([0.5, 1.25, -2], dtype=np.float64))
+        counter.count_many(ts + 30, np.array([4, -5, 2 ** 40], dtype=np.int64))
+
+    path = tmp_path / "trace.perfetto-trace"
+    _write(path, record, engine=engine)
+    samples = []
+    for packet, t in TraceReader(str(path)):
+        ev = packet.track_event
+        if ev.HasField("double_counter_value"):
+            samples.append((t, ev.double_counter_value))
+        elif ev.HasField("counter_value"):
+            samples.append((t, ev.counter_value))
+    assert samples == [(0, 1.5), (1, 2.5), (2, -3), (10, 0.5), (11, 1.25), (12, -2.0), (20, 0.5), (21, 1.25),
+                       (22, -2.0), (30, 4), (31, -5), (32, 2 ** 40)]
+    assert [type(v) for _, v in samples] == [float] * 2 + [int] + [float] * 6 + [int] * 3
@@ -0,0 +1,102 @@
+""" tg4perfetto.count: coalescing, and incremental counters adding up to the right values wherever a trace is cut """
+import glob
+import threading
+
+import pytest
+
+import tg4perfetto
+from tg4perfetto import TraceReader
+
+def _values(path, name, incremental=False):
+    """ The values of a counter, in the order recorded.  Incremental counters are added up the way Perfetto does
+    it: per sequence, from where the sequence last cleared its incremental state. """
+    reader = TraceReader(path)
+    values, sums, sequences = [], {}, set()
+    for packet, ts in reader:
+        seq = packet.trusted_packet_sequence_id
+        if packet.sequence_flags & 1:
+            sums.pop(seq, None)
+        if packet.HasField("track_event") and reader.track_name(reader.track_uuid(packet)) == name:
+            ev = packet.track_event
+            value = ev.double_counter_value if ev.HasField("double_counter_value") else ev.counter_value
+            if incremental:
+                value = sums[seq] = sums.get(seq, 0) + value
+                sequences.add(seq)
+            values.append(value)
+    assert reader.errors == []
+    # every thread's changes are on the one sequence
+    assert len(sequences) <= 1
+    return values
+
+def test_interval(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    counter = tg4perfetto.count("requests", interval=3600)
+
+    def work():
+        for _ in range(1000):
+            counter.increment(1)
+
+    with tg4perfetto.open(path):
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+    # the first increment, then the last value when the trace is closed
+    values = _values(path, "requests")
+    assert len(values) == 2
+    assert values[-1] == 4000
+
+def test_min_change(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    counter = tg4perfetto.count("queue", min_change=10)
+    with tg4perfetto.open(path):
+        for i in range(100):
+            counter.count(i)
+    assert _values(path, "queue") == list(range(10, 100, 10)) + [99]
+
+def _increment(counter, threads=4, n=500):
+    def work():
+        for _ in range(n):
+            counter.increment(1)
+    threads = [threading.Thread(target=work) for _ in range(threads)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+def test_incremental(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    counter = tg4perfetto.count("total", incremental=True)
+    with tg4perfetto.open(path) as session:
+        session._tracefile.flush_threshold = 100
+        _increment(counter)
+    assert _values(path, "total", True) == list(range(1, 2001))
+
+def test_incremental_rotation(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    counter = tg4perfetto.count("total", incremental=True)
+    with tg4perfetto.open(path, rotate_bytes=5000) as session:
+        session._tracefile.flush_threshold = 100
+        _increment(counter)
+    segments = sorted(glob.glob(str(tmp_path / "trace.*.perfetto-trace")), key=lambda s: int(s.split(".")[-2]))
+    assert len(segments) > 2
+    # every segment adds up on its own
+    values = []
+    for segment in segments:
+        values += _values(segment, "total", True)
+    assert values == list(range(1, 2001))
+
+@pytest.mark.parametrize("kwargs", [{"ring_buffer_size": 5000},
+                                    {"async_flush": True, "max_pending_flushes": 1, "backpressure": "drop"}],
+                         ids=["ring", "drop"])
+def test_incremental_lost_chunks(tmp_path, kwargs):
+    path = str(tmp_path / "trace.perfetto-trace")
+    counter = tg4perfetto.count("total", incremental=True)
+    with tg4perfetto.open(path, **kwargs) as session:
+        session._tracefile.flush_threshold = 20
+        _increment(counter)
+        if "ring_buffer_size" in kwargs:
+            tg4perfetto.dump()
+    # whatever was evicted or dropped, the values that are left are right
+    values = _values(path, "total", True)
+    assert values[-1] == 2000
+    assert values == sorted(set(values))
+    if "ring_buffer_size" in kwargs:
+        assert values == list(range(values[0], 2001))
@@ -0,0 +1,72 @@
+""" Instrumentation left in place: no trace open, disable()/enable(), and TG4PERFETTO_DISABLED """
+import os
+import subprocess
+import sys
+
+import tg4perfetto
+from tg4perfetto import summarize
+
+def _instrumented(i):
+    with tg4perfetto.trace("slice"):
+        tg4perfetto.instant("instant")
+    _counter.count(i)
+    return _decorated(i)
+
+_counter = tg4perfetto.count("counter")
+
+@tg4perfetto.trace_func
+def _decorated(i):
+    return i
+
+def test_no_trace_open():
+    assert not tg4perfetto.enabled()
+    assert [_instrumented(i) for i in range(3)] == [0, 1, 2]
+    assert tg4perfetto.instant("flows", num_outgoing_flow_ids=2) != []
+
+def test_disable(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    tg4perfetto.disable()
+    try:
+        # holds across open()
+        with tg4perfetto.open(path):
+            assert not tg4perfetto.enabled()
+            for i in range(10):
+                _instrumented(i)
+            tg4perfetto.enable()
+            assert tg4perfetto.enabled()
+            for i in range(10, 13):
+                _instrumented(i)
+            tg4perfetto.disable()
+            for i in range(13, 20):
+                _instrumented(i)
+    finally:
+        tg4perfetto.enable()
+    assert not tg4perfetto.enabled()
+    summary = summarize(path)
+    assert summary["validation"]["ok"], summary["validation"]
+    assert summary["slices"]["slice"]["count"] == summary["slices"]["_decorated"]["count"] == 3
+    assert summary["instants"]["instant"] == 3
+    assert summary["counters"]["counter"]["last"] == 12
+
+_ENVIRONMENT_CHECK = """
+import sys
+import tg4perfetto
+
+def func():
+    pass
+
+assert tg4perfetto.trace_func(func) is func
+assert tg4perfetto.trace_func_args(func) is func
+assert tg4perfetto.trace_func(tg4perfetto.track("t"))(func) is func
+with tg4perfetto.open(sys.argv[1]):
+    assert not tg4perfetto.enabled()
+    tg4perfetto.instant("paused")
+    tg4perfetto.enable()
+    tg4perfetto.instant("enabled")
+"""
+
+def test_environment(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    env = dict(os.environ, TG4PERFETTO_DISABLED="1", PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, "-c", _ENVIRONMENT_CHECK, path], env=env, check=True)
+    assert summarize(path)["instants"] == {"enabled": 1}
@@ -0,0 +1,137 @@
+""" The wire engine must write exactly the bytes the protobuf (pb2) engine does """
+import pytest
+
+from tg4perfetto import TraceGenerator, TraceReader, summarize
+
+def _write(tmp_path, engine, scenario, **kwargs):
+    path = str(tmp_path / "{}.perfetto-trace".format(engine))
+    tgen = TraceGenerator(path, engine, **kwargs)
+    scenario(tgen)
+    tgen.close()
+    with open(path, "rb") as f:
+        return path, f.read()
+
+def _check_parity(tmp_path, scenario, **kwargs):
+    wire_path, wire = _write(tmp_path, "wire", scenario, **kwargs)
+    proto_path, proto = _write(tmp_path, "protobuf", scenario, **kwargs)
+    assert wire == proto
+    summary = summarize(wire_path)
+    assert summary["validation"]["ok"], summary["validation"]
+    return wire_path, summary
+
+def _basic(tgen):
+    group = tgen.create_group("process", "main")
+    group.open(100, "outer")
+    group.close(250)
+    counter = tgen.create_counter_track("counter")
+    for i in range(5):
+        counter.count(i * 100, i * 3 - 5)
+    counter.count(600, 1.5)
+    track = group.create_track("thread")
+    track.instant(200, "instant")
+    track.open(300, "slice", {"a": "b", "c": 1})
+    track.close(400)
+
+def test_basic(tmp_path):
+    _, summary = _check_parity(tmp_path, _basic)
+    assert summary["slices"]["outer"]["count"] == 1
+    assert summary["slices"]["slice"]["total_ns"] == 100
+    assert summary["instants"] == {"instant": 1}
+    assert summary["counters"]["counter"]["count"] == 6
+
+def _annotations(tgen):
+    track = tgen.create_group("process").create_track("thread")
+    track.instant(10, "nested", {
+        "list": [[1], 2, 3, -4, "a", 1.5, None, {"key": "value", "flag": True}],
+        "dict": {"a": "abc", "b": False, "c": {"d": "e", "f": 0x1234567}},
+        "long_list": list(range(40)),
+        "long_dict": {str(i): i for i in range(30)},
+        "empty_list": [],
+        "empty_dict": {},
+        "tuple": (1, 2),
+        "bytes": b"\x00\x01",
+    })
+    # the same strings again come out of the interning tables
+    track.instant(20, "nested", {"dict": {"a": "abc"}})
+
+    tgen.annotation_max_bytes = 20
+    track.instant(30, "ascii", {"s": "x" * 100})
+    # truncated on UTF-8 bytes, at a character boundary
+    track.instant(40, "utf8", {"s": "é" * 15, "t": "more"})
+    track.instant(50, "utf8", {"s": "ab" + "€" * 10})
+    tgen.annotation_max_bytes = 4096
+    tgen.annotation_max_nodes = 8
+    track.instant(60, "nodes", {str(i): [i, i + 1] for i in range(10)})
+
+def test_annotations(tmp_path):
+    path, _ = _check_parity(tmp_path, _annotations)
+    reader = TraceReader(path)
+    strings = {}
+    for packet, ts in reader:
+        if packet.HasField("track_event"):
+            for a in packet.track_event.debug_annotations:
+                if a.HasField("string_value"):
+                    strings.setdefault(ts, []).append(a.string_value)
+    assert strings[30][0] == "x" * 20 + "..."
+    assert strings[40][0] == "é" * 10 + "..."
+    assert strings[50][0] == "ab" + "€" * 6 + "..."
+    assert all(len(s.encode()) <= 23 for ts in (40, 50) for s in strings[ts])
+
+def _flows_and_source_locations(tgen):
+    track = tgen.create_group("process").create_track("thread")
+    for i in range(100):
+        flow = [i] if i % 5 == 0 else []
+        track.open(2 * i, "slice", None, flow)
+        track.close(2 * i + 1, [i + 1000] if i % 7 == 0 else [])
+    tgen._track_instant(track._uuid, 300, "located", None, [], ("file.py", 10, "func"))
+    tgen._track_open(track._uuid, 301, "located", None, [], ("file.py", 10, "func"))
+    tgen._track_close(track._uuid, 302, [])
+    tgen._track_open(track._uuid, 303, "other", None, [], ("file.py", 11, "func"))
+    tgen._track_close(track._uuid, 304, [])
+
+def test_flows_and_source_locations(tmp_path):
+    path, summary = _check_parity(tmp_path, _flows_and_source_locations)
+    assert summary["slices"]["slice"]["count"] == 100
+    flows = set()
+    locations = 0
+    for packet, ts in TraceReader(path):
+        ev = packet.track_event
+        flows.update(ev.flow_ids)
+        flows.update(ev.terminating_flow_ids)
+        locations += ev.HasField("source_location_iid")
+    assert flows == {i for i in range(0, 100, 5)} | {i + 1000 for i in range(0, 100, 7)}
+    assert locations == 3
+
+def _many_events(tgen):
+    group = tgen.create_group("process")
+    track = group.create_track("thread")
+    counter = group.create_counter_track("counter")
+    for i in range(2000):
+        track.open(10 * i, "n{}".format(i % 7), {"i": i, "s": "v{}".format(i % 3)} if i % 2 else None)
+        track.instant(10 * i + 1, "instant")
+        counter.count(10 * i + 2, i)
+        track.close(10 * i + 5)
+
+@pytest.mark.parametrize("kwargs", [{}, {"incremental_timestamps": True}], ids=["absolute", "incremental"])
+def test_flush_boundaries(tmp_path, kwargs):
+    def scenario(tgen):
+        # every sequence restarts its interning state many times over
+        tgen.flush_threshold = 100
+        _many_events(tgen)
+        tgen.flush()
+        _basic(tgen)
+    _, summary = _check_parity(tmp_path, scenario, **kwargs)
+    assert summary["track_events"] == 2000 * 4 + 11
+    assert summary["slices"]["n0"]["total_ns"] == 5 * 286
+
+def test_incremental_timestamps(tmp_path):
+    # same timestamps as absolute ones, including timestamps that go backwards
+    def scenario(tgen):
+        track = tgen.create_group("process").create_track("thread")
+        for ts in (1000, 900, 5000, 5000, 10 ** 12, 3):
+            track.instant(ts, "instant")
+    (tmp_path / "absolute").mkdir()
+    plain, _ = _write(tmp_path / "absolute", "wire", scenario)
+    path, _ = _check_parity(tmp_path, scenario, incremental_timestamps=True)
+    times = lambda p: [ts for packet, ts in TraceReader(p) if packet.HasField("track_event")]
+    assert times(path) == times(plain) == [1000, 900, 5000, 5000, 10 ** 12, 3]
@@ -0,0 +1,29 @@
+""" import tg4perfetto stays light: the trace machinery and the protobuf runtime load on first use """
+import os
+import subprocess
+import sys
+
+_CHECK = """
+import sys
+import tg4perfetto
+
+@tg4perfetto.trace_func
+def func():
+    pass
+
+func()
+with tg4perfetto.trace("outside a trace"):
+    tg4perfetto.instant("instant")
+heavy = ("google.protobuf", "tg4perfetto._core", "tg4perfetto._wire", "tg4perfetto._reader")
+loaded = [m for m in heavy if m in sys.modules]
+assert loaded == [], loaded
+
+# and on first use
+tg4perfetto.TraceReader
+assert "google.protobuf" in sys.modules
+"""
+
+def test_lazy_imports():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    env.pop("TG4PERFETTO_DISABLED", None)
+    subprocess.run([sys.executable, "-c", _CHECK], env=env, check=True)
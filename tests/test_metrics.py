@@ -0,0 +1,44 @@
+""" open(metrics_rate=..., trace_gc=True): process metrics as counter tracks, and garbage collections as slices """
+import gc
+import time
+
+import tg4perfetto
+from tg4perfetto import TraceReader, summarize
+
+def _summary(path):
+    summary = summarize(path)
+    assert summary["validation"]["ok"], summary["validation"]
+    return summary
+
+def test_metrics(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    with tg4perfetto.open(path, metrics_rate=100):
+        end = time.perf_counter() + 0.2
+        while time.perf_counter() < end:
+            pass
+    counters = _summary(path)["counters"]
+    assert {"rss_bytes", "threads", "minor_faults", "cpu_user_percent"} <= set(counters)
+    assert counters["rss_bytes"]["last"] > 0
+    # this thread and the collector's
+    assert counters["threads"]["max"] >= 2
+    # only values that changed are written
+    assert counters["threads"]["count"] < 20
+
+def test_trace_gc(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    with tg4perfetto.open(path, trace_gc=True):
+        for _ in range(1000):
+            cycle = []
+            cycle.append(cycle)
+        del cycle
+        gc.collect()
+    assert _summary(path)["slices"]["gc"]["count"] >= 1
+    # generation, collected, uncollectable
+    collections = [[a.int_value for a in packet.track_event.debug_annotations]
+                   for packet, ts in TraceReader(path) if packet.track_event.debug_annotations]
+    # (the automatic collections get some of the cycles first)
+    assert 2 in [generation for generation, _, _ in collections]
+    assert sum(collected for _, collected, _ in collections) >= 1000
+    # no slices once the trace is closed
+    gc.collect()
+    assert _summary(path)["slices"]["gc"]["count"] == len(collections)
@@ -0,0 +1,104 @@
+""" Traces written through tg4perfetto.open() and the decorators """
+import os
+import signal
+
+import pytest
+
+import tg4perfetto
+from tg4perfetto import TraceReader, summarize
+
+def _valid(path):
+    summary = summarize(path)
+    assert summary["validation"]["ok"], summary["validation"]
+    return summary
+
+@tg4perfetto.trace_func
+def _work(i):
+    with tg4perfetto.trace("inner", i=i):
+        tg4perfetto.instant("leaf")
+    return i
+
+def test_open(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    with tg4perfetto.open(path):
+        for i in range(100):
+            _work(i)
+        tg4perfetto.count("counter").count(5)
+    summary = _valid(path)
+    assert summary["slices"]["_work"]["count"] == summary["slices"]["inner"]["count"] == 100
+    assert summary["instants"]["leaf"] == 100
+    assert summary["counters"]["counter"]["last"] == 5
+    assert not tg4perfetto.enabled()
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_fork_shards(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    with tg4perfetto.open(path) as session:
+        flow = tg4perfetto.instant("send", num_outgoing_flow_ids=1)[0]
+        pid = os.fork()
+        if pid == 0:
+            # the child continues in a shard of its own
+            try:
+                tg4perfetto.instant("receive", incoming_flow_ids=[flow])
+                _work(1)
+                session.__exit__(None, None, None)
+            finally:
+                os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+        _work(0)
+
+    shard = str(tmp_path / "trace.{}.perfetto-trace".format(pid))
+    parent, child = _valid(path), _valid(shard)
+    assert parent["instants"] == {"send": 1, "leaf": 1}
+    assert child["instants"] == {"receive": 1, "leaf": 1}
+    assert parent["slices"]["_work"]["count"] == child["slices"]["_work"]["count"] == 1
+
+    # shards don't share track uuids or sequence ids, and the flow connects them
+    uuids, sequences, flows = [], [], []
+    for p in (path, shard):
+        reader = TraceReader(p)
+        packets = [packet for packet, ts in reader]
+        uuids.append(set(reader.tracks))
+        sequences.append({packet.trusted_packet_sequence_id for packet in packets})
+        flows.append({f for packet in packets for f in packet.track_event.flow_ids})
+    assert not uuids[0] & uuids[1]
+    assert not sequences[0] & sequences[1]
+    assert flows[0] == flows[1] == {flow}
+
+def test_dump_on_exception(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    with pytest.raises(KeyError, match="original"):
+        with tg4perfetto.open(path, ring_buffer_size=1 << 20, dump_on_exception=True):
+            _work(0)
+            raise KeyError("original")
+    assert not tg4perfetto.enabled()
+    assert _valid(path)["slices"]["_work"]["count"] == 1
+
+def test_failed_dump_keeps_the_exception(tmp_path, capsys):
+    # the dump can't be written; the exception that left the block still comes out, and the trace is closed
+    path = str(tmp_path / "missing" / "trace.perfetto-trace")
+    with pytest.raises(KeyError, match="original"):
+        with tg4perfetto.open(path, ring_buffer_size=1 << 20, dump_on_exception=True):
+            raise KeyError("original")
+    assert "FileNotFoundError" in capsys.readouterr().err
+    assert not tg4perfetto.enabled()
+    with tg4perfetto.open(str(tmp_path / "next.perfetto-trace")):
+        _work(0)
+    assert _valid(str(tmp_path / "next.perfetto-trace"))["slices"]["_work"]["count"] == 1
+
+@pytest.mark.parametrize("kwargs", [{"dump_on_exception": True}, {"dump_signal": signal.SIGINT}])
+def test_dumps_need_a_ring_buffer(tmp_path, kwargs):
+    with pytest.raises(ValueError):
+        tg4perfetto.open(str(tmp_path / "trace.perfetto-trace"), **kwargs)
+    assert not tg4perfetto.enabled()
+
+def test_sequence_ids_stay_in_the_shard(tmp_path):
+    # far more sequences than a shard has ids: the ids go round, past those of the live sequences
+    from tg4perfetto import TraceGenerator
+    tgen = TraceGenerator(str(tmp_path / "trace.perfetto-trace"), shard=5)
+    live = tgen._thread_sequence().seq_id
+    ids = [tgen._next_seq_id() for _ in range(70000)]
+    tgen.close()
+    assert live not in ids
+    assert all(seq_id >> 16 == 5 and seq_id & 0xffff >= 3 for seq_id in ids)
@@ -0,0 +1,90 @@
+""" tg4perfetto.sampling: every N, per-name probability, head sampling and the rate limiter """
+import random
+import time
+
+import pytest
+
+import tg4perfetto
+from tg4perfetto import summarize
+
+def _summary(path):
+    summary = summarize(path)
+    assert summary["validation"]["ok"], summary["validation"]
+    return summary
+
+def test_every(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    io = tg4perfetto.track("io", sampling=tg4perfetto.sampling(every=10))
+    with tg4perfetto.open(path):
+        for _ in range(1000):
+            with io.trace("op"):
+                pass
+        one_in_four = tg4perfetto.sampling(every=4)
+        for _ in range(100):
+            tg4perfetto.instant("one in four", sampling=one_in_four)
+    summary = _summary(path)
+    assert summary["slices"]["op"]["count"] == 100
+    assert summary["instants"]["one in four"] == 25
+
+def test_probability_per_name(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    track = tg4perfetto.track("t", sampling=tg4perfetto.sampling(probability={"never": 0, "always": 1, "*": 0.5}))
+    random.seed(1)
+    with tg4perfetto.open(path):
+        for _ in range(1000):
+            for name in ("never", "always", "other"):
+                track.instant(name)
+    instants = _summary(path)["instants"]
+    assert "never" not in instants
+    assert instants["always"] == 1000
+    assert 350 < instants["other"] < 650
+
+@tg4perfetto.trace_func
+def _inner():
+    pass
+
+@tg4perfetto.trace_func(tg4perfetto.sampling(probability=0.3, head=True))
+def _root(i):
+    with tg4perfetto.trace("child"):
+        tg4perfetto.instant("leaf")
+        _inner()
+
+def test_head_sampling(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    random.seed(2)
+    with tg4perfetto.open(path):
+        for i in range(1000):
+            _root(i)
+        # outside a sampled-out root, everything is recorded again
+        _inner()
+    summary = _summary(path)
+    roots = summary["slices"]["_root"]["count"]
+    assert 200 < roots < 400
+    # the children follow the decision of their root: sampled requests are complete, the others absent
+    assert summary["slices"]["child"]["count"] == summary["instants"]["leaf"] == roots
+    assert summary["slices"]["_inner"]["count"] == roots + 1
+
+def test_rate_limiter(tmp_path):
+    path = str(tmp_path / "trace.perfetto-trace")
+    policy = tg4perfetto.sampling(max_rate=1000, burst=10)
+    limited = tg4perfetto.track("limited", sampling=policy)
+    sent = 0
+    with tg4perfetto.open(path):
+        start = time.perf_counter()
+        while time.perf_counter() - start < 0.2:
+            limited.instant("spam")
+            sent += 1
+        elapsed = time.perf_counter() - start
+    summary = _summary(path)
+    recorded = summary["instants"]["spam"]
+    assert recorded + policy.dropped == sent
+    # the burst, then max_rate per second
+    assert recorded <= 10 + 1000 * elapsed + 1
+    assert policy.dropped > 0
+    # the counter catches up with the drops at the next event that gets through
+    assert 0 < summary["counters"]["limited dropped"]["last"] <= policy.dropped
+
+@pytest.mark.parametrize("kwargs", [{"every": 0}, {"probability": 1.5}, {"probability": {"a": -1}}, {"max_rate": 0}])
+def test_invalid(kwargs):
+    with pytest.raises(ValueError):
+        tg4perfetto.sampling(**kwargs)
@@ -0,0 +1,88 @@
+""" merge_traces(), filter_trace() and the command line """
+import json
+
+import pytest
+
+from tg4perfetto import TraceGenerator, TraceReader, summarize, merge_traces, filter_trace
+from tg4perfetto._cli import main
+
+def _write(path, n, **kwargs):
+    tgen = TraceGenerator(path, **kwargs)
+    group = tgen.create_group("process")
+    track = group.create_track("thread")
+    counter = group.create_counter_track("counter")
+    for i in range(n):
+        track.open(10 * i, "slice", {"i": i}, [i + 1] if i % 10 == 0 else [])
+        track.instant(10 * i + 1, "instant")
+        counter.count(10 * i + 2, i)
+        track.close(10 * i + 5)
+    tgen.close()
+    return path
+
+def test_merge(tmp_path):
+    inputs = [_write(str(tmp_path / "a.perfetto-trace"), 1000),
+              _write(str(tmp_path / "b.perfetto-trace"), 500, compress=True),
+              _write(str(tmp_path / "c.perfetto-trace"), 200, incremental_timestamps=True)]
+    output = str(tmp_path / "merged.perfetto-trace")
+    result = merge_traces(inputs, output, clock_offsets=[0, 10 ** 9, 0])
+    assert result["errors"] == []
+    summary = summarize(output)
+    assert summary["validation"]["ok"], summary["validation"]
+    assert summary["slices"]["slice"]["count"] == 1700
+    assert summary["last_ts"] == 10 ** 9 + 10 * 499 + 5
+
+    # the inputs used the same uuids, sequence ids and flow ids; the merged trace keeps them apart
+    reader = TraceReader(output)
+    flows = [f for packet, ts in reader for f in packet.track_event.flow_ids]
+    assert len(reader.tracks) == 3 * 3
+    assert len(flows) == len(set(flows)) == 100 + 50 + 20
+    # one trace config, the first input's
+    configs = [packet for packet, ts in TraceReader(output) if packet.HasField("trace_config")]
+    assert len(configs) == 1
+
+@pytest.mark.parametrize("kwargs", [{}, {"compress": True}, {"mmap_output": True}],
+                         ids=["plain", "compressed", "mmap"])
+def test_filter(tmp_path, kwargs):
+    src = _write(str(tmp_path / "trace.perfetto-trace"), 1000, incremental_timestamps=True, **kwargs)
+    dst = str(tmp_path / "filtered.perfetto-trace")
+    assert filter_trace(src, dst, start=1000, end=1999)["errors"] == []
+    summary = summarize(dst)
+    assert summary["validation"]["ok"], summary["validation"]
+    assert summary["slices"]["slice"]["count"] == 100
+    assert (summary["first_ts"], summary["last_ts"]) == (1000, 1995)
+
+def test_cli(tmp_path, capsys):
+    trace = _write(str(tmp_path / "trace.perfetto-trace"), 100)
+
+    assert main(["stats", trace, "--json"]) == 0
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["slices"]["slice"]["count"] == 100
+    assert summary["validation"]["ok"]
+
+    assert main(["stats", trace]) == 0
+    out = capsys.readouterr().out
+    assert "slice" in out and "valid" in out
+
+    assert main(["validate", trace]) == 0
+    assert capsys.readouterr().out.strip() == "valid"
+
+    merged = str(tmp_path / "merged.perfetto-trace")
+    assert main(["merge", merged, trace, trace]) == 0
+    capsys.readouterr()
+    assert summarize(merged)["slices"]["slice"]["count"] == 200
+
+    filtered = str(tmp_path / "filtered.perfetto-trace")
+    assert main(["filter", trace, filtered, "--end", "499"]) == 0
+    capsys.readouterr()
+    assert summarize(filtered)["slices"]["slice"]["count"] == 50
+
+    # cut inside the last packet: invalid until repaired
+    with open(trace, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 3)
+    assert main(["validate", trace, "--json"]) == 1
+    assert not json.loads(capsys.readouterr().out)["ok"]
+    assert main(["repair", trace]) == 0
+    capsys.readouterr()
+    reader = TraceReader(trace)
+    assert sum(1 for _ in reader) > 0
+    assert reader.errors == []